@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+
+from core import alg
+from core.decode import decode
+from core.autofocus import Autofocus
+from core.detect import detect_stars
+from core.value_object import Image, MeasuredImage, StarArea
+from benchmarks.synthetic import star_field, write_frame, focus_sweep
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SCENARIOS = {
+    'small': {
+        'width': 1500,
+        'height': 1000,
+        'star_count': 60,
+        'seeing': 6.0,
+        'noise': 0.01,
+        'detectors': ['blob_log', 'threshold'],
+        'sweep_steps': 9,
+    },
+    'dslr': {
+        'width': 6000,
+        'height': 4000,
+        'star_count': 300,
+        'seeing': 3.0,
+        'noise': 0.01,
+        'detectors': ['threshold'],
+        'sweep_steps': 0,
+    },
+}
+
+FIELD_OPTIONS = ('width', 'height', 'star_count', 'seeing', 'noise',)
+
+
+def timed(fn, repeat=3):
+    """Returns (result, best wall time in seconds, peak traced memory in MB)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, best, peak / 2 ** 20
+
+
+def record(results, stage, fn, items, unit, repeat):
+    result, seconds, peak_mb = timed(fn, repeat)
+    count = items(result) if callable(items) else items
+    results[stage] = {
+        'seconds': seconds,
+        'peak_mb': peak_mb,
+        'throughput': count / seconds if seconds > 0 else None,
+        'unit': unit,
+    }
+    return result
+
+
+def run_scenario(scenario, directory, repeat=3):
+    field_options = {k: scenario[k] for k in FIELD_OPTIONS}
+    results = {}
+
+    frame, _ = star_field(**field_options)
+    path = write_frame(os.path.join(directory, 'frame.png'), frame)
+    megapixels = scenario['width'] * scenario['height'] / 1e6
+
+    image = Image(image_file=path, meta={'focus': 0})
+    record(results, 'decode', lambda: decode(path), megapixels, 'MP/s', repeat)
+    measured_image = MeasuredImage(image)
+
+    for detector in scenario['detectors']:
+        measured_image.detector = detector
+        blobs = record(
+            results, f'detect[{detector}]',
+            lambda: detect_stars(measured_image.image_arr, detector),
+            len, 'stars/s', repeat,
+        )
+        record(
+            results, f'fit[{detector}]',
+            lambda: StarArea.fit_all(measured_image.image_arr, blobs),
+            len, 'stars/s', repeat,
+        )
+        record(results, f'find_stars[{detector}]', measured_image.find_stars, len, 'stars/s', repeat)
+
+    steps = scenario['sweep_steps']
+    if steps:
+        focus_points = list(range(0, steps * 10, 10))
+        detector = scenario['detectors'][-1]
+        measured_images = []
+        for focus, frame_path in focus_sweep(directory, focus_points, best_focus=focus_points[steps // 2],
+                                             seeing=scenario['seeing'],
+                                             **{k: v for k, v in field_options.items() if k != 'seeing'}):
+            mi = MeasuredImage(Image(image_file=frame_path, meta={'focus': focus}), detector=detector)
+            mi.measure()
+            measured_images.append(mi)
+
+        # a fresh MeasuredStars per call, tracks are cached once built
+        fwhms, _ = record(
+            results, 'to_fwhm_list',
+            lambda: Autofocus.MeasuredStars.from_measured_images(measured_images).to_fwhm_list(max_stars=None),
+            sum(len(mi.catalog) for mi in measured_images), 'stars/s', repeat,
+        )
+        record(
+            results, 'v_shape_linear_fit',
+            lambda: alg.v_shape_linear_fit(fwhms),
+            sum(1 for row in fwhms for v in row[1:] if v is not None), 'values/s', repeat,
+        )
+
+    return results
+
+
+def run(scenarios=None, repeat=3):
+    names = scenarios or list(SCENARIOS)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            results[name] = run_scenario(SCENARIOS[name], os.path.join(directory, name), repeat=repeat)
+    return results
+
+
+def compare(results, baseline, time_tolerance=0.5, memory_tolerance=0.2, min_seconds=0.005, min_mb=1.0):
+    """Returns a list of regression descriptions of `results` against `baseline`.
+    `min_seconds` and `min_mb` are absolute slack so that tiny stages don't flap."""
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, current in stages.items():
+            reference = baseline.get(scenario, {}).get(stage)
+            if reference is None:
+                continue
+            if current['seconds'] > reference['seconds'] * (1 + time_tolerance) + min_seconds:
+                regressions.append(
+                    f"{scenario}/{stage}: {current['seconds']:.4f}s vs baseline {reference['seconds']:.4f}s"
+                )
+            if current['peak_mb'] > reference['peak_mb'] * (1 + memory_tolerance) + min_mb:
+                regressions.append(
+                    f"{scenario}/{stage}: {current['peak_mb']:.1f}MB vs baseline {reference['peak_mb']:.1f}MB"
+                )
+    return regressions
+
+
+def read_baseline(path=BASELINE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_baseline(results, path=BASELINE_FILE):
+    with open(path, 'w') as f:
+        f.write(json.dumps(results, indent=2, sort_keys=True))
+
+
+def print_results(results):
+    for scenario, stages in results.items():
+        print(f'Scenario: {scenario}')
+        for stage, r in stages.items():
+            throughput = '{:.1f} {}'.format(r['throughput'], r['unit']) if r['throughput'] else '-'
+            print(f"  - {stage:<28}\t{r['seconds']:.4f}s\t{r['peak_mb']:.1f}MB\t{throughput}")
+
+
+class Bench:
+    def run(self, *scenarios, repeat=3, update_baseline=False, time_tolerance=0.5, memory_tolerance=0.2):
+        results = run(list(scenarios) or None, repeat=int(repeat))
+        print_results(results)
+
+        if update_baseline:
+            baseline = read_baseline()
+            baseline.update(results)
+            write_baseline(baseline)
+            print(f'Baseline written to {BASELINE_FILE}')
+            return
+
+        regressions = compare(results, read_baseline(), float(time_tolerance), float(memory_tolerance))
+        if regressions:
+            print('Regressions:')
+            for r in regressions:
+                print(f'  - {r}')
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(Bench)
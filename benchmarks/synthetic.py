@@ -0,0 +1,46 @@
+import os
+import numpy as np
+from skimage import io
+
+
+def star_field(width=1500, height=1000, star_count=50, seeing=3.0, noise=0.01, sky=0.05, seed=0, margin=40):
+    """Returns a grayscale float frame (height x width, values 0..1) with gaussian stars
+    and a list of (x, y, amplitude) of rendered stars in array coordinates"""
+    rng = np.random.default_rng(seed)
+    frame = np.full((height, width), sky, dtype=np.float64)
+    frame += rng.normal(0, noise, frame.shape)
+
+    stars = [
+        (rng.uniform(margin, height - margin), rng.uniform(margin, width - margin), rng.uniform(0.3, 0.9))
+        for _ in range(star_count)
+    ]
+
+    half = int(np.ceil(seeing * 5))
+    for x, y, amplitude in stars:
+        x0, x1 = max(int(x) - half, 0), min(int(x) + half + 1, height)
+        y0, y1 = max(int(y) - half, 0), min(int(y) + half + 1, width)
+        X, Y = np.mgrid[x0:x1, y0:y1]
+        frame[x0:x1, y0:y1] += amplitude * np.exp(-((X - x) ** 2 + (Y - y) ** 2) / (2 * seeing ** 2))
+
+    return np.clip(frame, 0, 1), stars
+
+
+def write_frame(path, frame):
+    """Writes a grayscale frame as an 8-bit RGB image, the way camera previews arrive"""
+    rgb = np.repeat((frame * 255).astype(np.uint8)[..., np.newaxis], 3, axis=2)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    io.imsave(path, rgb, check_contrast=False)
+    return path
+
+
+def focus_sweep(directory, focus_points, best_focus, seeing=3.0, seeing_slope=0.05, **kwargs):
+    """Writes one star field per focus point, blurred proportionally to the distance from
+    `best_focus`. Returns a list of (focus, path). Star positions are shared between frames."""
+    result = []
+    for focus in focus_points:
+        frame, _ = star_field(seeing=seeing + seeing_slope * abs(focus - best_focus), **kwargs)
+        path = write_frame(os.path.join(directory, f'focus-{focus}.png'), frame)
+        result.append((focus, path))
+    return result
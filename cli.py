@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 import fire
 import logging
+from contextlib import nullcontext
 
-from core.client import Connector
-from core.autofocus import Autofocus
+from core.daemon import Daemon, DaemonClient, run_local
+from core.rigs import Rig, RigScheduler
+from core import instrument
 
 
 class Defaults:
@@ -18,6 +20,15 @@ defaults = Defaults()
 logger = logging.getLogger(__name__)
 
 
+def run_job(job, connection, daemon=False, trace=None, **kwargs):
+    if daemon:
+        if trace:
+            logger.warning('--trace only applies to local runs and is ignored with --daemon')
+        return DaemonClient().submit(job, connection, **kwargs)
+    with instrument.recording(trace) if trace else nullcontext():
+        return run_local(job, connection, **kwargs)
+
+
 class Cli:
     def autofocus(
         self,
@@ -31,12 +42,48 @@ class Cli:
         max=4100,
         steps=10,
         max_stars=5,
+        max_in_flight=2,
+        detector='blob_log',
+        roi=None,
+        roi_size=512,
+        reduce=1,
+        cache=True,
+        executor='threads',
+        max_workers=4,
+        mode='linear',
+        fit_model='linear',
+        fit_loss='linear',
+        history=True,
+        backlash=0,
+        focus_direction=1,
+        focus_tolerance=0.1,
+        daemon=False,
+        trace=None,
     ):
-        conn = Connector(ip, int(port), camera_name=camera_name, focuser_name=focuser_name, phd2_name=phd2_name)
-        conn.connect()
-
-        af = Autofocus(conn)
-        af.autofocus(int(time), int(min), int(max), int(steps), int(max_stars))
+        connection = dict(
+            ip=ip, port=int(port), camera_name=camera_name, focuser_name=focuser_name, phd2_name=phd2_name,
+            backlash=int(backlash), focus_direction=int(focus_direction), focus_tolerance=float(focus_tolerance),
+        )
+        return run_job(
+            'autofocus', connection, daemon, trace,
+            time=int(time),
+            min_focus=int(min),
+            max_focus=int(max),
+            steps=int(steps),
+            max_stars=int(max_stars),
+            max_in_flight=int(max_in_flight),
+            detector=detector,
+            roi=roi if roi in (None, 'stars') else float(roi),
+            roi_size=int(roi_size),
+            reduce=int(reduce),
+            cache=bool(cache),
+            executor=executor,
+            max_workers=int(max_workers),
+            mode=mode,
+            fit_model=fit_model,
+            fit_loss=fit_loss,
+            history=bool(history),
+        )
 
     def expose(
         self,
@@ -46,11 +93,12 @@ class Cli:
         focuser_name=defaults.focuser_name,
         phd2_name=defaults.phd2_name,
         time=60,
-        preifx="light"
+        preifx="light",
+        daemon=False,
+        trace=None,
     ):
-        conn = Connector(ip, port, camera_name=camera_name, focuser_name=focuser_name, phd2_name=phd2_name)
-        conn.connect()
-        conn.expose_only(time=time, prefix=preifx)
+        connection = dict(ip=ip, port=int(port), camera_name=camera_name, focuser_name=focuser_name, phd2_name=phd2_name)
+        return run_job('expose', connection, daemon, trace, time=time, prefix=preifx)
 
     def timelapse(
         self,
@@ -62,15 +110,94 @@ class Cli:
         phd2_name=defaults.phd2_name,
         time=60,
         dither=5,
+        dither_every=1,
+        max_pending=2,
+        prefix="light",
+        daemon=False,
+        trace=None,
+    ):
+        connection = dict(ip=ip, port=int(port), camera_name=camera_name, focuser_name=focuser_name, phd2_name=phd2_name)
+        report = run_job(
+            'timelapse', connection, daemon, trace,
+            count=int(count),
+            time=time,
+            dither=dither,
+            dither_every=int(dither_every),
+            max_pending=int(max_pending),
+            prefix=prefix,
+        )
+        return {k: v for k, v in report.items() if k != 'frames'}
+
+    def rigs(
+        self,
+        count=0,
+        names=None,
+        autofocus=True,
+        af_time=2,
+        min=3800,
+        max=4100,
+        steps=10,
+        mode='linear',
+        time=60,
+        dither=5,
+        dither_every=1,
         prefix="light",
+        executor='threads',
+        max_workers=4,
+        trace=None,
     ):
-        conn = Connector(ip, port, camera_name=camera_name, focuser_name=focuser_name, phd2_name=phd2_name)
-        conn.connect()
+        """Autofocus and then `count` timelapse frames on every rig of settings.RIGS (or `names`)
+        at once; per-rig 'autofocus'/'timelapse' settings override these parameters"""
+        if isinstance(names, str):
+            names = names.split(',')
+        rigs = Rig.from_settings(list(names) if names else None)
+
+        plan = []
+        for rig in rigs:
+            if autofocus:
+                plan.append((rig.name, 'autofocus', dict(
+                    time=int(af_time),
+                    min_focus=int(min),
+                    max_focus=int(max),
+                    steps=int(steps),
+                    mode=mode,
+                )))
+            if int(count):
+                plan.append((rig.name, 'timelapse', dict(
+                    count=int(count),
+                    time=time,
+                    dither=dither,
+                    dither_every=int(dither_every),
+                    prefix=prefix,
+                )))
+
+        with instrument.recording(trace) if trace else nullcontext():
+            with RigScheduler(rigs, executor=executor, max_workers=int(max_workers)) as scheduler:
+                results = scheduler.run(plan)
+
+        summary = {}
+        for (name, job, _), result in zip(plan, results):
+            if isinstance(result, Exception):
+                result = f'failed: {result}'
+            elif isinstance(result, dict):
+                result = {k: v for k, v in result.items() if k != 'frames'}
+            summary[f'{name}.{job}'] = result
+        return summary
+
+    def trace_summary(self, *paths):
+        """Aggregated span timings of runs recorded with --trace=<file.json|file.csv>"""
+        print(instrument.format_summary(instrument.aggregate(paths)))
 
-        for i in range(count):
-            n = i+1
-            logger.info(f"Exposure #{n} of {count}")
-            conn.expose_only(time=time, dither=dither, prefix=prefix)
+    def daemon(self, action='start'):
+        """start: serve in the foreground; status: list connected rigs; stop: shut the daemon down"""
+        if action == 'start':
+            Daemon().serve_forever()
+        elif action == 'status':
+            return DaemonClient().status()
+        elif action == 'stop':
+            DaemonClient().shutdown()
+        else:
+            raise ValueError(f'Unknown daemon action: {action}')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from concurrent import futures
+from functools import partial
+
+from core.client import Connector
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncConnector:
+    """asyncio front end of a Connector.
+
+    The INDI client only offers blocking waits, so every device operation runs
+    on the connector's own small thread pool while the event loop stays free.
+    A single loop can therefore drive focuser moves, exposures, dithering and
+    downloads of several rigs at once, e.g.:
+
+        await asyncio.gather(rig_a.expose(4000, 2), rig_b.expose_only(60, dither=5))
+    """
+
+    def __init__(self, connector=None, max_workers=4, **connector_kwargs):
+        self.connector = connector if connector is not None else Connector(**connector_kwargs)
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    async def connect(self):
+        await self._run(self.connector.connect)
+
+    async def move_focuser(self, focus):
+        await self._run(self.connector.move_focuser, focus)
+
+    async def dither(self, pixels):
+        await self._run(self.connector.dither, pixels)
+
+    async def wait_downloaded(self, image):
+        if image.download_future is not None:
+            await asyncio.wrap_future(image.download_future)
+        elif not image.is_downloaded():
+            await self._run(image.fetch, self.connector.download_manager)
+        return image
+
+    async def expose(self, focus, time, download_images=True, wait_download=True, prefix=None):
+        img = await self._run(
+            self.connector.expose,
+            focus, time,
+            download_images=download_images,
+            download_images_async=True,
+            prefix=prefix,
+        )
+        if download_images and wait_download:
+            await self.wait_downloaded(img)
+        return img
+
+    async def expose_only(self, time, dither=0, wait_download=False, prefix=None):
+        img, raw_img = await self._run(self.connector.expose_only, time, dither=dither, prefix=prefix)
+        if wait_download:
+            await asyncio.gather(self.wait_downloaded(img), self.wait_downloaded(raw_img))
+        return img, raw_img
+
+    async def close(self, timeout=None):
+        await self._run(self.connector.close, timeout)
+        self._executor.shutdown(wait=False)
@@ -1,80 +1,443 @@
 import numpy as np
-from scipy import optimize
+from functools import lru_cache
+from scipy import optimize, sparse
+
+
+GAUSSIAN_FWHM_FACTOR = 2 * np.sqrt(2 * np.log(2))
+
+PROFILES = ('gaussian', 'elliptical', 'moffat',)
 
 
 def two_dimensional_gaussian_fit(data):
-    def gaussian(height, center_x, center_y, width):
-        """Returns a gaussian function with the given parameters"""
-        return lambda x, y: height * np.exp(-(((center_x - x) / width) ** 2 + ((center_y - y) / width) ** 2) / 2)
+    """Returns (height, x, y, width)
+    the gaussian parameters of a 2D distribution found by a fit"""
+    return fit_star_profiles(data[np.newaxis], profile='gaussian')[0]
 
-    def moments(data):
-        """Returns (height, x, y, width)
-        the gaussian parameters of a 2D distribution by calculating its
-        moments """
-        total = data.sum()
-        X, Y = np.indices(data.shape)
-        x = (X * data).sum() / total
-        y = (Y * data).sum() / total
-        col = data[:, int(y)]
-        width = np.sqrt(np.abs((np.arange(col.size) - y) ** 2 * col).sum() / col.sum())
-        height = data.max()
-        return height, x, y, width
 
-    def fitgaussian(data):
-        """Returns (height, x, y, width)
-        the gaussian parameters of a 2D distribution found by a fit"""
-        params = moments(data)
+@lru_cache(maxsize=32)
+def coordinate_grid(shape):
+    """Returns flattened (X, Y) pixel coordinates for a cutout of given shape"""
+    X, Y = np.indices(shape, dtype=float)
+    X = X.ravel()
+    Y = Y.ravel()
+    X.flags.writeable = False
+    Y.flags.writeable = False
+    return X, Y
 
-        def errorfunction(p):
-            return np.ravel(gaussian(*p)(*np.indices(data.shape)) - data)
 
-        p, success = optimize.leastsq(errorfunction, params)
-        return p
+def _moments(data, X, Y):
+    """Returns (height, x, y, width) initial guesses for each cutout of a batch"""
+    n, rows, cols = data.shape
+    flat = data.reshape(n, -1)
+    total = flat.sum(axis=1)
+    x = (flat * X).sum(axis=1) / total
+    y = (flat * Y).sum(axis=1) / total
+    col_idx = np.clip(np.nan_to_num(y), 0, cols - 1).astype(int)
+    col = data[np.arange(n), :, col_idx]
+    width = np.sqrt(np.abs(((np.arange(rows) - y[:, np.newaxis]) ** 2 * col).sum(axis=1)) / col.sum(axis=1))
+    height = flat.max(axis=1)
+    return height, x, y, width
 
-    return fitgaussian(data)
 
+def _gaussian(p, X, Y):
+    h, cx, cy, w = (p[:, i:i + 1] for i in range(4))
+    dx = X - cx
+    dy = Y - cy
+    r2 = dx ** 2 + dy ** 2
+    e = np.exp(-r2 / (2 * w ** 2))
+    f = h * e
+    jac = np.stack([
+        e,
+        f * dx / w ** 2,
+        f * dy / w ** 2,
+        f * r2 / w ** 3,
+    ], axis=1)
+    return f, jac
 
-def v_shape_linear_fit(data):
-    def v_shape(slope_a, slope_b, center_x, center_y):
-        def f(x):
-            if x < center_x:
-                return slope_a * (x - center_x) + center_y
-            else:
-                return slope_b * (x - center_x) + center_y
 
-        return f
+def _elliptical(p, X, Y):
+    h, cx, cy, a, b, c = (p[:, i:i + 1] for i in range(6))
+    dx = X - cx
+    dy = Y - cy
+    e = np.exp(-(a * dx ** 2 + 2 * b * dx * dy + c * dy ** 2) / 2)
+    f = h * e
+    jac = np.stack([
+        e,
+        f * (a * dx + b * dy),
+        f * (b * dx + c * dy),
+        -f * dx ** 2 / 2,
+        -f * dx * dy,
+        -f * dy ** 2 / 2,
+    ], axis=1)
+    return f, jac
+
+
+def _moffat(p, X, Y):
+    h, cx, cy, alpha, beta = (p[:, i:i + 1] for i in range(5))
+    dx = X - cx
+    dy = Y - cy
+    r2 = dx ** 2 + dy ** 2
+    u = 1 + r2 / alpha ** 2
+    e = u ** -beta
+    f = h * e
+    g = 2 * f * beta / (u * alpha ** 2)
+    jac = np.stack([
+        e,
+        g * dx,
+        g * dy,
+        g * r2 / alpha,
+        -f * np.log(u),
+    ], axis=1)
+    return f, jac
+
+
+_MODELS = {
+    'gaussian': _gaussian,
+    'elliptical': _elliptical,
+    'moffat': _moffat,
+}
+
+
+def _initial_params(data, X, Y, profile, background):
+    height, x, y, width = _moments(data, X, Y)
+    if background:
+        bg = data.reshape(len(data), -1).min(axis=1)
+        height = height - bg
+
+    if profile == 'gaussian':
+        params = [height, x, y, width]
+    elif profile == 'elliptical':
+        inv_w2 = 1 / width ** 2
+        params = [height, x, y, inv_w2, np.zeros_like(width), inv_w2]
+    elif profile == 'moffat':
+        beta = np.full_like(width, 2.5)
+        alpha = width * GAUSSIAN_FWHM_FACTOR / (2 * np.sqrt(2 ** (1 / beta) - 1))
+        params = [height, x, y, alpha, beta]
+    else:
+        raise ValueError(f'Unknown star profile: {profile}')
+
+    if background:
+        params.append(bg)
+
+    return np.stack(params, axis=-1)
+
+
+def _evaluate(model, p, X, Y, background):
+    if not background:
+        return model(p, X, Y)
+    f, jac = model(p[:, :-1], X, Y)
+    f = f + p[:, -1:]
+    jac = np.concatenate([jac, np.ones((len(jac), 1, jac.shape[2]))], axis=1)
+    return f, jac
+
+
+def _levenberg_marquardt(residuals, p, max_iter=100, ftol=1.49e-8, xtol=1.49e-8):
+    """Minimizes sum of squared residuals for a batch of independent problems at once.
+
+    `residuals(p, idx)` returns residuals (n, m) and their jacobian (n, k, m)
+    for parameter rows `p` belonging to problems `idx`."""
+    n, k = p.shape
+    idx = np.arange(n)
+    r, jac = residuals(p, idx)
+    cost = (r ** 2).sum(axis=1)
+    lam = np.full(n, 1e-3)
+    active = np.isfinite(cost)
+    eye = np.eye(k)
+
+    for _ in range(max_iter):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+
+        J = jac[idx]
+        JtJ = J @ J.transpose(0, 2, 1)
+        g = (J @ r[idx][..., np.newaxis])[..., 0]
+        diag = np.diagonal(JtJ, axis1=1, axis2=2)
+        A = JtJ + lam[idx, np.newaxis, np.newaxis] * eye * (diag[:, np.newaxis, :] + 1e-12)
+        try:
+            delta = np.linalg.solve(A, -g[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            delta = -(np.linalg.pinv(A) @ g[..., np.newaxis])[..., 0]
+
+        new_p = p[idx] + delta
+        new_r, new_jac = residuals(new_p, idx)
+        new_cost = (new_r ** 2).sum(axis=1)
+
+        better = np.isfinite(new_cost) & (new_cost <= cost[idx])
+        accepted = idx[better]
+        step = np.linalg.norm(delta, axis=1)
+        converged = better & (
+            (cost[idx] - new_cost <= ftol * cost[idx])
+            | (step <= xtol * (np.linalg.norm(new_p, axis=1) + xtol))
+        )
+
+        p[accepted] = new_p[better]
+        r[accepted] = new_r[better]
+        jac[accepted] = new_jac[better]
+        cost[accepted] = new_cost[better]
+        lam[accepted] /= 10
+        lam[idx[~better]] *= 10
+
+        active[idx[converged]] = False
+        active[lam > 1e12] = False
+
+    return p
+
+
+def fit_star_profiles(cutouts, profile='gaussian', background=False, max_iter=100):
+    """Fits a star profile to every cutout of a batch of equally-sized cutouts.
+
+    Returns an (n, k) array of parameters, one row per cutout:
+     - gaussian: (height, x, y, width)
+     - elliptical: (height, x, y, a, b, c) with exponent -(a*dx^2 + 2*b*dx*dy + c*dy^2)/2
+     - moffat: (height, x, y, alpha, beta)
+    followed by the background level when `background` is set."""
+    if profile not in _MODELS:
+        raise ValueError(f'Unknown star profile: {profile}')
+
+    data = np.asarray(cutouts, dtype=float)
+    X, Y = coordinate_grid(data.shape[1:])
+    flat = data.reshape(len(data), -1)
+    model = _MODELS[profile]
+
+    def residuals(p, idx):
+        f, jac = _evaluate(model, p, X, Y, background)
+        return f - flat[idx], jac
+
+    params = _initial_params(data, X, Y, profile, background)
+    return _levenberg_marquardt(residuals, params, max_iter=max_iter)
+
+
+def profile_width(params, profile='gaussian'):
+    """Returns gaussian-equivalent width (sigma) of fitted profiles"""
+    params = np.atleast_2d(params)
+    if profile == 'gaussian':
+        return np.abs(params[:, 3])
+    if profile == 'elliptical':
+        a, b, c = params[:, 3], params[:, 4], params[:, 5]
+        return np.abs(a * c - b ** 2) ** -0.25
+    if profile == 'moffat':
+        alpha, beta = params[:, 3], params[:, 4]
+        return 2 * np.abs(alpha) * np.sqrt(2 ** (1 / beta) - 1) / GAUSSIAN_FWHM_FACTOR
+    raise ValueError(f'Unknown star profile: {profile}')
+
+
+def profile_flux(params, profile='gaussian'):
+    """Returns total flux (volume above background) of fitted profiles"""
+    params = np.atleast_2d(params)
+    height = params[:, 0]
+    if profile == 'gaussian':
+        return 2 * np.pi * height * params[:, 3] ** 2
+    if profile == 'elliptical':
+        a, b, c = params[:, 3], params[:, 4], params[:, 5]
+        return 2 * np.pi * height / np.sqrt(np.abs(a * c - b ** 2))
+    if profile == 'moffat':
+        alpha, beta = params[:, 3], params[:, 4]
+        return np.pi * height * alpha ** 2 / (beta - 1)
+    raise ValueError(f'Unknown star profile: {profile}')
+
+
+V_CURVE_MODELS = ('linear', 'hyperbolic',)
+
+V_CURVE_LOSSES = ('linear', 'huber', 'soft_l1',)
 
-    def init(data):
-        filtered_data = list(filter(lambda el: el[1] is not None, data))
-        center = min(filtered_data, key=lambda el: el[1])  # by value
 
-        left = min(filtered_data, key=lambda el: el[0])  # by position
-        right = max(filtered_data, key=lambda el: el[0])  # by position
+def fwhm_matrix(data):
+    """Converts [focus, fwhm_1, ..., fwhm_m] rows with None for missing values
+    into (focus vector, focus x stars matrix with NaN for missing values)"""
+    focus = np.array([row[0] for row in data], dtype=float)
+    values = np.array(
+        [[np.nan if v is None else v for v in row[1:]] for row in data],
+        dtype=float,
+    ).reshape(len(data), -1)
+    return focus, values
 
-        slope_a = (center[1] - left[1]) / (center[0] - left[0])
-        slope_b = (right[1] - center[1]) / (right[0] - center[0])
 
-        return [center[0], *center[1:], slope_a, slope_b]
+def _v_jacobian(param_count, star, d_center, d_level, d_slope_a, d_slope_b):
+    """Sparse Jacobian: every residual depends on the center, both slopes and its own star's level"""
+    n = len(star)
+    rows = np.repeat(np.arange(n), 4)
+    cols = np.stack([np.zeros(n, dtype=int), 1 + star, np.full(n, param_count - 2), np.full(n, param_count - 1)], axis=1)
+    data = np.stack(np.broadcast_arrays(d_center, d_level, d_slope_a, d_slope_b), axis=1)
+    return sparse.csr_matrix((data.ravel(), (rows, cols.ravel())), shape=(n, param_count))
 
-    def fit(data):
-        params = init(data)
 
-        def errorfunction(p):
-            slope_a = p[-2]
-            slope_b = p[-1]
-            center_x = p[0]
+def _v_linear(p, x, star):
+    """V-curve built of two lines meeting at (center, level of the star).
+    Returns model values and the Jacobian over p = [center, levels..., slope_a, slope_b]"""
+    center, slope_a, slope_b = p[0], p[-2], p[-1]
+    d = x - center
+    left = d < 0
+    slope = np.where(left, slope_a, slope_b)
+    value = slope * d + p[1:-2][star]
 
-            return np.ravel([
-                [
-                    0 if el[i] is None else
-                    v_shape(slope_a, slope_b, center_x, p[i])(el[0]) - el[i]
-                    for el in data
-                ]
-                for i in range(1, len(p)-2)
-            ])
+    return value, _v_jacobian(len(p), star, -slope, 1, np.where(left, d, 0), np.where(left, 0, d))
 
-        p, success = optimize.leastsq(errorfunction, params)
 
-        return p
+def _v_hyperbolic(p, x, star):
+    """Hyperbola sqrt(level^2 + (slope * (x - center))^2) with separate asymptotic
+    slopes on both sides; same parameter layout as the linear model"""
+    center, slope_a, slope_b = p[0], p[-2], p[-1]
+    level = p[1:-2][star]
+    d = x - center
+    left = d < 0
+    slope = np.where(left, slope_a, slope_b)
+    value = np.sqrt(level ** 2 + (slope * d) ** 2)
+    safe = np.where(value > 0, value, 1)
 
-    return fit(data)
+    return value, _v_jacobian(
+        len(p), star,
+        -slope ** 2 * d / safe,
+        level / safe,
+        np.where(left, slope_a * d ** 2 / safe, 0),
+        np.where(left, 0, slope_b * d ** 2 / safe),
+    )
+
+
+_V_CURVES = {
+    'linear': _v_linear,
+    'hyperbolic': _v_hyperbolic,
+}
+
+
+class VCurveFit:
+    """Result of fit_v_curve.
+
+    `p` is laid out as [center, levels..., slope_a, slope_b] (the format
+    returned by v_shape_linear_fit) and `stderr` holds matching standard
+    errors estimated from the Jacobian at the solution."""
+
+    def __init__(self, p, covariance, model, loss, cost, success):
+        self.p = p
+        self.covariance = covariance
+        self.model = model
+        self.loss = loss
+        self.cost = cost
+        self.success = success
+
+    @property
+    def center(self):
+        return self.p[0]
+
+    @property
+    def levels(self):
+        return self.p[1:-2]
+
+    @property
+    def slopes(self):
+        return self.p[-2], self.p[-1]
+
+    @property
+    def stderr(self):
+        return np.sqrt(np.abs(np.diag(self.covariance)))
+
+    @property
+    def center_stderr(self):
+        return self.stderr[0]
+
+    def predict(self, focus):
+        """Returns the modelled FWHM matrix (focus x stars)"""
+        focus = np.asarray(focus, dtype=float)
+        star_count = len(self.levels)
+        x = np.repeat(focus, star_count)
+        star = np.tile(np.arange(star_count), len(focus))
+        value, _ = _V_CURVES[self.model](self.p, x, star)
+        return value.reshape(len(focus), star_count)
+
+
+def _star_minimum(values):
+    minimum = np.min(np.where(np.isnan(values), np.inf, values), axis=0)
+    return np.where(np.isfinite(minimum), minimum, 0)
+
+
+def _v_curve_init(focus, values):
+    level = np.full(len(focus), np.inf)
+    has_values = ~np.isnan(values).all(axis=1)
+    # median over stars, so a single bad measurement cannot move the start point to an edge
+    level[has_values] = np.nanmedian(values[has_values], axis=1)
+    rows = np.flatnonzero(has_values)
+    center = np.argmin(level)
+    left, right = rows.min(), rows.max()
+
+    slope_a = (level[center] - level[left]) / (focus[center] - focus[left]) if center != left else -1.0
+    slope_b = (level[right] - level[center]) / (focus[right] - focus[center]) if center != right else 1.0
+
+    levels = np.where(np.isnan(values[center]), _star_minimum(values), values[center])
+
+    return np.array([focus[center], *levels, slope_a, slope_b])
+
+
+def fit_v_curve(data, model='linear', loss='linear', f_scale=None):
+    """Fits a V-curve shared by all stars to a focus x stars FWHM table.
+
+    `data` is either [focus, fwhm_1, ..., fwhm_m] rows with None for missing
+    values or a (focus vector, matrix with NaN) pair from fwhm_matrix. Every
+    star gets its own level while the center and both slopes are shared.
+    `loss` is passed to scipy's least_squares; robust losses ('huber',
+    'soft_l1') use `f_scale` (default: 10% of the median FWHM) as the inlier
+    residual size."""
+    if model not in _V_CURVES:
+        raise ValueError(f'Unknown V-curve model: {model}')
+    if loss not in V_CURVE_LOSSES:
+        raise ValueError(f'Unknown V-curve loss: {loss}')
+
+    focus, values = data if isinstance(data, tuple) else fwhm_matrix(data)
+    mask = ~np.isnan(values)
+    rows, star = np.nonzero(mask)
+    x = focus[rows]
+    y = values[mask]
+    evaluate = _V_CURVES[model]
+
+    if f_scale is None:
+        f_scale = 0.1 * np.median(y)
+
+    def residuals(p):
+        return evaluate(p, x, star)[0] - y
+
+    def jacobian(p):
+        return evaluate(p, x, star)[1]
+
+    p0 = _v_curve_init(focus, values)
+    if model == 'hyperbolic':
+        p0[1:-2] = _star_minimum(values)
+
+    result = optimize.least_squares(residuals, p0, jac=jacobian, loss=loss, f_scale=f_scale, method='trf')
+
+    dof = max(len(y) - len(p0), 1)
+    jac = sparse.csr_matrix(result.jac)
+    covariance = np.linalg.pinv((jac.T @ jac).toarray()) * (2 * result.cost / dof)
+
+    return VCurveFit(result.x, covariance, model, loss, result.cost, result.success)
+
+
+def v_curve_center(x1, f1, x2, f2, slope_a, slope_b, model='linear'):
+    """Estimates the V-curve center from FWHMs f1, f2 measured at x1 < x2 on
+    opposite sides of the minimum, given slopes known from an earlier fit.
+    Works on arrays of per-star measurements; returns NaN where the two
+    points do not bracket a center."""
+    x1, f1, x2, f2 = (np.asarray(v, dtype=float) for v in (x1, f1, x2, f2))
+
+    if model == 'linear':
+        center = (slope_a * x1 - slope_b * x2 - f1 + f2) / (slope_a - slope_b)
+    elif model == 'hyperbolic':
+        # f1^2 - a^2 (x1 - c)^2 = f2^2 - b^2 (x2 - c)^2 = level^2, quadratic in c
+        qa = slope_a ** 2 - slope_b ** 2
+        qb = -2 * (slope_a ** 2 * x1 - slope_b ** 2 * x2)
+        qc = slope_a ** 2 * x1 ** 2 - slope_b ** 2 * x2 ** 2 - f1 ** 2 + f2 ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if abs(qa) < 1e-12:
+                center = -qc / qb
+            else:
+                root = np.sqrt(qb ** 2 - 4 * qa * qc)
+                c1 = (-qb - root) / (2 * qa)
+                c2 = (-qb + root) / (2 * qa)
+                center = np.where((c1 >= x1) & (c1 <= x2), c1, c2)
+    else:
+        raise ValueError(f'Unknown V-curve model: {model}')
+
+    return np.where((center >= x1) & (center <= x2), center, np.nan)
+
+
+def v_shape_linear_fit(data):
+    """Returns [center, levels..., slope_a, slope_b] of a linear V-curve fit"""
+    return fit_v_curve(data).p
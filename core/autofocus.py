@@ -1,93 +1,447 @@
-from concurrent import futures
-
 from core.value_object import MeasuredImage
+from core.pipeline import SweepPipeline
+from core.executor import MeasurementExecutors
+from core.catalog import StarCatalog, STAR_DTYPE
 from core import alg
+from core.history import FocusPredictor
+from core.focuser import FocuserMotion
+from core.decode import star_region
+from core import instrument
+from scipy.spatial import cKDTree
+import numpy as np
+import logging
 import math
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
 
 
 class Autofocus:
-    def __init__(self, connector):
-        self.connector = connector
+    """`roi` is a Region or central fraction measured on every frame, or 'stars'
+    to measure only a `roi_size` square around the stars of the first sweep
+    frame (see expose_frame)."""
 
-    def autofocus(self, time, min_focus, max_focus, steps, max_stars=5):
+    def __init__(self, connector, detector='blob_log', keep_frames=False, roi=None, reduce=1, cache=None,
+                 executor='threads', max_workers=4, fit_model='linear', fit_loss='linear', history=None,
+                 on_progress=None, executors=None, prefix='autofocus', roi_size=512, roi_stars=3):
+        self.connector = connector
+        # sweeps follow the connector's approach direction so the focuser never reverses mid-sweep
+        self.motion = getattr(connector, 'motion', None) or FocuserMotion()
+        self.executors = executors
+        self.prefix = prefix
+        self.on_progress = on_progress
+        self.history = history
+        self.predictor = FocusPredictor(history) if history is not None else None
+        self.fit_model = fit_model
+        self.fit_loss = fit_loss
+        self.executor = executor
+        self.max_workers = max_workers
+        self.detector = detector
+        self.keep_frames = keep_frames
+        self.roi = roi
+        self.roi_size = roi_size
+        self.roi_stars = roi_stars
+        self.region = None
+        self._full_frames = []
+        self.reduce = reduce
+        self.cache = cache
+
+    @property
+    def measure_options(self):
+        return {
+            'detector': self.detector,
+            'roi': self.region if self.roi == 'stars' else self.roi,
+            'reduce': self.reduce,
+            'cache': self.cache,
+        }
+
+    SEARCH_MODES = ('linear', 'adaptive', 'incremental',)
+
+    @contextmanager
+    def measurement_executors(self):
+        """Executors shared by a scheduler if given, otherwise a private pair for this run"""
+        if self.executors is not None:
+            yield self.executors
+        else:
+            with MeasurementExecutors(self.executor, self.max_workers) as e:
+                yield e
+
+    @instrument.timed('vfit')
+    def fit(self, fwhms):
+        return alg.fit_v_curve(fwhms, model=self.fit_model, loss=self.fit_loss)
+
+    @staticmethod
+    def focus_steps(min_focus, max_focus, steps):
         step = int((max_focus - min_focus) / steps)
 
         step_list = list(range(min_focus, max_focus, step))
-        if step_list[:-1] != max_focus:
-            step_list.append(max_focus)
+        if max_focus - step_list[-1] < step / 2:
+            # uneven division would leave a near duplicate of max_focus
+            step_list.pop()
+        step_list.append(max_focus)
+        return step_list
+
+    def sweep(self, executors, focus_points, time, max_in_flight=2):
+        """Exposes all `focus_points` in order and returns their MeasuredImages"""
+        pipeline = SweepPipeline(
+            executors.io,
+            max_in_flight=max_in_flight,
+            measure_options=self.measure_options,
+            keep_frames=self.keep_frames,
+            measure_executor=executors.measure,
+        )
+        for f in self.motion.order(focus_points):
+            self.expose_frame(pipeline, f, time)
+
+        return pipeline.results()
+
+    def expose_frame(self, pipeline, focus, time):
+        """Exposes one sweep frame and submits it to `pipeline`.
+
+        In 'stars' ROI mode frames are exposed and measured in full until one
+        holds enough stars to select the region. Those frames stay part of the
+        sweep, keeping only the stars inside the region, and every later
+        frame is cropped."""
+        image = self.connector.expose(focus=focus, time=time, prefix=self.prefix)
+        future = pipeline.submit(image, focus)
+        if self.roi == 'stars' and self.region is None:
+            self._full_frames.append(future.result())
+            if self.select_region(self._full_frames[-1]) is not None:
+                for measured_image in self._full_frames:
+                    measured_image.catalog = measured_image.catalog.within(self.region)
+                pipeline.measure_options = self.measure_options
+        return future
+
+    def linear_search(self, executors, time, min_focus, max_focus, steps, max_in_flight=2):
+        return self.sweep(executors, self.focus_steps(min_focus, max_focus, steps), time, max_in_flight)
+
+    def adaptive_search(self, executors, time, min_focus, max_focus, steps, max_stars=5, max_in_flight=2,
+                        coarse_steps=4, tolerance=None):
+        """Coarse sweep followed by V-curve refinement around the fitted minimum.
+
+        After the coarse pass every round fits the V-curve, reseeding star
+        tracks when a refinement frame became the sharpest, then exposes two
+        points at half the previous spacing on both sides of its center. The
+        search stops when the center moves by no more than `tolerance` between
+        rounds (by default 1/8 of the coarse spacing), when the spacing drops
+        below it, or when `steps + 1` exposures - the linear sweep budget - are
+        used up."""
+        coarse_steps = min(coarse_steps, steps)
+        spacing = (max_focus - min_focus) / coarse_steps
+        if tolerance is None:
+            tolerance = spacing / 8
+        budget = steps + 1
+
+        focus_points = self.focus_steps(min_focus, max_focus, coarse_steps)
+        measured_images = self.sweep(executors, focus_points, time, max_in_flight)
+        ms = Autofocus.MeasuredStars.from_measured_images(measured_images)
 
-        image_jsons = []
-        measured_images = []
-        with futures.ThreadPoolExecutor(max_workers=4) as e:
-            threads = []
-            for f in step_list:
-                image = self.connector.expose(focus=f, time=time, prefix="autofocus")
-                image_jsons.append(image.meta_file)
-                measured_image = MeasuredImage.from_image(image, measure=False)
-                measured_image.focus = f
-                measured_images.append(measured_image)
+        previous = None
+        seed_focus = None
+        while True:
+            # track stars from the sharpest frame so far, refinement frames usually move it
+            best_focus = ms.focus_with_best_avg_fwhm()
+            if best_focus != seed_focus:
+                ms.build_tracks()
+                seed_focus = best_focus
+
+            fwhms, _ = ms.to_fwhm_list(max_stars=max_stars)
+            center = self.fit(fwhms).center
+            logger.info(f'Adaptive search: {len(measured_images)} exposures, V-curve center {center:.1f}')
+
+            if previous is not None and abs(center - previous) <= tolerance:
+                break
+            spacing /= 2
+            if spacing < tolerance:
+                break
+
+            refine = sorted({
+                int(round(min(max(f, min_focus), max_focus)))
+                for f in (center - spacing, center + spacing)
+            } - set(ms.focus_points()))
+            refine = refine[:budget - len(measured_images)]
+            if not refine:
+                break
+
+            new_images = self.sweep(executors, refine, time, max_in_flight)
+            for measured_image in new_images:
+                ms.add_measured_image(measured_image)
+            measured_images.extend(new_images)
+            previous = center
+
+        return measured_images, ms
+
+    def select_region(self, measured_image):
+        """Picks the `roi_size` square holding the most stars of a full frame.
+        Later frames are cropped to it by the camera when the driver supports
+        subframes, and right after decoding otherwise. Returns None when too
+        few stars are found."""
+        region = star_region(measured_image.catalog, measured_image.shape, self.roi_size, self.roi_stars)
+        if region is None:
+            logger.warning(
+                f'Fewer than {self.roi_stars} stars in any {self.roi_size}px region at focus '
+                f'{measured_image.focus}, measuring the next frame in full'
+            )
+            return None
 
-                t = e.submit(measured_image.measure)
-                threads.append(t)
+        self.region = region
+        set_subframe = getattr(self.connector, 'set_subframe', None)
+        cropped = set_subframe is not None and set_subframe(region, measured_image.shape)
+        logger.info(f'Measuring {region} cropped {"by the camera" if cropped else "after decoding"}')
+        return region
+
+    def reset_region(self):
+        reset_subframe = getattr(self.connector, 'reset_subframe', None)
+        if self.region is not None and reset_subframe is not None:
+            reset_subframe()
+
+    @property
+    def rig(self):
+        """History key of the focuser: its INDI server address and device name"""
+        focuser = getattr(self.connector, 'focuser_name', None)
+        if focuser is None:
+            return None
+        return f'{getattr(self.connector, "ip", None)}:{getattr(self.connector, "port", None)}/{focuser}'
+
+    def read_temperature(self):
+        read = getattr(self.connector, 'temperature', None)
+        try:
+            return read() if read is not None else None
+        except Exception as e:
+            logger.warning(f'Could not read focuser temperature: {e}')
+            return None
 
-            futures.wait(threads)
+    def quick_check(self, executors, prediction, time, min_focus, max_focus, max_stars=5, max_in_flight=2):
+        """Exposes one point on each slope of the predicted V-curve and estimates the
+        center from the known slopes. Returns (focus, stderr, measured images, MeasuredStars)
+        or None when the estimate does not confirm the prediction."""
+        if not math.isfinite(prediction.bottom_width):
+            return None
+        offset = max(3 * prediction.uncertainty, prediction.bottom_width)
+        x1 = int(round(prediction.focus - offset))
+        x2 = int(round(prediction.focus + offset))
+        if x1 < min_focus or x2 > max_focus:
+            return None
 
+        measured_images = self.sweep(executors, [x1, x2], time, max_in_flight)
         ms = Autofocus.MeasuredStars.from_measured_images(measured_images)
+        if len(ms.focus_points()) != 2:
+            # no stars measured in one of the frames
+            return None
+        (_, *f1), (_, *f2) = ms.to_fwhm_list(max_stars=max_stars)[0]
+        both = [(a, b) for a, b in zip(f1, f2) if a is not None and b is not None]
+        if len(both) < 2:
+            return None
+
+        f1, f2 = np.array(both).T
+        centers = alg.v_curve_center(x1, f1, x2, f2, prediction.slope_a, prediction.slope_b, prediction.model)
+        centers = centers[~np.isnan(centers)]
+        if len(centers) < 2:
+            return None
+
+        center = float(np.median(centers))
+        stderr = 1.4826 * np.median(np.abs(centers - center)) / math.sqrt(len(centers))
+        logger.info(f'Quick check around {prediction}: center {center:.1f} +/- {stderr:.1f}')
+
+        if abs(center - prediction.focus) > offset / 2 or stderr > offset / 4:
+            return None
+        return center, max(stderr, 1.0), measured_images, ms
+
+    def incremental_search(self, executors, time, min_focus, max_focus, steps, max_stars=5, max_in_flight=2,
+                           min_side_points=3, slope_tolerance=0.15):
+        """Linear sweep that refits the V-curve as soon as each frame is measured.
+
+        A Progress is emitted for every fitted frame. The sweep stops early once
+        at least `min_side_points` focus points lie on each side of the center
+        and both slopes are known to within `slope_tolerance` (relative
+        standard error). Measurement lags exposure by up to `max_in_flight`
+        frames, so a sweep may expose that many frames past the stop point."""
+        focus_points = self.motion.order(self.focus_steps(min_focus, max_focus, steps))
+        pipeline = SweepPipeline(
+            executors.io,
+            max_in_flight=max_in_flight,
+            measure_options=self.measure_options,
+            keep_frames=self.keep_frames,
+            measure_executor=executors.measure,
+        )
+        measured_images = []
+        ms = None
+        seed_focus = None
+
+        def update(new_images, exposures):
+            nonlocal ms, seed_focus
+            if not new_images:
+                return None
+            if ms is None:
+                ms = Autofocus.MeasuredStars.from_measured_images(new_images[:1])
+                new_images = new_images[1:]
+            for measured_image in new_images:
+                ms.add_measured_image(measured_image)
+
+            # frames without stars add no focus point, e.g. at a defocused sweep edge
+            if len(ms.focus_points()) < 4:
+                return None
+
+            # track stars from the sharpest frame so far
+            best_focus = ms.focus_with_best_avg_fwhm()
+            if best_focus != seed_focus:
+                ms.build_tracks()
+                seed_focus = best_focus
+
+            fit = self.fit(ms.to_fwhm_list(max_stars=max_stars)[0])
+            progress = Autofocus.Progress(exposures, len(measured_images), len(focus_points), fit)
+            self.report_progress(progress)
+            return progress
+
+        for exposures, f in enumerate(focus_points, start=1):
+            self.expose_frame(pipeline, f, time)
+
+            new_images = pipeline.drain()
+            measured_images.extend(new_images)
+            progress = update(new_images, exposures)
+            if progress is not None and progress.constrained(ms.focus_points(), min_side_points, slope_tolerance):
+                logger.info(f'V-curve constrained after {progress.exposures} of {len(focus_points)} exposures')
+                break
+
+        new_images = pipeline.drain(wait=True)
+        measured_images.extend(new_images)
+        update(new_images, exposures)
+        return measured_images, ms
+
+    def report_progress(self, progress):
+        if self.on_progress is not None:
+            self.on_progress(progress)
+        else:
+            logger.info(repr(progress))
+
+    def search(self, executors, mode, time, min_focus, max_focus, steps, max_stars=5, max_in_flight=2):
+        if mode == 'adaptive':
+            return self.adaptive_search(executors, time, min_focus, max_focus, steps, max_stars, max_in_flight)
+        if mode == 'incremental':
+            return self.incremental_search(executors, time, min_focus, max_focus, steps, max_stars, max_in_flight)
+
+        measured_images = self.linear_search(executors, time, min_focus, max_focus, steps, max_in_flight)
+        return measured_images, Autofocus.MeasuredStars.from_measured_images(measured_images)
+
+    @contextmanager
+    def subframes(self):
+        """Scope of the region a search selects in 'stars' ROI mode; restores full
+        frames afterwards, the verification frame is cropped after decoding"""
+        self.region = None
+        self._full_frames = []
+        try:
+            yield
+        finally:
+            self.reset_region()
+
+    @instrument.timed('autofocus')
+    def autofocus(self, time, min_focus, max_focus, steps, max_stars=5, max_in_flight=2, mode='linear'):
+        if mode not in self.SEARCH_MODES:
+            raise ValueError(f'Unknown search mode: {mode}')
+
+        temperature = self.read_temperature()
+        prediction = self.predictor.predict(temperature, rig=self.rig) if self.predictor is not None else None
+        checked = None
+
+        with self.measurement_executors() as e, self.subframes():
+            if prediction is not None:
+                checked = self.quick_check(e, prediction, time, min_focus, max_focus, max_stars, max_in_flight)
+
+            if checked is not None:
+                center, stderr, measured_images, ms = checked
+            elif prediction is not None:
+                low, high, narrowed_steps = FocusPredictor.sweep_range(prediction, min_focus, max_focus, steps)
+                logger.info(f'Sweeping {low}..{high} in {narrowed_steps} steps around {prediction}')
+                measured_images, ms = self.search(
+                    e, mode, time, low, high, narrowed_steps, max_stars, max_in_flight,
+                )
+
+                step = (high - low) / narrowed_steps
+                center = self.fit(ms.to_fwhm_list(max_stars=max_stars)[0]).center
+                # an edge kept at the full range limit has nothing beyond it to sweep
+                if (center < low + step and low > min_focus) or (center > high - step and high < max_focus):
+                    logger.warning(f'Focus {center:.1f} is at the edge of {low}..{high}, sweeping the full range')
+                    measured_images, ms = self.search(
+                        e, mode, time, min_focus, max_focus, steps, max_stars, max_in_flight,
+                    )
+            else:
+                measured_images, ms = self.search(
+                    e, mode, time, min_focus, max_focus, steps, max_stars, max_in_flight,
+                )
+
+        image_jsons = [mi.image.meta_file for mi in measured_images]
+
         fwhms, focus_sars = ms.to_fwhm_list(max_stars=max_stars)
 
         print()
         self.print_fit_input(fwhms)
 
-        p = alg.v_shape_linear_fit(fwhms)
+        if checked is not None:
+            print()
+            print(f'Quick check confirmed {prediction}')
+            print(' - best focus point: {:.3f} +/- {:.3f}'.format(center, stderr))
+            if self.history is not None:
+                self.history.add(
+                    center, stderr, prediction.model, prediction.slope_a, prediction.slope_b, prediction.level,
+                    temperature=temperature, rig=self.rig,
+                )
+        else:
+            fit = self.fit(fwhms)
+            center = fit.center
 
-        print()
-        self.print_fit_output(p)
+            print()
+            self.print_fit_output(fit)
+            if self.history is not None:
+                self.history.add_fit(fit, temperature=temperature, rig=self.rig)
 
         print()
 
-        best_focus = int(p[0])
-        image = self.connector.expose(focus=best_focus, time=time, prefix="autofocus-result")
-        measured_image = MeasuredImage.from_image(image, measure=True)
+        best_focus = int(center)
+        image = self.connector.expose(focus=best_focus, time=time, prefix=f"{self.prefix}-result")
+        image.wait_downloaded()
+        measured_image = MeasuredImage.from_image(image, measure=True, **self.measure_options)
         measured_image.focus = best_focus
+        if not self.keep_frames:
+            measured_image.release_frame()
         ms.add_measured_image(measured_image)
 
         self.plot_focus_image(best_focus, ms, focus_sars, image, image_jsons)
 
-    def plot_focus_image(self, focus, measured_stars, focus_stars, image, image_jsons):
-        tolerance_factor = 1
-        min_fwhm = min(s.fwhm for s in measured_stars.stars)
-        tolerance = min_fwhm * tolerance_factor
+        return best_focus
 
-        stars = [
-            measured_stars.star_at_focus(focus, s, tolerance)
-            for s in focus_stars
-        ]
+    def plot_focus_image(self, focus, measured_stars, focus_stars, image, image_jsons):
+        tracks = [measured_stars.track_for(s) for s in focus_stars]
+        stars = [track.at_focus(focus) for track in tracks if track is not None]
+        stars = [s for s in stars if s is not None]
 
         print(stars)
 
-        import matplotlib.pyplot as plt
+        # pyplot keeps global state; a bare Figure can be drawn from several rigs' threads at once
+        from matplotlib.figure import Figure
+        from matplotlib.patches import Circle
         from skimage import io
         import settings
         import os
         import datetime
         import json
 
-        fig = plt.figure()
+        fig = Figure()
         ax = fig.add_subplot(1, 1, 1)
         image_arr = io.imread(image.image_file)
         ax.imshow(image_arr)
         ax.set_title('Autofocus')
         for star in stars:
             y, x, r = star.x, star.y, star.area_radius
-            c = plt.Circle((x, y), r, color='yellow', linewidth=1, fill=False)
+            c = Circle((x, y), r, color='yellow', linewidth=1, fill=False)
             ax.add_patch(c)
         ax.set_axis_off()
 
         date = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
-        filename = f'{date}-autofocus-result.jpg'
+        filename = f'{date}-{self.prefix}-result.jpg'
         path = os.path.join(settings.LOCAL_STORAGE, filename)
 
-        plt.savefig(path)
+        fig.savefig(path)
 
         with open(f'{path}.json', 'w') as f:
             f.write(json.dumps(
@@ -95,75 +449,200 @@ class Autofocus:
                 indent=2
             ))
 
+        with open(f'{path}.tracks.json', 'w') as f:
+            f.write(json.dumps(
+                [track.to_dict() for track in tracks if track is not None],
+                indent=2
+            ))
+
     def print_fit_input(self, fwhms):
         print('Linear fit input:')
         for row in fwhms:
             print('Focus: {focus}'.format(focus=row[0]))
             print('  - values:\t{vals}'.format(vals='\t'.join(['{:.4f}'.format(r) if r is not None else 'None' for r in row[1:]])))
 
-    def print_fit_output(self, p):
-        print('Linear fit output:')
-        print(' - best focus point: {:.3f}'.format(p[0]))
+    def print_fit_output(self, fit):
+        p = fit.p
+        print(f'{fit.model.capitalize()} fit output:')
+        print(' - best focus point: {:.3f} +/- {:.3f}'.format(fit.center, fit.center_stderr))
         print(' - expected FWHMs:\t{}'.format('\t'.join(['{:.4f}'.format(r) if r is not None else 'None' for r in p[1:-2]])))
         print(' - slope A: {:.5f}'.format(p[-2]))
         print(' - slope B: {:.5f}'.format(p[-1]))
 
+    class Progress:
+        __slots__ = ('exposures', 'measured', 'planned', 'fit')
+
+        def __init__(self, exposures, measured, planned, fit):
+            self.exposures = exposures
+            self.measured = measured
+            self.planned = planned
+            self.fit = fit
+
+        @property
+        def center(self):
+            return self.fit.center
+
+        @property
+        def stderr(self):
+            return self.fit.center_stderr
+
+        def slope_errors(self):
+            stderr = self.fit.stderr
+            return tuple(abs(e / s) if s else np.inf for e, s in zip(stderr[-2:], self.fit.slopes))
+
+        def constrained(self, focus_points, min_side_points=3, slope_tolerance=0.15):
+            left = sum(1 for f in focus_points if f < self.center)
+            right = sum(1 for f in focus_points if f > self.center)
+            slope_a, slope_b = self.fit.slopes
+            return (
+                left >= min_side_points and right >= min_side_points
+                and slope_a < 0 < slope_b
+                and max(self.slope_errors()) <= slope_tolerance
+            )
+
+        def __repr__(self):
+            return (
+                f'Autofocus {self.measured}/{self.planned} frames measured ({self.exposures} exposed): '
+                f'focus {self.center:.1f} +/- {self.stderr:.1f}'
+            )
+
     class MeasuredStar:
-        def __init__(self, x, y, fwhm, focus, area_radius):
+        __slots__ = ('x', 'y', 'fwhm', 'focus', 'area_radius', 'flux', 'frame',)
+
+        def __init__(self, x, y, fwhm, focus, area_radius, flux=None, frame=None):
             self.x = x
             self.y = y
             self.fwhm = fwhm
             self.focus = focus
             self.area_radius = area_radius
+            self.flux = flux
+            self.frame = frame
+
+        @classmethod
+        def from_record(cls, record, focus=None):
+            return cls(
+                x=float(record['x']), y=float(record['y']),
+                fwhm=float(record['fwhm']),
+                focus=record['focus'].item() if focus is None else focus,
+                area_radius=float(record['radius']),
+                flux=float(record['flux']),
+                frame=int(record['frame']),
+            )
+
+        def __repr__(self):
+            return f'MeasuredStar x:{self.x} y:{self.y} focus:{self.focus} fwhm:{self.fwhm}'
+
+    class StarTrack:
+        """One physical star followed through the focus points of a sweep"""
+
+        def __init__(self, seed, stars=None):
+            self.seed = seed
+            self.stars = stars if stars is not None else {seed.focus: seed}
+
+        def at_focus(self, focus):
+            return self.stars.get(focus)
+
+        def focus_points(self):
+            return sorted(self.stars)
+
+        def nearest_focus(self, focus):
+            return min(self.stars, key=lambda f: abs(f - focus))
+
+        def __len__(self):
+            return len(self.stars)
+
+        def to_dict(self):
+            return {
+                'seed_focus': self.seed.focus,
+                'stars': [
+                    {
+                        'focus': focus,
+                        'x': float(star.x),
+                        'y': float(star.y),
+                        'fwhm': float(star.fwhm),
+                        'area_radius': float(star.area_radius),
+                    }
+                    for focus, star in sorted(self.stars.items())
+                ],
+            }
 
     class MeasuredStars:
         def __init__(self, image_width, image_height):
             self.image_width = image_width
             self.image_height = image_height
             self.stars = []
+            self.frame_count = 0
+            self.tracks = None
+            self.track_tolerance = None
+            self._tolerance_factor = None
+            self._track_by_star = {}
+            self._tables = None
+            self._tables_size = None
 
         def focus_points(self):
-            return sorted({star.focus for star in self.stars})
+            return sorted(self.focus_tables())
+
+        def focus_tables(self):
+            """Returns {focus: (stars, KD-tree of their positions)}, rebuilt only when stars were added"""
+            if self._tables is None or self._tables_size != len(self.stars):
+                by_focus = {}
+                for star in self.stars:
+                    by_focus.setdefault(star.focus, []).append(star)
+
+                self._tables = {
+                    focus: (stars, cKDTree(np.array([(s.x, s.y) for s in stars], dtype=float)))
+                    for focus, stars in by_focus.items()
+                }
+                self._tables_size = len(self.stars)
+            return self._tables
+
+        def match(self, seeds, tolerance=0):
+            """Follows every seed star through neighbouring focus points, each step matching
+            the nearest star within `tolerance` of the previous match.
+
+            Returns an array (seeds x focus points) of indexes into stars_at_focus(focus),
+            -1 where a seed has no match."""
+            tables = self.focus_tables()
+            focus_points = sorted(tables)
+            result = np.full((len(seeds), len(focus_points)), -1, dtype=int)
+            upper_bound = np.nextafter(tolerance, np.inf)
+
+            for seed_focus in {s.focus for s in seeds}:
+                rows = np.array([i for i, s in enumerate(seeds) if s.focus == seed_focus])
+                origin = np.array([(seeds[i].x, seeds[i].y) for i in rows], dtype=float)
+                start = focus_points.index(seed_focus)
+
+                for columns in (range(start, len(focus_points)), range(start - 1, -1, -1)):
+                    ref = origin.copy()
+                    for col in columns:
+                        stars, tree = tables[focus_points[col]]
+                        _, idx = tree.query(ref, distance_upper_bound=upper_bound)
+                        found = idx < len(stars)
+                        result[rows[found], col] = idx[found]
+                        ref[found] = tree.data[idx[found]]
 
-        def star_at_focus(self, focus, star, tolerance=0):
-            candidates = [s for s in self.star_all_focuses(star, tolerance) if s.focus == focus]
+            return result
 
-            if len(candidates) == 1:
-                return candidates[0]
+        def star_at_focus(self, focus, star, tolerance=0):
+            tables = self.focus_tables()
+            if focus not in tables:
+                return None
 
-            return None
+            col = sorted(tables).index(focus)
+            idx = self.match([star], tolerance)[0, col]
+            return tables[focus][0][idx] if idx >= 0 else None
 
         def star_all_focuses(self, star, tolerance=0):
-            def dist(s1, s2):
-                return math.sqrt((s1.x - s2.x) ** 2 + (s1.y - s2.y) ** 2)
-
-            result = []
-            focus_points = self.focus_points()
-
-            star_focus_idx = focus_points.index(star.focus)
-
-            ref_star = star
-            for focus in focus_points[star_focus_idx:]:
-                stars = self.stars_at_focus(focus)
-                near_stars = [s for s in stars if dist(s, ref_star) <= tolerance]
-                if len(near_stars) > 0:
-                    near_stars = sorted(near_stars, key=lambda s: dist(ref_star, s))
-                    result.append(near_stars[0])
-                    ref_star = near_stars[0]
-
-            ref_star = star
-            for focus in focus_points[:star_focus_idx][::-1]:
-                stars = self.stars_at_focus(focus)
-                near_stars = [s for s in stars if dist(s, ref_star) <= tolerance]
-                if len(near_stars) > 0:
-                    near_stars = sorted(near_stars, key=lambda s: dist(ref_star, s))
-                    result.append(near_stars[0])
-                    ref_star = near_stars[0]
-
-            return result
+            tables = self.focus_tables()
+            return [
+                tables[focus][0][idx]
+                for focus, idx in zip(sorted(tables), self.match([star], tolerance)[0])
+                if idx >= 0
+            ]
 
         def stars_at_focus(self, focus):
-            return [star for star in self.stars if star.focus == focus]
+            tables = self.focus_tables()
+            return list(tables[focus][0]) if focus in tables else []
 
         def focus_with_best_avg_fwhm(self):
             return min((f for f in self.focus_points()), key=lambda x: self.avg_fwhm(x))
@@ -172,71 +651,109 @@ class Autofocus:
             stars = self.stars_at_focus(focus)
             return sum(s.fwhm for s in stars) / float(len(stars))
 
-        def to_fwhm_list(self, tolerance_factor=1, max_stars=5):
-            fwhms = []
+        def build_tracks(self, tolerance_factor=1):
+            """Matches stars of the best focus point through the whole sweep once.
+            Tracks are extended in place by add_measured_image."""
+            seeds = self.stars_at_focus(self.focus_with_best_avg_fwhm())
+            tolerance = min(s.fwhm for s in seeds) * tolerance_factor
 
-            stars = self.stars_at_focus(self.focus_with_best_avg_fwhm())
+            focus_points = self.focus_points()
+            tables = self.focus_tables()
+            matches = self.match(seeds, tolerance)
+
+            self.tracks = [
+                Autofocus.StarTrack(seed, {
+                    focus: tables[focus][0][idx]
+                    for focus, idx in zip(focus_points, row)
+                    if idx >= 0
+                })
+                for seed, row in zip(seeds, matches)
+            ]
+            self.track_tolerance = tolerance
+            self._tolerance_factor = tolerance_factor
+            self._track_by_star = {
+                star: track
+                for track in self.tracks
+                for star in track.stars.values()
+            }
+            return self.tracks
+
+        def track_for(self, star):
+            return self._track_by_star.get(star)
+
+        def extend_tracks(self, focus):
+            if not self.tracks or focus not in self.focus_tables():
+                return
+
+            stars, tree = self.focus_tables()[focus]
+            tracks = [t for t in self.tracks if t.at_focus(focus) is None]
+            if not tracks:
+                return
+
+            ref = np.array([
+                (s.x, s.y)
+                for s in (t.at_focus(t.nearest_focus(focus)) for t in tracks)
+            ], dtype=float)
+            _, idx = tree.query(ref, distance_upper_bound=np.nextafter(self.track_tolerance, np.inf))
+
+            for track, i in zip(tracks, idx):
+                if i < len(stars):
+                    track.stars[focus] = stars[i]
+                    self._track_by_star[stars[i]] = track
 
-            min_fwhm = min(s.fwhm for s in stars)
-            tolerance = min_fwhm * tolerance_factor
+        def to_fwhm_list(self, tolerance_factor=1, max_stars=5):
+            if self.tracks is None or self._tolerance_factor != tolerance_factor:
+                self.build_tracks(tolerance_factor)
 
-            def star_score(star):
-                frame_count = len([x for x in self.star_all_focuses(star, tolerance) if x is not None])
+            tracks = self.tracks
+            seeds = [t.seed for t in tracks]
+            positions = np.array([(s.x, s.y) for s in seeds], dtype=float).reshape(-1, 2)
+            frame_count = np.array([len(t) for t in tracks])
 
-                center_dist = math.sqrt((star.x - self.image_width / 2) ** 2 + (star.y - self.image_height / 2) ** 2)
-                half_diam = math.sqrt(self.image_width ** 2 + self.image_width ** 2) / 2
-                dist_factor = 1 - (center_dist/half_diam) ** 3
+            center_dist = np.hypot(positions[:, 0] - self.image_width / 2, positions[:, 1] - self.image_height / 2)
+            half_diam = math.sqrt(self.image_width ** 2 + self.image_width ** 2) / 2
+            dist_factor = 1 - (center_dist / half_diam) ** 3
 
-                score = frame_count * dist_factor
-                return score
-
-            stars = sorted(
-                stars,
-                reverse=True,
-                key=star_score
-            )
+            score = frame_count * dist_factor
+            order = sorted(range(len(tracks)), reverse=True, key=lambda i: score[i])
 
             if max_stars is not None:
-                stars = stars[:max_stars]
+                order = order[:max_stars]
 
+            fwhms = []
             for f in self.focus_points():
                 row = [f]
-                for s in stars:
-                    s = self.star_at_focus(f, s, tolerance)
+                for i in order:
+                    s = tracks[i].at_focus(f)
                     row.append(s.fwhm if s is not None else None)
                 fwhms.append(row)
 
-            return fwhms, stars
+            return fwhms, [seeds[i] for i in order]
+
+        def catalog(self):
+            """Returns all stars as a columnar StarCatalog"""
+            return StarCatalog(np.array([
+                (s.x, s.y, s.area_radius, s.fwhm,
+                 np.nan if s.flux is None else s.flux, s.focus,
+                 -1 if s.frame is None else s.frame)
+                for s in self.stars
+            ], dtype=STAR_DTYPE))
 
         @classmethod
         def from_measured_images(cls, images):
-            image_width, image_height = images[0].image_arr.shape
+            image_width, image_height = images[0].shape
             ms = cls(image_width, image_height)
             for img in images:
-                if (ms.image_width, ms.image_height,) != img.image_arr.shape:
-                    raise Exception('Different size of an image: {} vs {}'.format((ms.image_width, ms.image_width,), img.image_arr.shape))
-
-                for s in img.stars:
-                    ms.stars.append(
-                        Autofocus.MeasuredStar(
-                            x=s.x, y=s.y,
-                            focus=img.image.meta['focus'],
-                            fwhm=s.fwhm,
-                            area_radius=s.radius,
-                        )
-                    )
+                ms.add_measured_image(img)
             return ms
 
         def add_measured_image(self, img):
-            if (self.image_width, self.image_height,) != img.image_arr.shape:
-                raise Exception('Different size of an image: {} vs {}'.format((self.image_width, self.image_width,), img.image_arr.shape))
-
-            for s in img.stars:
-                self.stars.append(
-                    Autofocus.MeasuredStar(
-                        x=s.x, y=s.y,
-                        focus=img.image.meta['focus'],
-                        fwhm=s.fwhm,
-                        area_radius=s.radius,
-                    )
-                )
+            if (self.image_width, self.image_height,) != img.shape:
+                raise Exception('Different size of an image: {} vs {}'.format((self.image_width, self.image_height,), img.shape))
+
+            focus = img.image.meta['focus']
+            catalog = img.catalog.with_frame(frame=self.frame_count, focus=focus)
+            self.frame_count += 1
+
+            self.stars.extend(Autofocus.MeasuredStar.from_record(r, focus=focus) for r in catalog)
+            self.extend_tracks(focus)
@@ -0,0 +1,87 @@
+import os
+import json
+import glob
+import hashlib
+import logging
+
+import numpy as np
+
+from core.catalog import StarCatalog
+
+
+logger = logging.getLogger(__name__)
+
+# bump when detection or fitting changes in a way that invalidates stored catalogs
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = '.stars.npz'
+
+
+def content_hash(path, chunk_size=2 ** 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def params_hash(params):
+    payload = json.dumps({'version': CACHE_VERSION, **params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class MeasurementCache:
+    """On-disk cache of star catalogs keyed by image content and measurement parameters.
+
+    Catalogs are stored next to the measured image (and its .json meta) as
+    <content hash>-<params hash>.stars.npz. Least recently used entries of a
+    directory are evicted once they take more than `max_bytes`."""
+
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        self.max_bytes = max_bytes
+
+    def key(self, image_file, params):
+        return f'{content_hash(image_file)[:24]}-{params_hash(params)[:12]}'
+
+    def path(self, image_file, key):
+        return os.path.join(os.path.dirname(os.path.abspath(image_file)), key + CACHE_SUFFIX)
+
+    def load(self, image_file, key):
+        path = self.path(image_file, key)
+        try:
+            with np.load(path) as f:
+                catalog = StarCatalog(f['stars'])
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+
+        logger.info(f'Loaded cached stars for {image_file}')
+        return catalog
+
+    def store(self, image_file, key, catalog):
+        path = self.path(image_file, key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, stars=catalog.data)
+        os.replace(tmp_path, path)
+        self.evict(os.path.dirname(path))
+        return path
+
+    def evict(self, directory):
+        entries = []
+        for path in glob.glob(os.path.join(directory, '*' + CACHE_SUFFIX)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
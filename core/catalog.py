@@ -0,0 +1,75 @@
+import numpy as np
+
+
+STAR_DTYPE = np.dtype([
+    ('x', np.float64),
+    ('y', np.float64),
+    ('radius', np.float32),
+    ('fwhm', np.float32),
+    ('flux', np.float32),
+    ('focus', np.float64),
+    ('frame', np.int32),
+])
+
+
+class StarCatalog:
+    """Columnar table of measured stars backed by a NumPy structured array"""
+
+    def __init__(self, data=None):
+        self.data = np.asarray(data, dtype=STAR_DTYPE) if data is not None else np.empty(0, dtype=STAR_DTYPE)
+
+    @classmethod
+    def from_star_areas(cls, areas, focus=np.nan, frame=-1, offset=(0, 0), scale=1):
+        """Builds a catalog in full resolution frame coordinates from StarAreas
+        measured on a frame decoded at `offset` and `scale`"""
+        data = np.empty(len(areas), dtype=STAR_DTYPE)
+        for i, s in enumerate(areas):
+            data[i] = (
+                offset[0] + s.x * scale, offset[1] + s.y * scale,
+                s.radius * scale, s.fwhm * scale, s.flux * scale ** 2,
+                focus, frame,
+            )
+        return cls(data)
+
+    @classmethod
+    def concatenate(cls, catalogs):
+        catalogs = list(catalogs)
+        if not catalogs:
+            return cls()
+        return cls(np.concatenate([c.data for c in catalogs]))
+
+    def with_frame(self, frame=None, focus=None):
+        data = self.data.copy()
+        if frame is not None:
+            data['frame'] = frame
+        if focus is not None:
+            data['focus'] = focus
+        return StarCatalog(data)
+
+    def at_focus(self, focus):
+        return StarCatalog(self.data[self.data['focus'] == focus])
+
+    def within(self, region):
+        """Stars centered inside a (top, left, height, width) region"""
+        top, left, height, width = region
+        x, y = self.data['x'], self.data['y']
+        return StarCatalog(self.data[(x >= top) & (x < top + height) & (y >= left) & (y < left + width)])
+
+    def positions(self):
+        return np.column_stack([self.data['x'], self.data['y']])
+
+    def __getitem__(self, field):
+        return self.data[field]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __repr__(self):
+        return f'StarCatalog ({len(self)} stars)'
@@ -1,5 +1,8 @@
+import socket
 import threading
 import logging
+from time import monotonic, sleep
+from concurrent import futures
 
 from indi.client.client import Client
 from indi.message.const import State
@@ -7,15 +10,27 @@ from indi.transport.client import TCP
 from indi.message import const
 
 from core.value_object import Image
+from core.download import default_manager
+from core.focuser import FocuserMotion
+from core import instrument
 
 
 logger = logging.getLogger(__name__)
 
 
+class ConnectionTimeout(Exception):
+    def __init__(self, report):
+        self.report = report
+        missing = [label for label, elapsed in report.items() if elapsed is None]
+        super().__init__('Timed out waiting for {}'.format(', '.join(missing)))
+
+
 class Connector:
     def __init__(self,
                  ip='127.0.0.1', port=7624,
                  camera_name=None, focuser_name=None, phd2_name=None,
+                 download_manager=None,
+                 backlash=0, focus_direction=1, focus_tolerance=0.1,
                  ):
         self.client = None
         self.camera_name = camera_name
@@ -27,180 +42,299 @@ class Connector:
         self.ip = ip
         self.port = port
         self.http_port = 8000
-
-    def connect(self):
+        self.download_manager = download_manager or default_manager()
+        self.set_motion(backlash, focus_direction, focus_tolerance)
+        self.subframe = None
+        self._outstanding = set()
+        self._outstanding_lock = threading.Lock()
+
+    def set_motion(self, backlash=0, focus_direction=1, focus_tolerance=0.1):
+        self.motion = FocuserMotion(backlash, focus_direction, focus_tolerance)
+
+    def connect(self, timeout=60, poll_interval=0.05, slow_after=2.0):
+        """Starts the INDI client and connects all devices at once.
+
+        Every expected device and property vector is checked on each poll; a
+        device is switched on as soon as its CONNECTION vector shows up. Raises
+        ConnectionTimeout with the per-vector report when anything is still
+        missing after `timeout` seconds; the server connections are closed
+        again whenever connecting fails."""
         control_connection = TCP(self.ip, self.port)
         blob_connection = TCP(self.ip, self.port)
 
         self.client = Client(control_connection, blob_connection)
         self.client.start()
-
-        if self.camera_name not in self.client.devices:
-            logger.info('Waiting for CAMERA')
-            self.client.waitforupdate(
-                device=self.camera_name,
-                vector='CONNECTION',
-                what='definition',``
+        try:
+            return self.wait_devices(timeout, poll_interval, slow_after)
+        except BaseException:
+            self.disconnect()
+            raise
+
+    def wait_devices(self, timeout, poll_interval, slow_after):
+        devices = [
+            (attr, name, vector)
+            for attr, name, vector in (
+                ('camera', self.camera_name, 'CCD_EXPOSURE'),
+                ('focuser', self.focuser_name, 'ABS_FOCUS_POSITION'),
+                ('phd2', self.phd2_name, 'DITHER'),
             )
+            if name is not None
+        ]
+
+        pending = {}
+        for attr, name, vector in devices:
+            pending[f'{name}.CONNECTION'] = (attr, name, 'CONNECTION')
+            pending[f'{name}.{vector}'] = (attr, name, vector)
+        logger.info('Waiting for {}'.format(', '.join(pending)))
+
+        start = monotonic()
+        self.connect_report = {}
+        while pending:
+            for label, (attr, name, vector) in list(pending.items()):
+                if not self.is_defined(name, vector):
+                    continue
+
+                elapsed = monotonic() - start
+                self.connect_report[label] = elapsed
+                del pending[label]
+                logger.info(f'{label} defined after {elapsed:.2f}s')
+                if elapsed > slow_after:
+                    logger.warning(f'{label} was slow to appear ({elapsed:.2f}s)')
+
+                if vector == 'CONNECTION':
+                    device = self.client[name]
+                    setattr(self, attr, device)
+                    device['CONNECTION']['CONNECT'].value = const.SwitchState.ON
+                    device['CONNECTION']['DISCONNECT'].value = const.SwitchState.OFF
+                    device['CONNECTION'].submit()
+
+            if not pending:
+                break
+
+            if monotonic() - start > timeout:
+                for label in pending:
+                    self.connect_report[label] = None
+                raise ConnectionTimeout(self.connect_report)
+
+            sleep(poll_interval)
 
-        if self.focuser_name not in self.client.devices:
-            logger.info('Waiting for FOCUSER')
-            self.client.waitforupdate(
-                device=self.focuser_name,
-                vector='CONNECTION',
-                what='definition',
-            )
+        logger.info('All connected')
+        return self.connect_report
 
-        if self.phd2_name not in self.client.devices:
-            logger.info('Waiting for PHD2')
-            self.client.waitforupdate(
-                device=self.phd2_name,
-                vector='CONNECTION',
-                what='definition',
-            )
+    def is_defined(self, device, vector):
+        return device in self.client.devices and vector in self.client[device]
 
-        self.focuser = self.client[self.focuser_name]
-        self.camera = self.client[self.camera_name]
-        self.phd2 = self.client[self.phd2_name]
+    def move_focuser(self, focus):
+        """Moves the focuser, approaching `focus` from the side set by `self.motion`
+        and returning as soon as the reported position is within its tolerance"""
+        current_focus = self.focuser['ABS_FOCUS_POSITION']['FOCUS_ABSOLUTE_POSITION'].value
+        moves = self.motion.moves(float(current_focus) if current_focus is not None else None, focus)
+        if not moves:
+            return
 
-        self.focuser['CONNECTION']['CONNECT'].value = const.SwitchState.ON
-        self.focuser['CONNECTION']['DISCONNECT'].value = const.SwitchState.OFF
-        self.focuser['CONNECTION'].submit()
+        with instrument.span('focuser.move', focus=focus, moves=len(moves)):
+            for position in moves[:-1]:
+                # backlash overshoot; reverse only once it is fully done
+                self.drive_focuser(position, lambda a, b: abs(float(a) - float(b)) < 0.1)
+            self.drive_focuser(focus, self.motion.settled)
 
-        self.camera['CONNECTION']['CONNECT'].value = const.SwitchState.ON
-        self.camera['CONNECTION']['DISCONNECT'].value = const.SwitchState.OFF
-        self.camera['CONNECTION'].submit()
+    def drive_focuser(self, position, settled):
+        logger.info(f'Setting FOCUS_ABSOLUTE_POSITION = {position}')
+        self.focuser['ABS_FOCUS_POSITION']['FOCUS_ABSOLUTE_POSITION'].value = position
+        self.focuser['ABS_FOCUS_POSITION'].submit()
 
-        self.phd2['CONNECTION']['CONNECT'].value = const.SwitchState.ON
-        self.phd2['CONNECTION']['DISCONNECT'].value = const.SwitchState.OFF
-        self.phd2['CONNECTION'].submit()
+        self.client.waitforupdate(
+            device=self.focuser.name,
+            vector='ABS_FOCUS_POSITION',
+            element='FOCUS_ABSOLUTE_POSITION',
+            expect=position,
+            what='value',
+            cmp=settled,
+        )
+        logger.info(f'DONE: Setting FOCUS_ABSOLUTE_POSITION = {position}')
 
-        if 'ABS_FOCUS_POSITION' not in self.focuser:
-            logger.info('Waiting for FOCUS_ABSOLUTE_POSITION')
-            self.client.waitforupdate(
-                device=self.focuser.name,
-                vector='ABS_FOCUS_POSITION',
-                what='definition'
-            )
+    def temperature(self):
+        """Focuser temperature if the driver reports one, otherwise None"""
+        if not self.is_defined(self.focuser.name, 'FOCUS_TEMPERATURE'):
+            return None
+        value = self.focuser['FOCUS_TEMPERATURE']['TEMPERATURE'].value
+        return float(value) if value is not None else None
+
+    def exposure(self, time):
+        logger.info(f'Setting CCD_EXPOSURE_VALUE = {time}')
+        with instrument.span('camera.exposure', exposure=time) as span:
+            self.camera['CCD_EXPOSURE']['CCD_EXPOSURE_VALUE'].value = time
+            self.camera['CCD_EXPOSURE'].submit()
 
-        if 'CCD_EXPOSURE' not in self.camera:
-            logger.info('Waiting for CCD_EXPOSURE')
             self.client.waitforupdate(
                 device=self.camera.name,
                 vector='CCD_EXPOSURE',
-                what='definition'
+                what='state',
+                expect=State.OK,
             )
+        if span.enabled:
+            # time past the requested exposure until the camera reports the frame
+            instrument.record('camera.readout', max(span.duration - float(time), 0.0))
+        logger.info(f'DONE: Setting CCD_EXPOSURE_VALUE = {time}')
 
-        if 'DITHER' not in self.phd2:
-            logger.info('Waiting for DITHER')
+        return self.camera['LAST_IMAGE_URL']['JPEG'].value, self.camera['LAST_IMAGE_URL']['RAW'].value
+
+    def set_subframe(self, region, shape):
+        """Asks the camera to crop its frames to `region` (top, left, height, width) of a
+        `shape` frame. Returns False when the driver has no CCD_FRAME, in which case
+        frames have to be cropped after download."""
+        if not self.is_defined(self.camera.name, 'CCD_FRAME'):
+            return False
+        top, left, height, width = region
+        scale = self.sensor_scale(shape)
+        self.set_ccd_frame(left * scale, top * scale, width * scale, height * scale)
+        self.subframe = {'region': list(region), 'shape': list(shape)}
+        return True
+
+    def reset_subframe(self):
+        if self.subframe is None:
+            return
+        if self.is_defined(self.camera.name, 'CCD_FRAME_RESET'):
+            self.camera['CCD_FRAME_RESET']['RESET'].value = const.SwitchState.ON
+            self.camera['CCD_FRAME_RESET'].submit()
             self.client.waitforupdate(
-                device=self.phd2.name,
-                vector='DITHER',
-                what='definition'
+                device=self.camera.name,
+                vector='CCD_FRAME_RESET',
+                what='state',
+                expect=State.OK,
             )
-        logger.info('All connected')
+        else:
+            height, width = self.subframe['shape']
+            scale = self.sensor_scale(self.subframe['shape'])
+            self.set_ccd_frame(0, 0, width * scale, height * scale)
+        self.subframe = None
+
+    def sensor_scale(self, shape):
+        """Sensor pixels per pixel of a downloaded frame of `shape`"""
+        if self.is_defined(self.camera.name, 'CCD_INFO'):
+            max_x = self.camera['CCD_INFO']['CCD_MAX_X'].value
+            if max_x:
+                return float(max_x) / shape[1]
+        return 1.0
+
+    def set_ccd_frame(self, x, y, width, height):
+        logger.info(f'Setting CCD_FRAME = {x:.0f},{y:.0f} {width:.0f}x{height:.0f}')
+        vector = self.camera['CCD_FRAME']
+        for name, value in (('X', x), ('Y', y), ('WIDTH', width), ('HEIGHT', height)):
+            vector[name].value = int(round(value))
+        vector.submit()
 
-    def expose(self, focus, time, download_images=True, download_images_async=True, prefix=None):
-
-        current_focus = self.focuser['ABS_FOCUS_POSITION']['FOCUS_ABSOLUTE_POSITION'].value
-        if current_focus is None or float(current_focus) != focus:
-            logger.info(f'Setting FOCUS_ABSOLUTE_POSITION = {focus}')
-
-            self.focuser['ABS_FOCUS_POSITION']['FOCUS_ABSOLUTE_POSITION'].value = focus
-            self.focuser['ABS_FOCUS_POSITION'].submit()
+        self.client.waitforupdate(
+            device=self.camera.name,
+            vector='CCD_FRAME',
+            what='state',
+            expect=State.OK,
+        )
 
-            self.client.waitforupdate(
-                device=self.focuser.name,
-                vector='ABS_FOCUS_POSITION',
-                element='FOCUS_ABSOLUTE_POSITION',
-                expect=focus,
-                what='value',
-                cmp=lambda a, b: abs(float(a) - float(b)) < 0.1
-            )
-            logger.info(f'DONE: Setting FOCUS_ABSOLUTE_POSITION = {focus}')
+    @instrument.timed('guider.dither')
+    def dither(self, pixels):
+        logger.info(f'Setting DITHER = {pixels}')
 
-        logger.info(f'Setting CCD_EXPOSURE_VALUE = {time}')
-        self.camera['CCD_EXPOSURE']['CCD_EXPOSURE_VALUE'].value = time
-        self.camera['CCD_EXPOSURE'].submit()
-        logger.info(f'DONE: Setting CCD_EXPOSURE_VALUE = {time}')
+        self.phd2['DITHER']['DITHER_BY_PIXELS'].value = pixels
+        self.phd2['DITHER'].submit()
 
         self.client.waitforupdate(
-            device=self.camera.name,
-            vector='CCD_EXPOSURE',
+            device=self.phd2.name,
+            vector='DITHER',
             what='state',
             expect=State.OK,
         )
+        logger.info(f'DONE: Setting DITHER = {pixels}')
 
-        url = self.camera['LAST_IMAGE_URL']['JPEG'].value
+    def expose(self, focus, time, download_images=True, download_images_async=True, prefix=None):
+        self.move_focuser(focus)
+
+        url, _ = self.exposure(time)
 
         meta = {
             'focus': focus,
             'exposure': time,
         }
+        if self.subframe is not None:
+            meta['subframe'] = dict(self.subframe)
 
         img = Image(source_url=url, meta=meta, prefix=prefix)
 
         if download_images:
             if download_images_async:
-                th = threading.Thread(
-                    target=img.download_image,
-                )
-                th.run()
+                self.track(img.fetch_async(self.download_manager))
             else:
-                img.download_image()
-                img.delete_remote_image()
+                img.fetch(self.download_manager)
 
         return img
 
     def expose_only(self, time, dither=0, prefix=None):
-        logger.info(f'Setting CCD_EXPOSURE_VALUE = {time}')
+        url, raw_url = self.exposure(time)
+        img, raw_img = self.download_exposure(url, raw_url, prefix=prefix)
 
-        self.camera['CCD_EXPOSURE']['CCD_EXPOSURE_VALUE'].value = time
-        self.camera['CCD_EXPOSURE'].submit()
-
-        self.client.waitforupdate(
-            device=self.camera.name,
-            vector='CCD_EXPOSURE',
-            what='state',
-            expect=State.OK,
-        )
-        logger.info(f'DONE: Setting CCD_EXPOSURE_VALUE = {time}')
+        if dither:
+            self.dither(dither)
 
-        url = self.camera['LAST_IMAGE_URL']['JPEG'].value
-        raw_url = self.camera['LAST_IMAGE_URL']['RAW'].value
+        return img, raw_img
 
+    def download_exposure(self, url, raw_url, prefix=None):
+        """Starts background downloads of both files of an exposure"""
         meta = {}
         img = Image(source_url=url, meta=meta, prefix=prefix)
-        raw_img = Image(source_url=raw_url, meta=meta, prefix=prefix)
+        raw_img = Image(source_url=raw_url, meta=dict(meta), prefix=prefix)
 
-        def download():
-            logger.info(f"Downloading jpg: {url}")
-            img.download_image()
-            img.delete_remote_image()
-            logger.info(f"DONE: Downloading jpg: {url}")
+        def download(image, kind):
+            logger.info(f"Downloading {kind}: {image.source_url}")
+            image.fetch(self.download_manager)
+            logger.info(f"DONE: Downloading {kind}: {image.source_url}")
 
-            logger.info(f"Downloading raw: {raw_url}")
-            raw_img.download_image()
-            raw_img.delete_remote_image()
-            logger.info(f"DONE: Downloading raw: {raw_url}")
-
-        download_th = threading.Thread(
-            target=download,
-        )
-        download_th.start()
-
-        if dither:
-            logger.info(f'Setting DITHER = {dither}')
+        img.download_future = self.track(self.download_manager.submit(download, img, 'jpg'))
+        raw_img.download_future = self.track(self.download_manager.submit(download, raw_img, 'raw'))
 
-            self.phd2['DITHER']['DITHER_BY_PIXELS'].value = dither
-            self.phd2['DITHER'].submit()
+        return img, raw_img
 
-            self.client.waitforupdate(
-                device=self.phd2.name,
-                vector='DITHER',
-                what='state',
-                expect=State.OK,
-            )
-            logger.info(f'DONE: Setting DITHER = {dither}')
+    def track(self, future):
+        with self._outstanding_lock:
+            self._outstanding.add(future)
+        future.add_done_callback(self._untrack)
+        return future
+
+    def _untrack(self, future):
+        with self._outstanding_lock:
+            self._outstanding.discard(future)
+
+    @property
+    def outstanding(self):
+        with self._outstanding_lock:
+            return list(self._outstanding)
+
+    def wait_transfers(self, timeout=None):
+        """Waits for outstanding background transfers; returns those still running"""
+        done, not_done = futures.wait(self.outstanding, timeout=timeout)
+        for f in done:
+            if f.exception() is not None:
+                logger.error(f'Transfer failed: {f.exception()}')
+        return not_done
+
+    def disconnect(self):
+        """Closes both INDI server connections, which also ends their reader threads"""
+        if self.client is None:
+            return
+        for handler in (self.client.control_connection_handler, self.client.blob_connection_handler):
+            if handler is None:
+                continue
+            try:
+                # wakes the blocked reader with EOF instead of an error
+                handler.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            handler.close()
+        self.client = None
 
-        return img, raw_img
+    def close(self, timeout=None):
+        """Waits for background transfers, then disconnects from the INDI server"""
+        pending = self.wait_transfers(timeout)
+        if pending:
+            logger.warning(f'{len(pending)} transfers still running on close')
+        self.disconnect()
+        return pending
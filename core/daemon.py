@@ -0,0 +1,289 @@
+import os
+import logging
+import secrets
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+
+import settings
+from core.client import Connector
+from core.autofocus import Autofocus
+from core.cache import MeasurementCache
+from core.timelapse import Timelapse
+from core.history import FocusHistory
+
+
+logger = logging.getLogger(__name__)
+
+
+AUTHKEY_FILE = 'daemon.key'
+
+# Connector kwargs identifying a rig; the rest, e.g. focuser motion, is applied per job
+CONNECTION_KEYS = ('ip', 'port', 'camera_name', 'focuser_name', 'phd2_name')
+
+
+class DaemonError(Exception):
+    pass
+
+
+def load_authkey(create=False):
+    """Key authenticating daemon clients.
+
+    TELESCOPY_DAEMON_AUTHKEY when set, otherwise a random key in
+    LOCAL_STORAGE/daemon.key that the daemon creates on its first start.
+    Requests are unpickled once authenticated, so the key file has to be
+    readable by its owner only."""
+    if settings.DAEMON_AUTHKEY:
+        return settings.DAEMON_AUTHKEY
+
+    path = os.path.join(settings.LOCAL_STORAGE, AUTHKEY_FILE)
+    if create and not os.path.exists(path):
+        os.makedirs(settings.LOCAL_STORAGE, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        raise DaemonError(f'No daemon key in {path}; start the daemon or set TELESCOPY_DAEMON_AUTHKEY')
+    if mode & 0o077:
+        raise DaemonError(f'{path} must be readable by its owner only (chmod 600)')
+    with open(path) as f:
+        return f.read().strip().encode()
+
+
+def autofocus_job(
+    conn,
+    time=2,
+    min_focus=3800,
+    max_focus=4100,
+    steps=10,
+    max_stars=5,
+    max_in_flight=2,
+    detector='blob_log',
+    roi=None,
+    roi_size=512,
+    reduce=1,
+    cache=True,
+    executor='threads',
+    max_workers=4,
+    mode='linear',
+    fit_model='linear',
+    fit_loss='linear',
+    history=True,
+    executors=None,
+    prefix='autofocus',
+):
+    af = Autofocus(
+        conn,
+        detector=detector,
+        roi=roi,
+        roi_size=roi_size,
+        reduce=reduce,
+        cache=MeasurementCache() if cache else None,
+        executor=executor,
+        max_workers=max_workers,
+        fit_model=fit_model,
+        fit_loss=fit_loss,
+        history=FocusHistory.shared() if history else None,
+        executors=executors,
+        prefix=prefix,
+    )
+    return af.autofocus(time, min_focus, max_focus, steps, max_stars, max_in_flight, mode=mode)
+
+
+def expose_job(conn, time=60, prefix='light'):
+    img, raw_img = conn.expose_only(time=time, prefix=prefix)
+    img.wait_downloaded()
+    raw_img.wait_downloaded()
+    return img.image_file
+
+
+def timelapse_job(conn, count, time=60, dither=5, dither_every=1, max_pending=2, prefix='light'):
+    timelapse = Timelapse(conn, time=time, dither=dither, dither_every=dither_every, max_pending=max_pending, prefix=prefix)
+    return timelapse.run(count).to_dict()
+
+
+JOBS = {
+    'autofocus': autofocus_job,
+    'expose': expose_job,
+    'timelapse': timelapse_job,
+}
+
+
+def run_local(job, connection, **kwargs):
+    """Runs a job on a fresh connection, the way the CLI works without a daemon"""
+    conn = Connector(**connection)
+    conn.connect()
+    try:
+        return JOBS[job](conn, **kwargs)
+    finally:
+        conn.close()
+
+
+class ConnectionPool:
+    """Connected Connectors keyed by server address and device names.
+
+    A rig is connected on first use and then kept; jobs on the same rig run
+    one at a time while different rigs are independent. Focuser motion
+    settings are part of each job: the kept Connector is reconfigured with
+    the ones sent, and defaults for the rest, as a new Connector would be."""
+
+    def __init__(self, factory=Connector):
+        self.factory = factory
+        self._connectors = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(connection):
+        return tuple(sorted((k, v) for k, v in connection.items() if k in CONNECTION_KEYS))
+
+    def _rig_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def run(self, connection, fn, *args, **kwargs):
+        key = self.key(connection)
+        with self._rig_lock(key):
+            conn = self._connectors.get(key)
+            if conn is None:
+                logger.info(f'Connecting {connection}')
+                conn = self.factory(**connection)
+                try:
+                    conn.connect()
+                except Exception:
+                    conn.close()
+                    raise
+                self._connectors[key] = conn
+            else:
+                # every job gets the motion it asks for, defaults for omitted keys
+                conn.set_motion(**{k: v for k, v in connection.items() if k not in CONNECTION_KEYS})
+            try:
+                return fn(conn, *args, **kwargs)
+            except OSError:
+                # transport trouble; reconnect on next use
+                self._connectors.pop(key, None)
+                conn.close()
+                raise
+
+    def status(self):
+        with self._lock:
+            keys = list(self._connectors)
+            busy = {key for key, lock in self._locks.items() if lock.locked()}
+        return [
+            {**dict(key), 'busy': key in busy, 'outstanding': len(self._connectors[key].outstanding)}
+            for key in keys
+        ]
+
+    def close(self, timeout=None):
+        with self._lock:
+            connectors = list(self._connectors.values())
+            self._connectors.clear()
+        for conn in connectors:
+            conn.close(timeout)
+
+
+class Daemon:
+    """Long-lived process keeping INDI connections open between CLI invocations.
+
+    Requests are dicts sent over a local authenticated socket:
+    {'job': name, 'connection': Connector kwargs, 'kwargs': job kwargs}, or
+    {'job': 'status'} / {'job': 'shutdown'}. Each client connection is served
+    in its own thread and gets back {'ok': bool, 'result' or 'error': ...}."""
+
+    def __init__(self, address=settings.DAEMON_ADDRESS, authkey=None, pool=None, jobs=JOBS):
+        self.authkey = authkey if authkey is not None else load_authkey(create=True)
+        self.pool = pool or ConnectionPool()
+        self.jobs = jobs
+        self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+        self._stopping = threading.Event()
+
+    def serve_forever(self):
+        logger.info(f'Daemon listening on {self.address}')
+        try:
+            while not self._stopping.is_set():
+                try:
+                    channel = self.listener.accept()
+                except OSError as e:
+                    if self._stopping.is_set():
+                        break
+                    logger.warning(f'Rejected connection: {e}')
+                    continue
+                threading.Thread(target=self.serve, args=(channel,), daemon=True).start()
+        finally:
+            self.listener.close()
+            self.pool.close()
+
+    def serve(self, channel):
+        with channel:
+            try:
+                request = channel.recv()
+            except EOFError:
+                return
+            channel.send(self.handle(request))
+
+        if request.get('job') == 'shutdown':
+            self.shutdown()
+
+    def handle(self, request):
+        job = request.get('job')
+        if job == 'status':
+            return {'ok': True, 'result': self.pool.status()}
+        if job == 'shutdown':
+            return {'ok': True, 'result': None}
+        if job not in self.jobs:
+            return {'ok': False, 'error': f'Unknown job: {job}'}
+
+        logger.info(f'Running {job} {request.get("kwargs", {})}')
+        try:
+            result = self.pool.run(request['connection'], self.jobs[job], **request.get('kwargs', {}))
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        return {'ok': True, 'result': result}
+
+    def shutdown(self):
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        # wake up the accept() call in serve_forever
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+
+class DaemonClient:
+    def __init__(self, address=settings.DAEMON_ADDRESS, authkey=None):
+        self.address = address
+        self.authkey = authkey if authkey is not None else load_authkey()
+
+    def request(self, **request):
+        try:
+            channel = Client(self.address, authkey=self.authkey)
+        except ConnectionRefusedError:
+            raise DaemonError(f'Daemon is not running on {self.address}')
+
+        with channel:
+            channel.send(request)
+            response = channel.recv()
+
+        if not response['ok']:
+            raise DaemonError(response['error'])
+        return response['result']
+
+    def submit(self, job, connection, **kwargs):
+        return self.request(job=job, connection=connection, kwargs=kwargs)
+
+    def status(self):
+        return self.request(job='status')
+
+    def shutdown(self):
+        return self.request(job='shutdown')
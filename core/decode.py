@@ -0,0 +1,180 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from PIL import Image as PILImage
+
+from core import instrument
+
+
+Region = namedtuple('Region', ['top', 'left', 'height', 'width'])
+
+# data: decoded single-channel array
+# offset: (row, col) of data[0, 0] in full resolution frame
+# scale: full resolution pixels per decoded pixel
+# shape: full resolution frame shape
+Frame = namedtuple('Frame', ['data', 'offset', 'scale', 'shape'])
+
+
+def central_region(shape, fraction):
+    """Returns a Region covering the central `fraction` of both frame dimensions"""
+    height = int(shape[0] * fraction)
+    width = int(shape[1] * fraction)
+    return Region((shape[0] - height) // 2, (shape[1] - width) // 2, height, width)
+
+
+def star_region(catalog, shape, size, min_stars=3, margin=None):
+    """Returns the `size` x `size` Region holding the most measured stars of `catalog`
+    (ties broken by total flux), or None when no window holds `min_stars`.
+
+    Candidate windows are centered on each star; a star counts when it lies at
+    least `margin` (by default twice its radius) inside the window, so it stays
+    fully inside while defocused."""
+    if len(catalog) == 0:
+        return None
+    height, width = min(size, shape[0]), min(size, shape[1])
+    positions = catalog.positions()
+    margin = 2 * catalog['radius'] if margin is None else np.full(len(catalog), margin)
+
+    tops = np.clip(np.round(positions[:, 0] - height / 2), 0, shape[0] - height)
+    lefts = np.clip(np.round(positions[:, 1] - width / 2), 0, shape[1] - width)
+
+    # inside[i, j]: star j lies within the window centered on star i
+    rows = positions[np.newaxis, :, 0] - tops[:, np.newaxis]
+    cols = positions[np.newaxis, :, 1] - lefts[:, np.newaxis]
+    inside = (
+        (rows >= margin) & (rows <= height - margin)
+        & (cols >= margin) & (cols <= width - margin)
+    )
+    counts = inside.sum(axis=1)
+    flux = (inside * catalog['flux']).sum(axis=1)
+
+    best = np.lexsort((flux, counts))[-1]
+    if counts[best] < min_stars:
+        return None
+    return Region(int(tops[best]), int(lefts[best]), height, width)
+
+
+def resolve_region(roi, shape):
+    if roi is None:
+        return None
+    if isinstance(roi, (int, float)):
+        return central_region(shape, roi)
+    roi = Region(*roi)
+    top = max(int(roi.top), 0)
+    left = max(int(roi.left), 0)
+    return Region(
+        top, left,
+        min(int(roi.height), shape[0] - top),
+        min(int(roi.width), shape[1] - left),
+    )
+
+
+def frame_shape(path):
+    """Returns (rows, cols) of an image file reading only its header"""
+    with PILImage.open(path) as img:
+        return img.size[1], img.size[0]
+
+
+def _to_dtype(arr, dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return arr.astype(dtype) / np.iinfo(arr.dtype).max if arr.dtype.kind in 'ui' else arr.astype(dtype)
+    if dtype == np.uint16 and arr.dtype == np.uint8:
+        return arr.astype(np.uint16) * 257
+    return arr.astype(dtype)
+
+
+@instrument.timed('decode')
+def decode(path, roi=None, reduce=1, dtype=np.float32):
+    """Decodes an image file straight to a single-channel array.
+
+    `roi` is a Region (or a central fraction of the frame) in full resolution
+    pixels; only that part of the frame is returned. `reduce` > 1 asks for a
+    reduced-resolution draft, which JPEG decodes via DCT scaling without ever
+    materializing the full-size frame."""
+    with PILImage.open(path) as img:
+        full_shape = (img.size[1], img.size[0])
+        region = resolve_region(roi, full_shape)
+
+        if reduce > 1 and img.format == 'JPEG':
+            img.draft('L', (img.size[0] // reduce, img.size[1] // reduce))
+
+        if img.mode in ('I;16', 'I;16B', 'I;16L', 'I'):
+            gray = img
+        else:
+            gray = img.convert('L')
+
+        scale = full_shape[1] / gray.size[0]
+        if reduce > 1 and scale < reduce:
+            factor = max(int(round(reduce / scale)), 1)
+            gray = gray.reduce(factor)
+            scale = full_shape[1] / gray.size[0]
+
+        offset = (0, 0)
+        if region is not None:
+            box = (
+                int(region.left / scale),
+                int(region.top / scale),
+                int(np.ceil((region.left + region.width) / scale)),
+                int(np.ceil((region.top + region.height) / scale)),
+            )
+            gray = gray.crop(box)
+            offset = (box[1] * scale, box[0] * scale)
+
+        data = np.asarray(gray)
+        if gray.mode == 'I':
+            data = data.clip(0, 65535).astype(np.uint16)
+        data = _to_dtype(data, dtype)
+
+    return Frame(data, offset, scale, full_shape)
+
+
+class FrameCache:
+    """Thread-safe LRU cache of decoded frames, bounded by total array size"""
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path, roi, reduce, dtype):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, roi, reduce, np.dtype(dtype).str)
+
+    def get(self, path, roi=None, reduce=1, dtype=np.float32):
+        roi = tuple(roi) if roi is not None and not isinstance(roi, (int, float)) else roi
+        key = self.key(path, roi, reduce, dtype)
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return self._frames[key]
+
+        frame = decode(path, roi=roi, reduce=reduce, dtype=dtype)
+        frame.data.flags.writeable = False
+
+        with self._lock:
+            if key not in self._frames and frame.data.nbytes <= self.max_bytes:
+                self._frames[key] = frame
+                self._bytes += frame.data.nbytes
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._frames.popitem(last=False)
+                    self._bytes -= evicted.data.nbytes
+        return frame
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._bytes = 0
+
+
+frame_cache = FrameCache()
+
+
+def load_gray(path, roi=None, reduce=1, dtype=np.float32, cache=True):
+    if cache:
+        return frame_cache.get(path, roi=roi, reduce=reduce, dtype=dtype)
+    return decode(path, roi=roi, reduce=reduce, dtype=dtype)
@@ -0,0 +1,109 @@
+import numpy as np
+from math import ceil
+from scipy import ndimage
+from skimage.feature import blob_log
+
+from core import instrument
+
+
+def detect_blob_log(image_arr, min_sigma=8):
+    """Reference detector: multi-scale Laplacian of Gaussian over the full frame"""
+    blobs = blob_log(image_arr, min_sigma=min_sigma)
+    return [(i[0], i[1], i[2] * 2) for i in blobs]
+
+
+def downsample(image_arr, factor):
+    """Block-averages an image by an integer factor, dropping incomplete edge blocks"""
+    if factor <= 1:
+        return image_arr
+    h = image_arr.shape[0] // factor
+    w = image_arr.shape[1] // factor
+    return image_arr[:h * factor, :w * factor].reshape(h, factor, w, factor).mean(axis=(1, 3))
+
+
+def background_map(image_arr, tile=32):
+    """Estimates a smooth sky background from medians of `tile`-sized tiles"""
+    h, w = image_arr.shape
+    ny = max(h // tile, 1)
+    nx = max(w // tile, 1)
+    th = h // ny
+    tw = w // nx
+    tiles = image_arr[:ny * th, :nx * tw].reshape(ny, th, nx, tw)
+    medians = np.median(tiles, axis=(1, 3))
+    background = ndimage.zoom(medians, (h / ny, w / nx), order=1, mode='nearest')
+    return np.pad(background, ((0, h - background.shape[0]), (0, w - background.shape[1])), mode='edge')[:h, :w]
+
+
+def detect_threshold(image_arr, min_sigma=8, downsample_factor=4, threshold=5.0, min_area=2, tile=32):
+    """Fast detector: threshold + connected components on a background-subtracted,
+    downsampled frame, refined at full resolution only around candidates"""
+    small = downsample(np.asarray(image_arr, dtype=np.float32), downsample_factor)
+    residual = small - background_map(small, tile=tile)
+    noise = 1.4826 * np.median(np.abs(residual - np.median(residual)))
+    if noise <= 0:
+        noise = residual.std()
+
+    labels, count = ndimage.label(residual > threshold * noise)
+    if count == 0:
+        return []
+
+    factor = max(downsample_factor, 1)
+    index = np.arange(1, count + 1)
+    areas = ndimage.sum_labels(np.ones_like(labels), labels, index)
+    peaks = ndimage.maximum_position(residual, labels, index)
+    slices = ndimage.find_objects(labels)
+
+    stars = []
+    for area, peak, sl in zip(areas, peaks, slices):
+        if area < min_area:
+            continue
+        extent = max(sl[0].stop - sl[0].start, sl[1].stop - sl[1].start) * factor
+        star = refine_candidate(
+            image_arr,
+            (peak[0] + 0.5) * factor - 0.5,
+            (peak[1] + 0.5) * factor - 0.5,
+            max(extent, 4 * min_sigma),
+            min_sigma,
+        )
+        if star is not None:
+            stars.append(star)
+    return stars
+
+
+def refine_candidate(image_arr, x, y, window, min_sigma):
+    """Returns (x, y, radius) from intensity moments in a full-resolution window"""
+    half = ceil(window / 2)
+    x0 = max(int(round(x)) - half, 0)
+    y0 = max(int(round(y)) - half, 0)
+    cutout = np.asarray(image_arr[x0:int(round(x)) + half + 1, y0:int(round(y)) + half + 1], dtype=np.float64)
+    if cutout.size == 0:
+        return None
+
+    weights = cutout - np.median(cutout)
+    weights[weights < 0] = 0
+    total = weights.sum()
+    if total <= 0:
+        return None
+
+    X, Y = np.indices(cutout.shape)
+    cx = (X * weights).sum() / total
+    cy = (Y * weights).sum() / total
+    sigma = np.sqrt((((X - cx) ** 2 + (Y - cy) ** 2) * weights).sum() / total / 2)
+
+    return x0 + cx, y0 + cy, max(sigma, min_sigma) * 2
+
+
+DETECTORS = {
+    'blob_log': detect_blob_log,
+    'threshold': detect_threshold,
+}
+
+
+@instrument.timed('detect')
+def detect_stars(image_arr, detector='blob_log', **kwargs):
+    """Returns a list of (x, y, radius) star candidates found by `detector`"""
+    try:
+        fn = DETECTORS[detector]
+    except KeyError:
+        raise ValueError(f'Unknown star detector: {detector}')
+    return fn(image_arr, **kwargs)
@@ -0,0 +1,123 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from concurrent import futures
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core import instrument
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class DownloadManager:
+    """Shares one pooled HTTP session between all image transfers.
+
+    Files are streamed to disk in chunks, failed transfers are retried with
+    exponential backoff and at most `max_queue` background transfers may be
+    outstanding; `submit` blocks until a slot frees up."""
+
+    RETRY_STATUS = (429, 500, 502, 503, 504,)
+
+    def __init__(self, max_workers=2, max_queue=8, retries=3, backoff=0.5, chunk_size=2 ** 20, timeout=30):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_queue)
+
+    def _retrying(self, fn, url):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn()
+            except (requests.ConnectionError, requests.Timeout, RetryableError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f'Transfer of {url} failed ({e}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    @instrument.timed('download')
+    def fetch(self, url, path):
+        """Streams `url` into `path`; the file only appears once it is complete"""
+        scheme = urlparse(url).scheme
+        tmp_path = f'{path}.part'
+
+        if scheme in ("file",):
+            shutil.copyfile(urlparse(url).path, tmp_path)
+            os.replace(tmp_path, path)
+            return path
+
+        if scheme not in ("http", "https",):
+            raise ValueError(f"Unsupprted URL scheme: {scheme}")
+
+        def attempt():
+            with self.session.get(url, stream=True, timeout=self.timeout) as r:
+                if r.status_code in self.RETRY_STATUS:
+                    raise RetryableError(f'HTTP {r.status_code}')
+                r.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+            os.replace(tmp_path, path)
+            return path
+
+        try:
+            return self._retrying(attempt, url)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @instrument.timed('delete')
+    def delete(self, url):
+        def attempt():
+            r = self.session.delete(url, timeout=self.timeout)
+            if r.status_code in self.RETRY_STATUS:
+                raise RetryableError(f'HTTP {r.status_code}')
+            r.raise_for_status()
+
+        self._retrying(attempt, url)
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+
+_default_manager = None
+_default_manager_lock = threading.Lock()
+
+
+def default_manager():
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            _default_manager = DownloadManager()
+        return _default_manager
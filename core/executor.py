@@ -0,0 +1,78 @@
+import os
+from concurrent import futures
+
+from core import instrument
+from core.value_object import MeasuredImage
+
+
+EXECUTOR_BACKENDS = ('threads', 'processes', 'inline',)
+
+
+class InlineExecutor(futures.Executor):
+    """Runs submitted calls immediately in the calling thread"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def make_executor(backend='threads', max_workers=4):
+    if backend == 'threads':
+        return futures.ThreadPoolExecutor(max_workers=max_workers)
+    if backend == 'processes':
+        return futures.ProcessPoolExecutor(max_workers=max_workers)
+    if backend == 'inline':
+        return InlineExecutor()
+    raise ValueError(f'Unknown executor backend: {backend}')
+
+
+def measure_catalog(image, measure_options, trace=False):
+    """Measures an already downloaded image and returns only its StarCatalog.
+    Used in worker processes so that full frames never cross process boundaries.
+
+    Spans recorded in a worker stay there, so with `trace` the result is
+    (catalog, spans) with span starts in time.time() seconds, ready for
+    instrument.merge in the parent."""
+    if not trace:
+        return MeasuredImage.from_image(image, measure=True, **measure_options).catalog
+
+    with instrument.recording() as recorder:
+        catalog = MeasuredImage.from_image(image, measure=True, **measure_options).catalog
+    spans = [
+        {**s, 'start': recorder.started + s['start'], 'process': os.getpid()}
+        for s in recorder.to_dict()['spans']
+    ]
+    return catalog, spans
+
+
+class MeasurementExecutors:
+    """Pair of executors for a sweep: one for downloads (always threads unless inline)
+    and an optional separate pool for measurements running in worker processes"""
+
+    def __init__(self, backend='threads', max_workers=4):
+        if backend not in EXECUTOR_BACKENDS:
+            raise ValueError(f'Unknown executor backend: {backend}')
+        self.backend = backend
+        self.max_workers = max_workers
+        self.io = None
+        self.measure = None
+
+    def __enter__(self):
+        if self.backend == 'inline':
+            self.io = InlineExecutor()
+        else:
+            self.io = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+        if self.backend == 'processes':
+            self.measure = futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        return self
+
+    def __exit__(self, *exc):
+        self.io.shutdown(wait=True)
+        if self.measure is not None:
+            self.measure.shutdown(wait=True)
+        return False
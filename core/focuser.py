@@ -0,0 +1,47 @@
+class FocuserMotion:
+    """Plans focuser moves so every position is approached from the same side.
+
+    `direction` is +1 to approach targets moving outwards (increasing
+    position) and -1 for inwards. A move against that direction overshoots
+    the target by `backlash` steps and comes back, so gear play is always
+    taken up the same way. `tolerance` is how close the reported position
+    must be to the target before the focuser counts as settled."""
+
+    def __init__(self, backlash=0, direction=1, tolerance=0.1):
+        if direction not in (1, -1):
+            raise ValueError('direction must be 1 or -1')
+        if backlash < 0:
+            raise ValueError('backlash must not be negative')
+        self.backlash = backlash
+        self.direction = direction
+        self.tolerance = tolerance
+
+    def settled(self, position, target):
+        return abs(float(position) - float(target)) <= self.tolerance
+
+    def moves(self, current, target):
+        """Positions to command, in order, to reach `target` from `current`"""
+        if current is not None and self.settled(current, target):
+            return []
+        against = current is None or (target - float(current)) * self.direction < 0
+        if against and self.backlash:
+            return [target - self.direction * self.backlash, target]
+        return [target]
+
+    def order(self, focus_points):
+        """Sweep order in the approach direction: only the first move may need
+        a backlash overshoot and the focuser never reverses in between"""
+        return sorted(focus_points, reverse=self.direction < 0)
+
+    def travel(self, current, focus_points):
+        """Total steps driven to visit `focus_points` in the given order"""
+        total = 0
+        for target in focus_points:
+            for position in self.moves(current, target):
+                if current is not None:
+                    total += abs(position - float(current))
+                current = position
+        return total
+
+    def __repr__(self):
+        return f'FocuserMotion backlash:{self.backlash} direction:{self.direction:+d} tolerance:{self.tolerance}'
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = 'focus-history.json'
+
+
+class FocusHistory:
+    """Persistent list of autofocus results.
+
+    Each record holds the focus position with its uncertainty, the fitted
+    V-curve (model, slopes, median level), a timestamp, the rig it was
+    measured on and the focuser temperature when known. Records are kept in
+    a JSON file in LOCAL_STORAGE, replaced atomically on every change.
+
+    Adding a record re-reads the file while holding a lock on `{path}.lock`,
+    so records added by other processes or instances in the meantime are
+    kept. Concurrent jobs of one process share the instance of `shared()`."""
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None, max_records=500):
+        self.path = path or os.path.join(settings.LOCAL_STORAGE, HISTORY_FILE)
+        self.max_records = max_records
+        self.records = self.load()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path=None):
+        """The one instance of this process for `path`"""
+        path = os.path.abspath(path or os.path.join(settings.LOCAL_STORAGE, HISTORY_FILE))
+        with cls._shared_lock:
+            if path not in cls._shared:
+                cls._shared[path] = cls(path)
+            return cls._shared[path]
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logger.warning(f'Ignoring unreadable focus history {self.path}')
+            return []
+
+    @contextmanager
+    def _locked(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with self._lock, open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp', dir=directory or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(self.records, indent=2))
+        os.replace(tmp_path, self.path)
+
+    def add(self, focus, stderr, model, slope_a, slope_b, level, temperature=None, rig=None, timestamp=None):
+        record = {
+            'timestamp': time.time() if timestamp is None else timestamp,
+            'rig': rig,
+            'temperature': temperature,
+            'focus': float(focus),
+            'stderr': float(stderr),
+            'model': model,
+            'slope_a': float(slope_a),
+            'slope_b': float(slope_b),
+            'level': float(level),
+        }
+        with self._locked():
+            self.records = (self.load() + [record])[-self.max_records:]
+            self.save()
+        return record
+
+    def add_fit(self, fit, **kwargs):
+        """Stores a VCurveFit result"""
+        return self.add(
+            fit.center, fit.center_stderr, fit.model, fit.slopes[0], fit.slopes[1], np.median(fit.levels),
+            **kwargs
+        )
+
+    def recent(self, rig=None, max_age=None, limit=None, now=None):
+        """Returns the newest records of a rig, newest first"""
+        now = time.time() if now is None else now
+        records = [
+            r for r in reversed(self.records)
+            if r.get('rig') == rig and (max_age is None or now - r['timestamp'] <= max_age)
+        ]
+        return records[:limit] if limit is not None else records
+
+    def __len__(self):
+        return len(self.records)
+
+
+class FocusPrediction:
+    def __init__(self, focus, uncertainty, slope_a, slope_b, level, model, temperature=None):
+        self.focus = focus
+        self.uncertainty = uncertainty
+        self.slope_a = slope_a
+        self.slope_b = slope_b
+        self.level = level
+        self.model = model
+        self.temperature = temperature
+
+    @property
+    def bottom_width(self):
+        """Distance from the center at which the V-curve reaches twice the minimum FWHM,
+        infinite when a slope is flat"""
+        slope = min(abs(self.slope_a), abs(self.slope_b))
+        return self.level / slope if slope > 0 else np.inf
+
+    def __repr__(self):
+        return f'FocusPrediction focus:{self.focus:.1f} +/- {self.uncertainty:.1f}'
+
+
+class FocusPredictor:
+    """Predicts the focus position from recent history.
+
+    With temperatures for at least `min_temperature_records` recent runs the
+    prediction follows a linear fit of focus against temperature; otherwise it
+    is the latest focus, with the RMS change between recent runs as uncertainty.
+    Slopes and level come from the medians of recent fits of the same model."""
+
+    def __init__(self, history, max_age=30 * 24 * 3600, window=20, min_temperature_records=3, min_uncertainty=1.0):
+        self.history = history
+        self.max_age = max_age
+        self.window = window
+        self.min_temperature_records = min_temperature_records
+        self.min_uncertainty = min_uncertainty
+
+    def predict(self, temperature=None, rig=None, now=None):
+        records = self.history.recent(rig=rig, max_age=self.max_age, limit=self.window, now=now)
+        if not records:
+            return None
+
+        latest = records[0]
+        same_model = [r for r in records if r['model'] == latest['model']]
+        focus = np.array([r['focus'] for r in records])
+
+        thermal = [r for r in records if r.get('temperature') is not None]
+        temps = np.array([r['temperature'] for r in thermal], dtype=float)
+        if (
+            temperature is not None
+            and len(thermal) >= self.min_temperature_records
+            and np.ptp(temps) > 0
+        ):
+            thermal_focus = np.array([r['focus'] for r in thermal])
+            coef = np.polyfit(temps, thermal_focus, 1)
+            predicted = np.polyval(coef, temperature)
+            residual = thermal_focus - np.polyval(coef, temps)
+            uncertainty = np.sqrt(np.sum(residual ** 2) / max(len(thermal) - 2, 1))
+        else:
+            predicted = latest['focus']
+            # typical change between consecutive runs
+            uncertainty = np.sqrt(np.mean(np.diff(focus) ** 2)) if len(focus) > 1 else 0.0
+
+        uncertainty = max(uncertainty, latest['stderr'], self.min_uncertainty)
+
+        return FocusPrediction(
+            focus=float(predicted),
+            uncertainty=float(uncertainty),
+            slope_a=float(np.median([r['slope_a'] for r in same_model])),
+            slope_b=float(np.median([r['slope_b'] for r in same_model])),
+            level=float(np.median([r['level'] for r in same_model])),
+            model=latest['model'],
+            temperature=temperature,
+        )
+
+    @staticmethod
+    def sweep_range(prediction, min_focus, max_focus, steps, sigmas=3):
+        """Narrows a sweep to the predicted focus +/- `sigmas` uncertainties, but never
+        narrower than 1.5 bottom widths on either side, so both slopes are still sampled.
+        Keeps the step size."""
+        if not np.isfinite(prediction.bottom_width):
+            return min_focus, max_focus, steps
+        half_span = max(sigmas * prediction.uncertainty, 1.5 * prediction.bottom_width)
+        low = int(max(min_focus, prediction.focus - half_span))
+        high = int(min(max_focus, prediction.focus + half_span))
+        if high <= low:
+            return min_focus, max_focus, steps
+
+        step = (max_focus - min_focus) / steps
+        return low, high, max(4, int(round((high - low) / step)))
@@ -0,0 +1,216 @@
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+
+class Span:
+    __slots__ = ('recorder', 'name', 'attrs', 'start', 'duration')
+
+    enabled = True
+
+    def __init__(self, recorder, name, attrs):
+        self.recorder = recorder
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = time.perf_counter() - self.start
+        self.recorder.add(self.name, self.start, self.duration, self.attrs)
+        return False
+
+
+class NullSpan:
+    """Stand-in returned while instrumentation is disabled"""
+    __slots__ = ()
+
+    enabled = False
+    duration = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = NullSpan()
+
+
+class Recorder:
+    """Collects spans from all threads of a run"""
+
+    FIELDS = ('name', 'start', 'duration', 'thread',)
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.started = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration, attrs=None):
+        record = {
+            'name': name,
+            'start': start - self.origin,
+            'duration': duration,
+            'thread': threading.current_thread().name,
+            **(attrs or {}),
+        }
+        with self._lock:
+            self.spans.append(record)
+
+    def to_dict(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {'started': self.started, 'spans': spans}
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            f.write(json.dumps(self.to_dict(), indent=2, default=str))
+        return path
+
+    def write_csv(self, path):
+        spans = self.to_dict()['spans']
+        extra = sorted({k for s in spans for k in s} - set(self.FIELDS))
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.FIELDS) + extra)
+            writer.writeheader()
+            writer.writerows(spans)
+        return path
+
+    def write(self, path):
+        """Writes CSV for a .csv path and JSON otherwise"""
+        if path.endswith('.csv'):
+            return self.write_csv(path)
+        return self.write_json(path)
+
+    def summary(self):
+        return summarize(self.to_dict()['spans'])
+
+
+_recorder = None
+
+
+def span(name, **attrs):
+    """Times a block as `name` when a recorder is active:
+
+        with instrument.span('download', url=url):
+            ...
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_SPAN
+    return Span(recorder, name, attrs)
+
+
+def record(name, duration, **attrs):
+    """Adds a span measured elsewhere, ending now"""
+    recorder = _recorder
+    if recorder is not None:
+        recorder.add(name, time.perf_counter() - duration, duration, attrs)
+
+
+def merge(spans, **attrs):
+    """Adds spans recorded in another process, with `start` in time.time() seconds"""
+    recorder = _recorder
+    if recorder is None:
+        return
+    offset = time.perf_counter() - time.time()
+    for s in spans:
+        extra = {k: v for k, v in s.items() if k not in Recorder.FIELDS}
+        recorder.add(s['name'], s['start'] + offset, s['duration'], {**extra, **attrs})
+
+
+def timed(name):
+    """Decorator form of span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(recorder=None):
+    global _recorder
+    _recorder = recorder or Recorder()
+    return _recorder
+
+
+def disable():
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def active():
+    return _recorder
+
+
+@contextmanager
+def recording(path=None):
+    """Records spans for the duration of the block and writes them to `path` if given"""
+    previous = _recorder
+    recorder = enable()
+    try:
+        yield recorder
+    finally:
+        if previous is not None:
+            enable(previous)
+        else:
+            disable()
+        if path:
+            recorder.write(path)
+
+
+def summarize(spans):
+    """Aggregates spans by name: count, total, mean, median, p95 and max seconds"""
+    durations = {}
+    for s in spans:
+        durations.setdefault(s['name'], []).append(float(s['duration']))
+
+    result = {}
+    for name, values in sorted(durations.items()):
+        values = np.array(values)
+        result[name] = {
+            'count': len(values),
+            'total': float(values.sum()),
+            'mean': float(values.mean()),
+            'median': float(np.median(values)),
+            'p95': float(np.percentile(values, 95)),
+            'max': float(values.max()),
+        }
+    return result
+
+
+def load_spans(path):
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            return list(csv.DictReader(f))
+    with open(path) as f:
+        return json.load(f)['spans']
+
+
+def aggregate(paths):
+    """Summary over the spans of several recorded runs"""
+    return summarize([s for path in paths for s in load_spans(path)])
+
+
+def format_summary(summary):
+    lines = ['{:<20} {:>6} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'span', 'count', 'total', 'mean', 'median', 'p95', 'max')]
+    for name, s in summary.items():
+        lines.append('{:<20} {:>6} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            name, s['count'], s['total'], s['mean'], s['median'], s['p95'], s['max']))
+    return '\n'.join(lines)
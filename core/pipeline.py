@@ -0,0 +1,79 @@
+import threading
+import logging
+
+from core import instrument
+from core.value_object import MeasuredImage
+from core.executor import measure_catalog
+
+
+logger = logging.getLogger(__name__)
+
+
+class SweepPipeline:
+    """Downloads and measures sweep frames in the background.
+
+    While frame N is being downloaded and measured by the executor the caller
+    is free to move the focuser and expose frame N+1. At most `max_in_flight`
+    frames are processed at once; `submit` blocks when that limit is reached.
+    """
+
+    def __init__(self, executor, max_in_flight=2, measure_options=None, keep_frames=True, measure_executor=None):
+        self.executor = executor
+        self.measure_executor = measure_executor
+        self.max_in_flight = max_in_flight
+        self.measure_options = measure_options or {}
+        self.keep_frames = keep_frames
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._futures = []
+        self._drained = 0
+
+    def submit(self, image, focus):
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(
+                self.process, image, focus, self.measure_options, self.keep_frames, self.measure_executor,
+            )
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        image.measure_future = future
+        self._futures.append(future)
+        return future
+
+    @staticmethod
+    def process(image, focus, measure_options, keep_frame=True, measure_executor=None):
+        image.wait_downloaded()
+
+        if measure_executor is not None:
+            trace = instrument.active() is not None
+            catalog = measure_executor.submit(measure_catalog, image, measure_options, trace).result()
+            if trace:
+                catalog, spans = catalog
+                instrument.merge(spans)
+            measured_image = MeasuredImage.from_catalog(image, catalog, **measure_options)
+            measured_image.focus = focus
+            return measured_image
+
+        measured_image = MeasuredImage.from_image(image, measure=False, **measure_options)
+        measured_image.focus = focus
+        measured_image.measure()
+        if not keep_frame:
+            measured_image.release_frame()
+        return measured_image
+
+    def results(self):
+        return [f.result() for f in self._futures]
+
+    def drain(self, wait=False):
+        """Returns frames finished since the last call, in submission order.
+        With `wait` blocks until every submitted frame is done."""
+        result = []
+        while self._drained < len(self._futures):
+            future = self._futures[self._drained]
+            if not wait and not future.done():
+                break
+            result.append(future.result())
+            self._drained += 1
+        return result
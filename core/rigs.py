@@ -0,0 +1,147 @@
+import logging
+import threading
+from concurrent import futures
+
+import settings
+from core.client import Connector
+from core.daemon import JOBS
+from core.executor import MeasurementExecutors
+
+
+logger = logging.getLogger(__name__)
+
+
+class Rig:
+    """One camera + focuser (+ optional PHD2) on an INDI server.
+
+    `autofocus` and `timelapse` hold per-rig job parameters, e.g. the focus
+    range of this scope; they take precedence over the caller's parameters.
+    `backlash`, `focus_direction` and `focus_tolerance` configure the
+    focuser motion of the rig's Connector."""
+
+    def __init__(self, name, ip='127.0.0.1', port=7624, camera_name=None, focuser_name=None, phd2_name=None,
+                 autofocus=None, timelapse=None, backlash=0, focus_direction=1, focus_tolerance=0.1):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.camera_name = camera_name
+        self.focuser_name = focuser_name
+        self.phd2_name = phd2_name
+        self.backlash = backlash
+        self.focus_direction = focus_direction
+        self.focus_tolerance = focus_tolerance
+        self.job_options = {
+            'autofocus': autofocus or {},
+            'timelapse': timelapse or {},
+        }
+
+    @property
+    def connection(self):
+        return {
+            'ip': self.ip,
+            'port': self.port,
+            'camera_name': self.camera_name,
+            'focuser_name': self.focuser_name,
+            'phd2_name': self.phd2_name,
+            'backlash': self.backlash,
+            'focus_direction': self.focus_direction,
+            'focus_tolerance': self.focus_tolerance,
+        }
+
+    def options(self, job, kwargs):
+        return {**kwargs, **self.job_options.get(job, {})}
+
+    @classmethod
+    def from_settings(cls, names=None):
+        """Rigs from settings.RIGS, all of them or the given names in order"""
+        names = list(settings.RIGS) if names is None else names
+        unknown = [n for n in names if n not in settings.RIGS]
+        if unknown:
+            raise ValueError('Unknown rigs: {}'.format(', '.join(unknown)))
+        return [cls(name, **settings.RIGS[name]) for name in names]
+
+    def __repr__(self):
+        return f'Rig {self.name} ({self.camera_name} + {self.focuser_name} @ {self.ip}:{self.port})'
+
+
+class RigScheduler:
+    """Runs jobs for several rigs from one process.
+
+    Every rig has its own single worker thread, so its jobs run one after
+    another in submission order while rigs proceed concurrently. Connections
+    are opened once per rig on first use. Downloads go through the shared
+    download manager and autofocus measurement through one shared pair of
+    measurement executors."""
+
+    def __init__(self, rigs, executor='threads', max_workers=4, connector_factory=Connector, jobs=JOBS):
+        self.rigs = {rig.name: rig for rig in rigs}
+        self.connector_factory = connector_factory
+        self.jobs = jobs
+        self.executors = MeasurementExecutors(executor, max_workers)
+        self._workers = {
+            name: futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'rig-{name}')
+            for name in self.rigs
+        }
+        self._connectors = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.executors.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def connector(self, name):
+        """Connected Connector of a rig; only called from the rig's own worker"""
+        with self._lock:
+            conn = self._connectors.get(name)
+        if conn is None:
+            rig = self.rigs[name]
+            logger.info(f'Connecting {rig}')
+            conn = self.connector_factory(**rig.connection)
+            conn.connect()
+            with self._lock:
+                self._connectors[name] = conn
+        return conn
+
+    def run_job(self, name, job, kwargs):
+        conn = self.connector(name)
+        if job == 'autofocus':
+            kwargs = {'executors': self.executors, 'prefix': f'{name}-autofocus', **kwargs}
+        elif 'prefix' in kwargs:
+            kwargs = {**kwargs, 'prefix': f'{name}-{kwargs["prefix"]}'}
+        logger.info(f'{name}: running {job}')
+        return self.jobs[job](conn, **kwargs)
+
+    def submit(self, name, job, **kwargs):
+        if name not in self.rigs:
+            raise ValueError(f'Unknown rig: {name}')
+        if job not in self.jobs:
+            raise ValueError(f'Unknown job: {job}')
+        return self._workers[name].submit(self.run_job, name, job, self.rigs[name].options(job, kwargs))
+
+    def run(self, plan):
+        """Submits (rig name, job, kwargs) entries and waits for all of them.
+        Returns results in plan order; a failed job yields its exception and
+        does not stop later jobs of the same rig."""
+        submitted = [self.submit(name, job, **kwargs) for name, job, kwargs in plan]
+        futures.wait(submitted)
+        results = []
+        for (name, job, _), future in zip(plan, submitted):
+            e = future.exception()
+            if e is not None:
+                logger.error(f'{name}: {job} failed: {e}')
+            results.append(e if e is not None else future.result())
+        return results
+
+    def close(self, timeout=None):
+        for worker in self._workers.values():
+            worker.shutdown(wait=True)
+        self.executors.__exit__(None, None, None)
+        with self._lock:
+            connectors = list(self._connectors.values())
+            self._connectors.clear()
+        for conn in connectors:
+            conn.close(timeout)
@@ -0,0 +1,174 @@
+import logging
+from time import monotonic
+from concurrent import futures
+
+from core import instrument
+
+
+logger = logging.getLogger(__name__)
+
+
+class FrameTiming:
+    __slots__ = ('number', 'exposure', 'wall', 'shutter', 'backlog_wait', 'dither', 'dithered', 'download_errors')
+
+    def __init__(self, number, exposure, wall, shutter, backlog_wait, dither, dithered, download_errors=None):
+        self.number = number
+        self.exposure = exposure
+        self.wall = wall
+        self.shutter = shutter
+        self.backlog_wait = backlog_wait
+        self.dither = dither
+        self.dithered = dithered
+        # filled in as this frame's downloads finish, possibly after later frames
+        self.download_errors = download_errors if download_errors is not None else []
+
+    @property
+    def duty_cycle(self):
+        return self.exposure / self.wall if self.wall > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'number': self.number,
+            'exposure': self.exposure,
+            'wall': self.wall,
+            'shutter': self.shutter,
+            'backlog_wait': self.backlog_wait,
+            'dither': self.dither,
+            'dithered': self.dithered,
+            'duty_cycle': self.duty_cycle,
+            'download_errors': list(self.download_errors),
+        }
+
+    def __repr__(self):
+        return (
+            f'Frame #{self.number} wall:{self.wall:.1f}s shutter:{self.shutter:.1f}s '
+            f'dither:{self.dither:.1f}s duty:{self.duty_cycle:.1%}'
+        )
+
+
+class TimelapseReport:
+    def __init__(self, frames):
+        self.frames = frames
+
+    @property
+    def exposure(self):
+        return sum(f.exposure for f in self.frames)
+
+    @property
+    def wall(self):
+        return sum(f.wall for f in self.frames)
+
+    @property
+    def duty_cycle(self):
+        return self.exposure / self.wall if self.wall > 0 else 0.0
+
+    @property
+    def failed_downloads(self):
+        return sum(len(f.download_errors) for f in self.frames)
+
+    def to_dict(self):
+        return {
+            'frames': [f.to_dict() for f in self.frames],
+            'exposure': self.exposure,
+            'wall': self.wall,
+            'duty_cycle': self.duty_cycle,
+            'failed_downloads': self.failed_downloads,
+        }
+
+
+class Timelapse:
+    """Runs a series of exposures keeping the shutter open as much as possible.
+
+    While the camera exposes, the scheduler waits for the download backlog to
+    drop below `max_pending` frames, so slow transfers only stall a frame when
+    they fall that far behind. Downloads of a finished frame run during the
+    dither/settle and the next exposure. Dithering happens after every
+    `dither_every` frames and never after the last one. Failed downloads are
+    logged and recorded in the frame's `download_errors`."""
+
+    def __init__(self, connector, time=60, dither=5, dither_every=1, max_pending=2, prefix='light'):
+        if dither_every < 1:
+            raise ValueError('dither_every must be at least 1')
+        if max_pending < 1:
+            raise ValueError('max_pending must be at least 1')
+        self.connector = connector
+        self.time = time
+        self.dither = dither
+        self.dither_every = dither_every
+        self.max_pending = max_pending
+        self.prefix = prefix
+        self.frames = []
+        self.images = []
+        self._backlog = []
+
+    def should_dither(self, number, count):
+        return bool(self.dither) and number < count and number % self.dither_every == 0
+
+    def collect_backlog(self):
+        """Drops finished downloads from the backlog, recording failures with their frame"""
+        pending = []
+        for number, errors, future in self._backlog:
+            if not future.done():
+                pending.append((number, errors, future))
+            elif future.exception() is not None:
+                logger.error(f'Download for frame #{number} failed: {future.exception()}')
+                errors.append(str(future.exception()))
+        self._backlog = pending
+
+    def wait_backlog(self, limit):
+        self.collect_backlog()
+        while len(self._backlog) > limit:
+            futures.wait([f for _, _, f in self._backlog], return_when=futures.FIRST_COMPLETED)
+            self.collect_backlog()
+
+    def run(self, count):
+        with futures.ThreadPoolExecutor(max_workers=1) as shutter:
+            for i in range(count):
+                self.frames.append(self.frame(i + 1, count, shutter))
+
+        self.wait_backlog(0)
+        report = TimelapseReport(self.frames)
+        logger.info(
+            f'Timelapse done: {len(self.frames)} frames, {report.exposure:.0f}s exposure '
+            f'in {report.wall:.0f}s, duty cycle {report.duty_cycle:.1%}'
+        )
+        if report.failed_downloads:
+            logger.warning(f'{report.failed_downloads} downloads failed')
+        return report
+
+    @instrument.timed('timelapse.frame')
+    def frame(self, number, count, shutter):
+        logger.info(f"Exposure #{number} of {count}")
+        start = monotonic()
+
+        exposure = shutter.submit(self.connector.exposure, self.time)
+
+        # each frame has two downloads; leave room for the one being exposed
+        self.wait_backlog(2 * (self.max_pending - 1))
+        backlog_wait = monotonic() - start
+
+        url, raw_url = exposure.result()
+        exposed = monotonic()
+
+        images = self.connector.download_exposure(url, raw_url, prefix=self.prefix)
+        self.images.append(images)
+        download_errors = []
+        self._backlog.extend((number, download_errors, img.download_future) for img in images)
+
+        dithered = self.should_dither(number, count)
+        if dithered:
+            self.connector.dither(self.dither)
+        end = monotonic()
+
+        timing = FrameTiming(
+            number,
+            exposure=self.time,
+            wall=end - start,
+            shutter=exposed - start,
+            backlog_wait=backlog_wait,
+            dither=end - exposed,
+            dithered=dithered,
+            download_errors=download_errors,
+        )
+        logger.info(repr(timing))
+        return timing
@@ -1,11 +1,14 @@
-import requests
+import numpy as np
 import settings
 import os
 import json
 from core import alg
-from skimage.feature import blob_log
+from core import instrument
+from core.detect import detect_stars
+from core.catalog import StarCatalog
+from core.decode import load_gray, frame_shape
+from core.download import default_manager
 from skimage.color import rgb2gray
-from skimage import io
 from math import ceil, floor
 from urllib.parse import urlparse
 
@@ -16,6 +19,8 @@ class Image:
         self.image_file = image_file
         self.meta = meta if meta is not None else {}
         self.prefix = prefix
+        self.download_future = None
+        self.measure_future = None
 
         if image_file is not None:
             try:
@@ -23,27 +28,52 @@ class Image:
             except:
                 pass
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['download_future'] = None
+        state['measure_future'] = None
+        return state
+
     def is_downloaded(self):
         return self.image_file is not None
 
-    def download_image(self):
-        url = self.source_url
-        scheme = urlparse(url).scheme
+    def is_remote(self):
+        return urlparse(self.source_url).scheme in ("http", "https",)
 
-        if scheme in ("http", "https", "ftp"):
-            r = requests.get(url).scheme
-            r.raise_for_status()
-            image = r.content
-            print(f'Downloaded {url}')
-        elif scheme in ("file",):
-            file_path = urlparse(url).path
-            with open(file_path, "rb") as f:
-                image = f.read()
-            print(f'Read {url}')
-        else:
-            raise ValueError(f"Unsupprted URL scheme: {scheme}")
+    def fetch(self, manager=None):
+        """Downloads the image and removes the remote copy when it lives on the camera host"""
+        self.download_image(manager)
+        if self.is_remote():
+            self.delete_remote_image(manager)
+        return self
 
-        filename = os.path.basename(url)
+    def fetch_async(self, manager=None):
+        manager = manager or default_manager()
+        self.download_future = manager.submit(self.fetch, manager)
+        return self.download_future
+
+    def wait_downloaded(self, timeout=None):
+        """Blocks until a background download finishes; downloads in place if none was started"""
+        if self.download_future is not None:
+            self.download_future.result(timeout)
+        elif not self.is_downloaded():
+            self.fetch()
+        return self
+
+    def is_measured(self):
+        return self.measure_future is not None and self.measure_future.done()
+
+    def wait_measured(self, timeout=None):
+        """Returns the MeasuredImage once whoever measures the image is done with it"""
+        if self.measure_future is None:
+            raise ValueError('Image measurement was not scheduled')
+        return self.measure_future.result(timeout)
+
+    def download_image(self, manager=None):
+        manager = manager or default_manager()
+        url = self.source_url
+
+        filename = os.path.basename(urlparse(url).path)
 
         if self.prefix:
             filename = f"{self.prefix}-{filename}"
@@ -52,10 +82,10 @@ class Image:
         dir = os.path.dirname(path)
 
         if not os.path.exists(dir):
-            os.mkdir(dir)
+            os.makedirs(dir, exist_ok=True)
 
-        with open(path, 'wb') as f:
-            f.write(image)
+        manager.fetch(url, path)
+        print(f'Downloaded {url}')
 
         self.image_file = path
 
@@ -63,15 +93,16 @@ class Image:
         self.meta['filename'] = filename
         self.write_meta()
 
-    def delete_remote_image(self):
+    def delete_remote_image(self, manager=None):
+        manager = manager or default_manager()
         url = self.source_url
         scheme = urlparse(url).scheme
 
         if scheme in ("http", "https",):
-            requests.delete(url)
+            manager.delete(url)
         else:
             raise ValueError(f"Unsupprted URL scheme: {scheme}")
-        
+
         print(f'Deleted {url}')
 
     def write_meta(self):
@@ -91,31 +122,113 @@ class Image:
 
 
 class StarArea:
-    def __init__(self, image_arr, x, y, radius):
+    def __init__(self, image_arr, x, y, radius, fwhm=None, flux=None, profile='gaussian', background=False):
         self.x = x
         self.y = y
         self.radius = radius
         self.image_arr = image_arr
-        gauss = alg.two_dimensional_gaussian_fit(self.star_arr)
-        self.fwhm = gauss[3]
+        if fwhm is None:
+            params = alg.fit_star_profiles(self.star_arr[np.newaxis], profile=profile, background=background)
+            fwhm = alg.profile_width(params, profile)[0]
+            flux = alg.profile_flux(params, profile)[0]
+        self.fwhm = fwhm
+        self.flux = flux
 
     @property
     def star_arr(self):
+        if self.image_arr is None:
+            raise ValueError('Image frame was released')
         return self.image_arr[
-                floor(self.x - self.radius):ceil(self.x + self.radius),
-                floor(self.y - self.radius):ceil(self.y + self.radius),
+                max(floor(self.x - self.radius), 0):ceil(self.x + self.radius),
+                max(floor(self.y - self.radius), 0):ceil(self.y + self.radius),
             ]
 
+    @classmethod
+    @instrument.timed('fit')
+    def fit_all(cls, image_arr, blobs, profile='gaussian', background=False):
+        """Creates StarAreas for (x, y, radius) blobs, fitting equally-sized cutouts in batches"""
+        areas = [cls(image_arr, x, y, radius, fwhm=0, flux=0) for x, y, radius in blobs]
+
+        by_shape = {}
+        for area in areas:
+            by_shape.setdefault(area.star_arr.shape, []).append(area)
+
+        for shape, group in by_shape.items():
+            if 0 in shape:
+                continue
+            cutouts = np.stack([area.star_arr for area in group])
+            params = alg.fit_star_profiles(cutouts, profile=profile, background=background)
+            widths = alg.profile_width(params, profile)
+            fluxes = alg.profile_flux(params, profile)
+            for area, width, flux in zip(group, widths, fluxes):
+                area.fwhm = width
+                area.flux = flux
+
+        return [area for area in areas if 0 not in area.star_arr.shape]
+
     def __repr__(self):
         return f'Star x:{self.x} y:{self.y} r:{self.radius} fwhm:{self.fwhm}'
 
 
 class MeasuredImage:
-    def __init__(self, image):
+    def __init__(self, image, detector='blob_log', profile='gaussian', background=False,
+                 roi=None, reduce=1, dtype=np.float32, cache_frames=False, cache=None):
         self.image = image
-        loaded_img_arr = io.imread(image.image_file)
-        self.image_arr = self.to_gray(loaded_img_arr)
+        self.detector = detector
+        self.profile = profile
+        self.background = background
+        self.roi = roi
+        self.reduce = reduce
+        self.dtype = dtype
+        self.cache_frames = cache_frames
+        self.cache = cache
+        self.shape = frame_shape(image.image_file)
+        self.origin = (0, 0)
+        subframe = image.meta.get('subframe')
+        if subframe is not None and self.shape == tuple(subframe['region'][2:]):
+            # cropped by the camera: place stars on the whole frame and skip client-side cropping
+            self.origin = tuple(subframe['region'][:2])
+            self.shape = tuple(subframe['shape'])
+            self.roi = None
         self.stars = []
+        self.catalog = StarCatalog()
+        self._frame = None
+        self._frame_released = False
+
+    @property
+    def frame(self):
+        if self._frame is None and not self._frame_released:
+            self._frame = load_gray(
+                self.image.image_file,
+                roi=self.roi,
+                reduce=self.reduce,
+                dtype=self.dtype,
+                cache=self.cache_frames,
+            )
+        return self._frame
+
+    @property
+    def image_arr(self):
+        return self.frame.data if self.frame is not None else None
+
+    @property
+    def offset(self):
+        return self.frame.offset[0] + self.origin[0], self.frame.offset[1] + self.origin[1]
+
+    @property
+    def scale(self):
+        return self.frame.scale
+
+    @property
+    def measure_params(self):
+        return {
+            'detector': self.detector,
+            'profile': self.profile,
+            'background': self.background,
+            'roi': self.roi,
+            'reduce': self.reduce,
+            'dtype': np.dtype(self.dtype).str,
+        }
 
     @staticmethod
     def to_gray(image_arr):
@@ -128,23 +241,65 @@ class MeasuredImage:
         raise Exception(f'Do not know how to convert image of shape {image_arr.shape} to grayscale')
 
     @classmethod
-    def from_image(cls, image, measure=True):
-        img = cls(image)
+    def from_image(cls, image, measure=True, **kwargs):
+        img = cls(image, **kwargs)
         if measure:
             img.measure()
         return img
 
+    @classmethod
+    def from_catalog(cls, image, catalog, **kwargs):
+        """Creates an already measured image from a catalog, without decoding the frame"""
+        img = cls(image, **kwargs)
+        img.catalog = catalog
+        img.release_frame()
+        return img
+
     def find_stars(self):
-        blobs = blob_log(self.image_arr, min_sigma=8)
-        return [
-            StarArea(self.image_arr, i[0], i[1], i[2] * 2)
-            for i in blobs
-        ]
+        return StarArea.fit_all(
+            self.image_arr,
+            detect_stars(self.image_arr, self.detector),
+            profile=self.profile,
+            background=self.background,
+        )
 
+    @instrument.timed('measure')
     def measure(self):
+        focus = self.image.meta.get('focus', np.nan)
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(self.image.image_file, self.measure_params)
+            catalog = self.cache.load(self.image.image_file, cache_key)
+            if catalog is not None:
+                self.catalog = catalog.with_frame(focus=focus)
+                print(self)
+                return
+
         self.stars = self.find_stars()
+        self.catalog = StarCatalog.from_star_areas(
+            self.stars,
+            focus=focus,
+            offset=self.offset,
+            scale=self.scale,
+        )
+
+        if cache_key is not None:
+            self.cache.store(self.image.image_file, cache_key, self.catalog)
+
         print(self)
 
+    def release_frame(self):
+        """Drops the decoded frame; measured stars and the catalog are kept"""
+        self._frame = None
+        self._frame_released = True
+        for s in self.stars:
+            s.image_arr = None
+
+    @property
+    def frame_released(self):
+        return self._frame_released
+
     def __repr__(self):
         if self.image.meta and 'focus' in self.image.meta:
             focus = self.image.meta['focus']
@@ -152,13 +307,13 @@ class MeasuredImage:
         else:
             meta = '(no meta)'
 
-        if self.stars:
-            cnt = len(self.stars)
+        if len(self.catalog):
+            cnt = len(self.catalog)
             stars = f'({cnt} stars)\n' + '\n'.join([
-                f'  - Star ({s.x},{s.y}):\n'
-                f'      Radius: {s.radius}\n'
-                f'      FWHM: {s.fwhm}'
-                for s in self.stars
+                f'  - Star ({s["x"]},{s["y"]}):\n'
+                f'      Radius: {s["radius"]}\n'
+                f'      FWHM: {s["fwhm"]}'
+                for s in self.catalog
             ])
         else:
             stars = '(no stars)'
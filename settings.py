@@ -21,3 +21,26 @@ FOCUSERS = [
     'NODE_FOCUSER',
     'FOCUSER_SIMULATOR',
 ]
+
+DAEMON_ADDRESS = ('127.0.0.1', 7625)
+# without it the daemon generates a random key in LOCAL_STORAGE/daemon.key (mode 0600)
+DAEMON_AUTHKEY = os.environ.get('TELESCOPY_DAEMON_AUTHKEY', '').encode() or None
+
+# rigs driven together by `cli.py rigs`; 'autofocus' and 'timelapse' override job parameters per rig
+RIGS = {
+    'main': {
+        'ip': SERVER_IP,
+        'port': SERVER_PORT,
+        'camera_name': CAMERAS[0],
+        'focuser_name': FOCUSERS[0],
+        'phd2_name': 'PHD2',
+    },
+    'simulator': {
+        'ip': SERVER_IP,
+        'port': SERVER_PORT,
+        'camera_name': CAMERAS[1],
+        'focuser_name': FOCUSERS[1],
+        'phd2_name': None,
+        'timelapse': {'dither': 0},
+    },
+}
@@ -0,0 +1,71 @@
+import os
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+class ImageRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files of a directory over GET and removes them on DELETE,
+    like the image host of the INDI camera drivers"""
+
+    def __init__(self, *args, server_state=None, **kwargs):
+        self.server_state = server_state
+        super().__init__(*args, **kwargs)
+
+    def fail_if_requested(self):
+        with self.server_state['lock']:
+            self.server_state['requests'].append((self.command, self.path))
+            if self.server_state['failures'] > 0:
+                self.server_state['failures'] -= 1
+                self.send_error(503)
+                return True
+        return False
+
+    def do_GET(self):
+        if not self.fail_if_requested():
+            super().do_GET()
+
+    def do_DELETE(self):
+        if self.fail_if_requested():
+            return
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        os.remove(path)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageHTTPServer:
+    """Local HTTP image host running in a background thread"""
+
+    def __init__(self, directory, failures=0):
+        self.directory = directory
+        self.state = {'lock': threading.Lock(), 'failures': failures, 'requests': []}
+        handler = partial(ImageRequestHandler, directory=directory, server_state=self.state)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def url(self, filename):
+        return f'http://127.0.0.1:{self.port}/{filename}'
+
+    @property
+    def requests(self):
+        return list(self.state['requests'])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return False
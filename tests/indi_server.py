@@ -0,0 +1,358 @@
+import os
+import shutil
+import socketserver
+import threading
+import time
+import datetime
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+from PIL import Image as PILImage
+
+from benchmarks.synthetic import star_field, write_frame
+
+
+class Vector:
+    """One INDI property vector: kind is 'Switch', 'Number' or 'Text'"""
+
+    def __init__(self, device, name, kind, elements, state='Idle', perm='rw', rule='OneOfMany'):
+        self.device = device
+        self.name = name
+        self.kind = kind
+        self.elements = OrderedDict(elements)
+        self.state = state
+        self.perm = perm
+        self.rule = rule
+
+    def format(self, value):
+        if self.kind == 'Switch':
+            return 'On' if value else 'Off'
+        if self.kind == 'Number':
+            return '%g' % value
+        return '' if value is None else str(value)
+
+    def parse(self, text):
+        text = (text or '').strip()
+        if self.kind == 'Switch':
+            return text == 'On'
+        if self.kind == 'Number':
+            return float(text)
+        return text
+
+    def to_xml(self, verb):
+        tag = f'{verb}{self.kind}Vector'
+        attrs = {
+            'device': self.device.name,
+            'name': self.name,
+            'state': self.state,
+            'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        if verb == 'def':
+            attrs.update(label=self.name, group='Main', perm=self.perm, timeout='60')
+            if self.kind == 'Switch':
+                attrs['rule'] = self.rule
+        root = ET.Element(tag, attrs)
+
+        element_tag = f'{verb}{self.kind}' if verb == 'def' else f'one{self.kind}'
+        for name, value in self.elements.items():
+            element_attrs = {'name': name}
+            if verb == 'def':
+                element_attrs['label'] = name
+                if self.kind == 'Number':
+                    element_attrs.update(format='%g', min='-1000000', max='1000000', step='1')
+            ET.SubElement(root, element_tag, element_attrs).text = self.format(value)
+        return ET.tostring(root, encoding='unicode')
+
+
+class Device:
+    def __init__(self, name):
+        self.name = name
+        self.server = None
+        self.connected = False
+        self.connection = Vector(self, 'CONNECTION', 'Switch', [('CONNECT', False), ('DISCONNECT', True)])
+        self.vectors = OrderedDict()
+
+    def define(self, name, kind, elements, **kwargs):
+        self.vectors[name] = Vector(self, name, kind, elements, **kwargs)
+        return self.vectors[name]
+
+    def defined(self):
+        """Vectors a client sees; drivers only define their properties once connected"""
+        return [self.connection] + (list(self.vectors.values()) if self.connected else [])
+
+    def vector(self, name):
+        return self.connection if name == 'CONNECTION' else self.vectors[name]
+
+    def update(self, vector, state=None, **values):
+        vector.elements.update(values)
+        if state is not None:
+            vector.state = state
+        self.server.broadcast(vector.to_xml('set'))
+
+    def new(self, vector, values):
+        if vector is self.connection:
+            connect = values.get('CONNECT', not values.get('DISCONNECT', False))
+            vector.elements.update(CONNECT=connect, DISCONNECT=not connect)
+            vector.state = 'Ok'
+            self.server.broadcast(vector.to_xml('set'))
+            if connect and not self.connected:
+                self.connected = True
+                for v in self.vectors.values():
+                    self.server.broadcast(v.to_xml('def'))
+            self.connected = connect
+            return
+        self.handle(vector, values)
+
+    def handle(self, vector, values):
+        self.update(vector, state='Ok', **values)
+
+
+class SimulatedFocuser(Device):
+    """Moves at `speed` steps per second, reporting its position while busy.
+
+    With `backlash` the optics lag the reported position by up to that many
+    steps: they sit at `position - backlash` after moving outwards and at
+    `position` after moving inwards."""
+
+    def __init__(self, name='FOCUSER_SIMULATOR', position=4000, speed=2000.0, temperature=None, report_interval=0.05,
+                 backlash=0):
+        super().__init__(name)
+        self.speed = speed
+        self.report_interval = report_interval
+        self.backlash = backlash
+        self.position = float(position)
+        self.optical = self.position
+        self.define('ABS_FOCUS_POSITION', 'Number', [('FOCUS_ABSOLUTE_POSITION', self.position)])
+        if temperature is not None:
+            self.define('FOCUS_TEMPERATURE', 'Number', [('TEMPERATURE', temperature)], perm='ro')
+
+    def handle(self, vector, values):
+        if vector.name != 'ABS_FOCUS_POSITION':
+            return super().handle(vector, values)
+
+        target = values['FOCUS_ABSOLUTE_POSITION']
+        start, started = self.position, time.monotonic()
+        duration = abs(target - start) / self.speed
+        self.update(vector, state='Busy')
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= duration:
+                break
+            self.set_position(start + (target - start) * elapsed / duration)
+            self.update(vector, FOCUS_ABSOLUTE_POSITION=round(self.position))
+            time.sleep(min(self.report_interval, duration - elapsed))
+        self.set_position(target)
+        self.update(vector, state='Ok', FOCUS_ABSOLUTE_POSITION=target)
+
+    def set_position(self, position):
+        self.position = position
+        self.optical = min(max(self.optical, position - self.backlash), position)
+
+
+class SimulatedCamera(Device):
+    """Exposes for `time * time_scale` seconds plus `readout` seconds, then publishes
+    the frame on the image host and its URLs in LAST_IMAGE_URL.
+
+    With `subframes` the camera also defines CCD_INFO, CCD_FRAME and
+    CCD_FRAME_RESET and crops published frames to the current CCD_FRAME."""
+
+    def __init__(self, name='CAMERA_SIMULATOR', frames=None, image_host=None, time_scale=0.0, readout=0.0,
+                 subframes=False):
+        super().__init__(name)
+        self.frames = frames
+        self.image_host = image_host
+        self.time_scale = time_scale
+        self.readout = readout
+        self.focuser = None
+        self.count = 0
+        self.define('CCD_EXPOSURE', 'Number', [('CCD_EXPOSURE_VALUE', 0.0)])
+        self.define('LAST_IMAGE_URL', 'Text', [('JPEG', ''), ('RAW', '')], perm='ro')
+        if subframes:
+            full = [('X', 0), ('Y', 0), ('WIDTH', frames.width), ('HEIGHT', frames.height)]
+            self.full_frame = OrderedDict(full)
+            self.define('CCD_INFO', 'Number', [('CCD_MAX_X', frames.width), ('CCD_MAX_Y', frames.height)], perm='ro')
+            self.define('CCD_FRAME', 'Number', full)
+            self.define('CCD_FRAME_RESET', 'Switch', [('RESET', False)], rule='AtMostOne')
+
+    @property
+    def region(self):
+        """Current (top, left, height, width) subframe or None for full frames"""
+        frame = self.vectors.get('CCD_FRAME')
+        if frame is None or frame.elements == self.full_frame:
+            return None
+        e = {k: int(v) for k, v in frame.elements.items()}
+        return e['Y'], e['X'], e['HEIGHT'], e['WIDTH']
+
+    def handle(self, vector, values):
+        if vector.name == 'CCD_FRAME_RESET':
+            self.update(self.vectors['CCD_FRAME'], state='Ok', **self.full_frame)
+            return self.update(vector, state='Ok', RESET=False)
+        if vector.name != 'CCD_EXPOSURE':
+            return super().handle(vector, values)
+
+        exposure = values['CCD_EXPOSURE_VALUE']
+        self.update(vector, state='Busy', CCD_EXPOSURE_VALUE=exposure)
+        time.sleep(exposure * self.time_scale + self.readout)
+
+        self.count += 1
+        focus = self.focuser.optical if self.focuser is not None else 0
+        jpeg = self.frames.render(
+            focus, os.path.join(self.image_host.directory, f'IMG_{self.count:04d}.jpg'), self.region,
+        )
+        raw = os.path.join(self.image_host.directory, f'IMG_{self.count:04d}.raw')
+        shutil.copyfile(jpeg, raw)
+
+        self.update(
+            self.vectors['LAST_IMAGE_URL'], state='Ok',
+            JPEG=self.image_host.url(os.path.basename(jpeg)),
+            RAW=self.image_host.url(os.path.basename(raw)),
+        )
+        self.update(vector, state='Ok', CCD_EXPOSURE_VALUE=0)
+
+
+class SimulatedGuider(Device):
+    def __init__(self, name='PHD2', settle=0.0):
+        super().__init__(name)
+        self.settle = settle
+        self.dithers = []
+        self.define('DITHER', 'Number', [('DITHER_BY_PIXELS', 0.0)])
+
+    def handle(self, vector, values):
+        if vector.name != 'DITHER':
+            return super().handle(vector, values)
+        self.dithers.append(values['DITHER_BY_PIXELS'])
+        self.update(vector, state='Busy', **values)
+        time.sleep(self.settle)
+        self.update(vector, state='Ok')
+
+
+class SyntheticFrames:
+    """Star fields blurred in proportion to the distance from `best_focus`"""
+
+    def __init__(self, best_focus=4000, width=600, height=400, star_count=15, seeing=2.5, slope=0.04):
+        self.best_focus = best_focus
+        self.width = width
+        self.height = height
+        self.star_count = star_count
+        self.seeing = seeing
+        self.slope = slope
+
+    def render(self, focus, path, region=None):
+        frame, _ = star_field(
+            width=self.width, height=self.height, star_count=self.star_count,
+            seeing=self.seeing + self.slope * abs(focus - self.best_focus),
+        )
+        if region is not None:
+            top, left, height, width = region
+            frame = frame[top:top + height, left:left + width]
+        return write_frame(path, frame)
+
+
+class SimsFrames:
+    """Recorded frames of the telescopy-sims package, one per focus position"""
+
+    def __init__(self):
+        import telescopy_sims
+        self.pattern = os.path.join(
+            os.path.dirname(telescopy_sims.__file__), 'resources', 'images', 'focus-10{focus:03d}.jpg'
+        )
+
+    def render(self, focus, path, region=None):
+        source = self.pattern.format(focus=int(round(focus)))
+        if region is None:
+            shutil.copyfile(source, path)
+            return path
+        top, left, height, width = region
+        with PILImage.open(source) as img:
+            img.crop((left, top, left + width, top + height)).save(path)
+        return path
+
+
+class IndiConnectionHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.server.simulator.connections.append(self)
+
+    def finish(self):
+        self.server.simulator.connections.remove(self)
+
+    def send(self, message):
+        with self.send_lock:
+            try:
+                self.request.sendall(message.encode())
+            except OSError:
+                pass
+
+    def handle(self):
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        parser.feed('<stream>')
+        depth = 0
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            parser.feed(data.decode())
+            for event, element in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    self.server.simulator.dispatch(self, element)
+
+
+class IndiSimulator:
+    """In-process INDI server speaking the XML protocol over TCP.
+
+    Every client connection (control or BLOB) receives all property updates.
+    New values are handled on a worker thread per request, so slow focuser
+    moves or exposures never block the protocol stream."""
+
+    def __init__(self, devices):
+        self.devices = OrderedDict((d.name, d) for d in devices)
+        for device in devices:
+            device.server = self
+        self.connections = []
+        self.messages = []
+        self.tcp = socketserver.ThreadingTCPServer(('127.0.0.1', 0), IndiConnectionHandler)
+        self.tcp.daemon_threads = True
+        self.tcp.simulator = self
+        self.thread = threading.Thread(target=self.tcp.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.tcp.server_address[1]
+
+    def broadcast(self, message):
+        for connection in list(self.connections):
+            connection.send(message)
+
+    def dispatch(self, connection, element):
+        self.messages.append(element.tag)
+        if element.tag == 'getProperties':
+            device = element.get('device')
+            for d in self.devices.values():
+                if device in (None, d.name):
+                    for vector in d.defined():
+                        connection.send(vector.to_xml('def'))
+            return
+
+        if not element.tag.startswith('new'):
+            return  # enableBLOB and anything else needs no answer
+
+        device = self.devices[element.get('device')]
+        vector = device.vector(element.get('name'))
+        values = {child.get('name'): vector.parse(child.text) for child in element}
+        threading.Thread(target=device.new, args=(vector, values), daemon=True).start()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.tcp.shutdown()
+        self.tcp.server_close()
+        return False
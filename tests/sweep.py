@@ -0,0 +1,24 @@
+import os
+
+from benchmarks.synthetic import star_field, write_frame
+from core.value_object import Image
+
+
+class SweepConnector:
+    """Renders a star field blurred in proportion to the distance from `best_focus`;
+    focus positions in `starless` render an empty sky"""
+
+    def __init__(self, directory, best_focus, starless=()):
+        self.directory = directory
+        self.best_focus = best_focus
+        self.starless = set(starless)
+        self.exposed = []
+
+    def expose(self, focus, time, download_images=True, download_images_async=True, prefix=None):
+        self.exposed.append(focus)
+        frame, _ = star_field(
+            width=600, height=400, star_count=0 if focus in self.starless else 15,
+            seeing=2.5 + 0.04 * abs(focus - self.best_focus),
+        )
+        path = write_frame(os.path.join(self.directory, f'focus-{len(self.exposed)}.png'), frame)
+        return Image(source_url='file://' + path, image_file=path, meta={'focus': focus})
@@ -0,0 +1,76 @@
+import pytest
+
+from core import alg
+from core.autofocus import Autofocus
+from core.executor import MeasurementExecutors
+from .sweep import SweepConnector
+
+
+@pytest.mark.parametrize('best_focus', [3870, 4040])
+def test_adaptive_search_uses_fewer_exposures(tmp_path, best_focus):
+    conn = SweepConnector(str(tmp_path), best_focus)
+    af = Autofocus(conn, detector='threshold', executor='inline')
+
+    with MeasurementExecutors('inline') as e:
+        measured_images, ms = af.adaptive_search(e, 1, 3800, 4100, steps=10)
+
+    fwhms, _ = ms.to_fwhm_list()
+    center = alg.v_shape_linear_fit(fwhms)[0]
+
+    assert len(conn.exposed) == len(measured_images) < 11
+    assert len(set(conn.exposed)) == len(conn.exposed)
+    assert conn.exposed[:5] == [3800, 3875, 3950, 4025, 4100]
+    assert abs(center - best_focus) < 15
+    # tracks follow the sharpest frame even when a refinement frame took over
+    assert all(t.seed.focus == ms.focus_with_best_avg_fwhm() for t in ms.tracks)
+
+
+def test_unknown_search_mode():
+    with pytest.raises(ValueError):
+        Autofocus(None).autofocus(1, 3800, 4100, 10, mode='bisect')
+
+
+def test_incremental_search_stops_early(tmp_path):
+    conn = SweepConnector(str(tmp_path), 3820)
+    progress = []
+    af = Autofocus(conn, detector='threshold', executor='inline', on_progress=progress.append)
+
+    with MeasurementExecutors('inline') as e:
+        measured_images, ms = af.search(e, 'incremental', 1, 3700, 4200, steps=10)
+
+    assert len(conn.exposed) == len(measured_images) < 11
+    assert [p.measured for p in progress] == list(range(4, len(measured_images) + 1))
+    assert progress[-1].constrained(ms.focus_points())
+    assert abs(progress[-1].center - 3820) < 10
+
+
+@pytest.mark.parametrize('mode', ['linear', 'incremental'])
+def test_sweep_starting_on_starless_edge(tmp_path, mode):
+    conn = SweepConnector(str(tmp_path), 3950, starless=(3700,))
+    af = Autofocus(conn, detector='threshold', executor='inline', on_progress=lambda p: None)
+
+    with MeasurementExecutors('inline') as e:
+        measured_images, ms = af.search(e, mode, 1, 3700, 4200, steps=10)
+
+    assert conn.exposed[0] == 3700
+    assert 3700 not in ms.focus_points()
+    assert abs(alg.v_shape_linear_fit(ms.to_fwhm_list()[0])[0] - 3950) < 15
+
+
+def test_star_region_from_first_frame_with_stars(tmp_path):
+    conn = SweepConnector(str(tmp_path), 3950, starless=(3700,))
+    af = Autofocus(conn, detector='threshold', executor='inline', roi='stars', roi_size=200)
+
+    with MeasurementExecutors('inline') as e, af.subframes():
+        measured_images, ms = af.search(e, 'linear', 1, 3700, 4200, steps=10)
+
+    # no extra reference exposure: frames are measured in full until one holds enough stars,
+    # starting with the starless edge, and the rest are cropped to the region it picked
+    assert conn.exposed == list(range(3700, 4250, 50))
+    full = [mi.roi is None for mi in measured_images]
+    assert 1 < sum(full) < len(full) and full == sorted(full, reverse=True)
+    assert all(tuple(mi.roi) == tuple(af.region) for mi in measured_images[sum(full):])
+    top, left, height, width = af.region
+    positions = ms.catalog().positions()
+    assert ((positions[:, 0] >= top) & (positions[:, 0] < top + height)).all()
+    assert ((positions[:, 1] >= left) & (positions[:, 1] < left + width)).all()
@@ -0,0 +1,42 @@
+import time
+import asyncio
+import pytest
+
+pytest.importorskip('indi')
+
+from core.aio import AsyncConnector  # noqa: E402
+from core.value_object import Image  # noqa: E402
+
+
+class SlowConnector:
+    download_manager = None
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = []
+
+    def expose(self, focus, time_, download_images=True, download_images_async=True, prefix=None):
+        time.sleep(self.delay)
+        self.calls.append(('expose', focus))
+        return Image(image_file='/dev/null', meta={'focus': focus})
+
+    def dither(self, pixels):
+        time.sleep(self.delay)
+        self.calls.append(('dither', pixels))
+
+    def close(self, timeout=None):
+        pass
+
+
+def test_rigs_run_concurrently():
+    rigs = [AsyncConnector(SlowConnector(0.2)) for _ in range(3)]
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*(rig.expose(100, 1) for rig in rigs), *(rig.dither(5) for rig in rigs))
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*(rig.close() for rig in rigs))
+        return elapsed
+
+    assert asyncio.run(run()) < 0.5
+    assert all(sorted(rig.connector.calls) == [('dither', 5), ('expose', 100)] for rig in rigs)
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from core import alg
+
+
+def make_cutouts(widths, size=31, background=10.0, noise=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    X, Y = np.indices((size, size))
+    center = (size - 1) / 2
+    return np.stack([
+        150 * np.exp(-((X - center) ** 2 + (Y - center) ** 2) / (2 * w ** 2))
+        + background + rng.normal(0, noise, (size, size))
+        for w in widths
+    ])
+
+
+def test_two_dimensional_gaussian_fit():
+    cutout = make_cutouts([3.0], background=0)[0]
+
+    height, x, y, width = alg.two_dimensional_gaussian_fit(cutout)
+
+    assert x == pytest.approx(15, abs=0.05)
+    assert y == pytest.approx(15, abs=0.05)
+    assert abs(width) == pytest.approx(3.0, abs=0.05)
+
+
+@pytest.mark.parametrize('profile', alg.PROFILES)
+def test_fit_star_profiles_batch(profile):
+    widths = np.linspace(2, 6, 12)
+    cutouts = make_cutouts(widths)
+
+    params = alg.fit_star_profiles(cutouts, profile=profile, background=True)
+
+    assert params.shape[0] == len(widths)
+    # a moffat profile only approximates the gaussian stars used here
+    width_tolerance, background_tolerance = (0.15, 1.0) if profile == 'moffat' else (0.05, 0.2)
+    np.testing.assert_allclose(alg.profile_width(params, profile), widths, atol=width_tolerance)
+    np.testing.assert_allclose(params[:, -1], 10.0, atol=background_tolerance)
+
+
+def test_fit_star_profiles_batch_matches_single():
+    cutouts = make_cutouts([2.5, 4.0, 5.5])
+
+    batch = alg.fit_star_profiles(cutouts)
+    single = np.concatenate([alg.fit_star_profiles(c[np.newaxis]) for c in cutouts])
+
+    np.testing.assert_allclose(batch, single, rtol=1e-5)
+
+
+def v_curve_table(model, center=3950, stars=20, missing=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    focus = np.linspace(3800, 4100, 11)
+    levels = rng.uniform(2.5, 4, stars)
+    d = focus[:, np.newaxis] - center
+    if model == 'hyperbolic':
+        values = np.sqrt(levels ** 2 + (0.04 * d) ** 2)
+    else:
+        values = levels + np.where(d < 0, -0.03, 0.05) * d
+    values = values + rng.normal(0, 0.05, values.shape)
+    values[rng.random(values.shape) < missing] = np.nan
+    return focus, values
+
+
+@pytest.mark.parametrize('model', alg.V_CURVE_MODELS)
+def test_fit_v_curve(model):
+    focus, values = v_curve_table(model)
+    rows = [[f, *(None if np.isnan(v) else v for v in row)] for f, row in zip(focus, values)]
+
+    fit = alg.fit_v_curve(rows, model=model)
+
+    assert fit.center == pytest.approx(3950, abs=3 * fit.center_stderr + 1)
+    assert fit.center_stderr < 2
+    assert fit.slopes[0] < 0 < fit.slopes[1]
+    assert fit.predict(focus).shape == values.shape
+    np.testing.assert_allclose(alg.v_shape_linear_fit(rows), alg.fit_v_curve(rows).p)
+
+
+@pytest.mark.parametrize('loss', ['huber', 'soft_l1'])
+def test_fit_v_curve_robust_loss(loss):
+    focus, values = v_curve_table('linear', missing=0)
+    # blended stars on one side of the minimum
+    values[3:5, :8] += 3
+
+    plain = alg.fit_v_curve((focus, values))
+    robust = alg.fit_v_curve((focus, values), loss=loss)
+
+    assert abs(plain.center - 3950) > 5
+    assert robust.center == pytest.approx(3950, abs=4)
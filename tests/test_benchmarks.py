@@ -0,0 +1,29 @@
+import os
+import pytest
+
+from benchmarks import bench
+from benchmarks.synthetic import star_field
+
+
+def test_star_field():
+    frame, stars = star_field(width=300, height=200, star_count=7)
+
+    assert frame.shape == (200, 300)
+    assert len(stars) == 7
+    assert 0 <= frame.min() and frame.max() <= 1
+
+
+def test_compare():
+    baseline = {'small': {'fit': {'seconds': 1.0, 'peak_mb': 100.0}}}
+
+    assert bench.compare({'small': {'fit': {'seconds': 1.2, 'peak_mb': 110.0}}}, baseline) == []
+    assert len(bench.compare({'small': {'fit': {'seconds': 2.0, 'peak_mb': 200.0}}}, baseline)) == 2
+    assert bench.compare({'other': {'fit': {'seconds': 9.0, 'peak_mb': 900.0}}}, baseline) == []
+
+
+@pytest.mark.skipif(not os.environ.get('TELESCOPY_BENCHMARK'), reason='set TELESCOPY_BENCHMARK=1 to run benchmarks')
+def test_no_regressions():
+    results = bench.run()
+    bench.print_results(results)
+
+    assert bench.compare(results, bench.read_baseline()) == []
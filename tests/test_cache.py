@@ -0,0 +1,52 @@
+import os
+import numpy as np
+
+from benchmarks.synthetic import star_field, write_frame
+from core.cache import MeasurementCache, CACHE_SUFFIX
+from core.value_object import Image, MeasuredImage
+
+
+def make_image(tmp_path, name='frame.png', seed=0):
+    frame, _ = star_field(width=400, height=300, star_count=5, seeing=4, seed=seed)
+    path = write_frame(str(tmp_path / name), frame)
+    return Image(image_file=path, meta={'focus': 100})
+
+
+def test_measure_uses_cache(tmp_path):
+    cache = MeasurementCache()
+    image = make_image(tmp_path)
+
+    first = MeasuredImage.from_image(image, detector='threshold', cache=cache)
+    second = MeasuredImage.from_image(image, detector='threshold', cache=cache)
+
+    assert len(first.catalog) > 0
+    np.testing.assert_array_equal(first.catalog.data, second.catalog.data)
+    assert second._frame is None
+
+
+def test_cache_keyed_by_content_and_params(tmp_path):
+    cache = MeasurementCache()
+    image = make_image(tmp_path)
+    copy = make_image(tmp_path, name='copy.png')
+    other = make_image(tmp_path, name='other.png', seed=1)
+    params = {'detector': 'threshold'}
+
+    assert cache.key(image.image_file, params) == cache.key(copy.image_file, params)
+    assert cache.key(image.image_file, params) != cache.key(other.image_file, params)
+    assert cache.key(image.image_file, params) != cache.key(image.image_file, {'detector': 'blob_log'})
+
+
+def test_cache_eviction(tmp_path):
+    cache = MeasurementCache()
+    image = make_image(tmp_path)
+
+    MeasuredImage.from_image(image, detector='threshold', cache=cache)
+    [first] = [f for f in os.listdir(tmp_path) if f.endswith(CACHE_SUFFIX)]
+    cache.max_bytes = os.path.getsize(tmp_path / first) * 1.5
+    os.utime(tmp_path / first, (0, 0))
+
+    MeasuredImage.from_image(image, detector='threshold', reduce=2, cache=cache)
+
+    cached = [f for f in os.listdir(tmp_path) if f.endswith(CACHE_SUFFIX)]
+    assert len(cached) == 1
+    assert cached != [first]
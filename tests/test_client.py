@@ -0,0 +1,107 @@
+import threading
+import pytest
+
+pytest.importorskip('indi')
+
+from core import client  # noqa: E402
+
+
+class FakeVector(dict):
+    def __init__(self, elements):
+        super().__init__({name: type('Element', (), {'value': None})() for name in elements})
+        self.submitted = 0
+
+    def submit(self):
+        self.submitted += 1
+
+
+class FakeDevice(dict):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+
+class FakeSocket:
+    def shutdown(self, how):
+        pass
+
+
+class FakeConnectionHandler:
+    def __init__(self):
+        self.client_socket = FakeSocket()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    """Defines devices and vectors from background timers, like a remote INDI server would"""
+
+    def __init__(self, schedule):
+        self.devices = {}
+        self.schedule = schedule
+        self.control_connection_handler = FakeConnectionHandler()
+        self.blob_connection_handler = FakeConnectionHandler()
+
+    def start(self):
+        for delay, device, vector in self.schedule:
+            threading.Timer(delay, self.define, (device, vector)).start()
+
+    def define(self, device, vector):
+        self.devices.setdefault(device, FakeDevice(device))[vector] = FakeVector(['CONNECT', 'DISCONNECT'])
+
+    def __getitem__(self, name):
+        return self.devices[name]
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    def install(schedule):
+        clients = []
+        monkeypatch.setattr(client, 'TCP', lambda ip, port: None)
+        monkeypatch.setattr(client, 'Client', lambda control, blob: clients.append(FakeClient(schedule)) or clients[-1])
+        return clients
+    return install
+
+
+def make_connector():
+    return client.Connector(camera_name='CAMERA', focuser_name='FOCUSER', phd2_name='PHD2')
+
+
+def test_connect_waits_concurrently(fake_client):
+    fake_client([
+        (0.1, 'CAMERA', 'CONNECTION'), (0.1, 'FOCUSER', 'CONNECTION'), (0.1, 'PHD2', 'CONNECTION'),
+        (0.2, 'CAMERA', 'CCD_EXPOSURE'), (0.2, 'FOCUSER', 'ABS_FOCUS_POSITION'), (0.2, 'PHD2', 'DITHER'),
+    ])
+    conn = make_connector()
+
+    report = conn.connect(timeout=5, poll_interval=0.01)
+
+    assert set(report) == {
+        'CAMERA.CONNECTION', 'FOCUSER.CONNECTION', 'PHD2.CONNECTION',
+        'CAMERA.CCD_EXPOSURE', 'FOCUSER.ABS_FOCUS_POSITION', 'PHD2.DITHER',
+    }
+    assert max(report.values()) < 1
+    assert conn.camera['CONNECTION'].submitted == 1
+    assert conn.phd2.name == 'PHD2'
+
+
+def test_connect_times_out_with_report(fake_client):
+    clients = fake_client([
+        (0.0, 'CAMERA', 'CONNECTION'), (0.0, 'CAMERA', 'CCD_EXPOSURE'),
+        (0.0, 'FOCUSER', 'CONNECTION'), (0.0, 'FOCUSER', 'ABS_FOCUS_POSITION'),
+    ])
+    conn = make_connector()
+
+    with pytest.raises(client.ConnectionTimeout) as e:
+        conn.connect(timeout=0.3, poll_interval=0.01)
+
+    assert e.value.report['PHD2.CONNECTION'] is None
+    assert e.value.report['PHD2.DITHER'] is None
+    assert e.value.report['CAMERA.CCD_EXPOSURE'] is not None
+
+    # no server connections or reader threads are left behind
+    assert conn.client is None
+    assert clients[0].control_connection_handler.closed
+    assert clients[0].blob_connection_handler.closed
@@ -0,0 +1,182 @@
+import os
+import stat
+import threading
+from concurrent import futures
+
+import pytest
+
+import settings
+
+pytest.importorskip('indi')
+
+from core.daemon import ConnectionPool, Daemon, DaemonClient, DaemonError, expose_job, load_authkey  # noqa: E402
+from core.client import Connector  # noqa: E402
+from core.value_object import Image  # noqa: E402
+
+
+class FakeConnector:
+    instances = []
+
+    def __init__(self, **connection):
+        self.connection = connection
+        self.motion = {k: v for k, v in connection.items() if k in ('backlash', 'focus_direction', 'focus_tolerance')}
+        self.connects = 0
+        self.outstanding = []
+        FakeConnector.instances.append(self)
+
+    def connect(self):
+        self.connects += 1
+
+    def set_motion(self, **motion):
+        self.motion = motion
+
+    def close(self, timeout=None):
+        pass
+
+
+def focus_job(conn, focus):
+    return {'connector': id(conn), 'focus': focus}
+
+
+def failing_job(conn):
+    raise RuntimeError('boom')
+
+
+@pytest.fixture
+def daemon():
+    FakeConnector.instances = []
+    d = Daemon(
+        address=('127.0.0.1', 0),
+        authkey=b'test',
+        pool=ConnectionPool(factory=FakeConnector),
+        jobs={'focus': focus_job, 'fail': failing_job},
+    )
+    thread = threading.Thread(target=d.serve_forever)
+    thread.start()
+    yield DaemonClient(d.address, authkey=b'test')
+    d.shutdown()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_daemon_reuses_connection(daemon):
+    rig = {'ip': '10.0.0.1', 'port': 7624, 'camera_name': 'CAMERA'}
+
+    first = daemon.submit('focus', rig, focus=100)
+    second = daemon.submit('focus', rig, focus=200)
+    other = daemon.submit('focus', {**rig, 'camera_name': 'OTHER'}, focus=300)
+
+    assert first['connector'] == second['connector'] != other['connector']
+    assert second['focus'] == 200
+    assert [c.connects for c in FakeConnector.instances] == [1, 1]
+    assert len(daemon.status()) == 2
+
+
+def test_motion_settings_reuse_connection(daemon):
+    rig = {'ip': '10.0.0.1', 'port': 7624, 'focuser_name': 'FOCUSER'}
+
+    first = daemon.submit('focus', {**rig, 'backlash': 0}, focus=100)
+    second = daemon.submit('focus', {**rig, 'backlash': 50, 'focus_direction': -1}, focus=200)
+
+    assert first['connector'] == second['connector']
+    assert len(FakeConnector.instances) == len(daemon.status()) == 1
+    assert FakeConnector.instances[0].motion == {'backlash': 50, 'focus_direction': -1}
+
+
+def test_motion_settings_apply_per_job(daemon):
+    rig = {'ip': '10.0.0.1', 'port': 7624, 'focuser_name': 'FOCUSER'}
+    daemon.submit('focus', {**rig, 'backlash': 50, 'focus_direction': -1, 'focus_tolerance': 2}, focus=100)
+    conn = FakeConnector.instances[0]
+
+    daemon.submit('focus', rig, focus=200)
+    assert conn.motion == {}
+
+    daemon.submit('focus', {**rig, 'backlash': 50, 'focus_direction': -1, 'focus_tolerance': 2}, focus=300)
+    daemon.submit('focus', {**rig, 'backlash': 30}, focus=400)
+    assert conn.motion == {'backlash': 30}
+
+
+class OfflineConnector(Connector):
+    def connect(self):
+        pass
+
+
+def test_pooled_connector_motion_matches_new_connector():
+    pool = ConnectionPool(factory=OfflineConnector)
+    pooled = pool.run({'port': 1, 'backlash': 50, 'focus_direction': -1}, lambda conn: conn)
+
+    assert pool.run({'port': 1, 'focus_tolerance': 2}, lambda conn: conn) is pooled
+    assert repr(pooled.motion) == repr(Connector(focus_tolerance=2).motion)
+
+
+def test_daemon_reports_job_errors(daemon):
+    with pytest.raises(DaemonError, match='boom'):
+        daemon.submit('fail', {'ip': '10.0.0.1'})
+
+    with pytest.raises(DaemonError, match='Unknown job'):
+        daemon.submit('missing', {'ip': '10.0.0.1'})
+
+
+def test_client_without_daemon():
+    with pytest.raises(DaemonError):
+        DaemonClient(('127.0.0.1', 1), authkey=b'test').status()
+
+
+@pytest.fixture
+def key_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'LOCAL_STORAGE', str(tmp_path))
+    monkeypatch.setattr(settings, 'DAEMON_AUTHKEY', None)
+    return tmp_path / 'daemon.key'
+
+
+def test_authkey_generated_private(key_storage):
+    with pytest.raises(DaemonError, match='No daemon key'):
+        DaemonClient()
+
+    key = load_authkey(create=True)
+
+    assert len(key) == 64
+    assert stat.S_IMODE(os.stat(key_storage).st_mode) == 0o600
+    assert load_authkey(create=True) == load_authkey() == DaemonClient().authkey
+
+
+def test_authkey_file_must_be_private(key_storage):
+    load_authkey(create=True)
+    os.chmod(key_storage, 0o644)
+
+    with pytest.raises(DaemonError, match='chmod 600'):
+        load_authkey()
+
+
+def test_failed_connection_is_closed():
+    class BrokenConnector(FakeConnector):
+        closed = 0
+
+        def close(self, timeout=None):
+            BrokenConnector.closed += 1
+
+    def broken_job(conn):
+        raise ConnectionResetError()
+
+    pool = ConnectionPool(factory=BrokenConnector)
+    with pytest.raises(ConnectionResetError):
+        pool.run({'ip': '10.0.0.1'}, broken_job)
+
+    assert BrokenConnector.closed == 1
+    assert pool.status() == []
+
+
+def test_expose_job_waits_for_download():
+    class Exposing:
+        def expose_only(self, time, prefix=None):
+            img, raw_img = Image(source_url='http://camera/a.jpg'), Image(source_url='http://camera/a.raw')
+            for image in (img, raw_img):
+                image.download_future = futures.Future()
+                threading.Timer(0.05, finish, (image,)).start()
+            return img, raw_img
+
+    def finish(image):
+        image.image_file = image.source_url.rsplit('/', 1)[-1]
+        image.download_future.set_result(image)
+
+    assert expose_job(Exposing()) == 'a.jpg'
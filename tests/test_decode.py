@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from PIL import Image as PILImage
+
+from benchmarks.synthetic import star_field, write_frame
+from core import decode
+from core.catalog import StarCatalog, STAR_DTYPE
+from core.value_object import Image, MeasuredImage
+
+
+@pytest.fixture
+def jpeg_file(tmp_path):
+    arr = np.zeros((400, 600, 3), dtype=np.uint8)
+    arr[100:110, 300:310] = 255
+    path = str(tmp_path / 'frame.jpg')
+    PILImage.fromarray(arr).save(path, quality=95)
+    return path
+
+
+def test_decode_gray_float32(jpeg_file):
+    frame = decode.decode(jpeg_file)
+
+    assert frame.data.shape == (400, 600)
+    assert frame.data.dtype == np.float32
+    assert frame.shape == (400, 600)
+    assert frame.data.max() == pytest.approx(1.0, abs=0.05)
+
+
+def test_decode_region(jpeg_file):
+    frame = decode.decode(jpeg_file, roi=decode.Region(50, 250, 100, 100))
+
+    assert frame.data.shape == (100, 100)
+    assert frame.offset == (50, 250)
+    row, col = np.unravel_index(frame.data.argmax(), frame.data.shape)
+    assert 100 <= row + frame.offset[0] < 110
+    assert 300 <= col + frame.offset[1] < 310
+
+
+def test_decode_reduced_draft(jpeg_file):
+    frame = decode.decode(jpeg_file, reduce=2, roi=0.5)
+
+    assert frame.scale == 2
+    assert frame.data.shape == (100, 150)
+    assert frame.offset == (100, 150)
+
+
+def test_frame_cache(jpeg_file):
+    cache = decode.FrameCache()
+
+    first = cache.get(jpeg_file)
+    second = cache.get(jpeg_file)
+
+    assert first is second
+    assert not first.data.flags.writeable
+    assert cache.get(jpeg_file, reduce=2) is not first
+
+
+def test_star_region():
+    catalog = StarCatalog(np.array(
+        [(100, 100, 3, 4, 10, 0, 0), (150, 180, 3, 4, 10, 0, 0), (120, 220, 3, 4, 5, 0, 0), (350, 550, 3, 4, 90, 0, 0)],
+        dtype=STAR_DTYPE,
+    ))
+
+    region = decode.star_region(catalog, (400, 600), 200, min_stars=3)
+
+    assert region.height == region.width == 200
+    assert all(
+        region.top + 6 <= x <= region.top + 194 and region.left + 6 <= y <= region.left + 194
+        for x, y in catalog.positions()[:3]
+    )
+    assert decode.star_region(catalog, (400, 600), 200, min_stars=4) is None
+    # one star per window: the brightest wins
+    assert decode.star_region(catalog, (400, 600), 30, min_stars=1) == decode.Region(335, 535, 30, 30)
+
+
+def test_subframe_cropped_by_camera(tmp_path):
+    frame, _ = star_field(width=400, height=300, star_count=5, seeing=3)
+    region = decode.star_region(
+        MeasuredImage.from_image(
+            Image(image_file=write_frame(str(tmp_path / 'full.png'), frame), meta={'focus': 1}), detector='threshold',
+        ).catalog,
+        (300, 400), 150, min_stars=1,
+    )
+    top, left, height, width = region
+    full = MeasuredImage.from_image(
+        Image(image_file=str(tmp_path / 'full.png'), meta={'focus': 1}), detector='threshold', roi=region,
+    )
+    cropped = MeasuredImage.from_image(
+        Image(
+            image_file=write_frame(str(tmp_path / 'sub.png'), frame[top:top + height, left:left + width]),
+            meta={'focus': 1, 'subframe': {'region': list(region), 'shape': [300, 400]}},
+        ),
+        detector='threshold', roi=region,
+    )
+
+    assert cropped.shape == full.shape == (300, 400)
+    np.testing.assert_allclose(np.sort(cropped.catalog['x']), np.sort(full.catalog['x']))
+    np.testing.assert_allclose(np.sort(cropped.catalog['y']), np.sort(full.catalog['y']))
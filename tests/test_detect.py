@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from core import detect
+
+
+def make_frame(stars, shape=(400, 600), sigma=8.0, seed=0):
+    rng = np.random.default_rng(seed)
+    X, Y = np.indices(shape)
+    frame = 0.05 + rng.normal(0, 0.005, shape)
+    for x, y in stars:
+        frame += 0.9 * np.exp(-((X - x) ** 2 + (Y - y) ** 2) / (2 * sigma ** 2))
+    return frame
+
+
+STARS = [(60, 80), (120, 400), (200, 250), (330, 90), (300, 520)]
+
+
+@pytest.mark.parametrize('detector', detect.DETECTORS)
+def test_detect_stars(detector):
+    found = detect.detect_stars(make_frame(STARS), detector)
+
+    assert len(found) == len(STARS)
+    for x, y in STARS:
+        assert min((fx - x) ** 2 + (fy - y) ** 2 for fx, fy, r in found) < 2 ** 2
+
+
+def test_detect_stars_unknown_detector():
+    with pytest.raises(ValueError):
+        detect.detect_stars(make_frame([]), 'nope')
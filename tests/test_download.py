@@ -0,0 +1,84 @@
+import os
+import pytest
+
+import settings
+from core.download import DownloadManager
+from core.value_object import Image
+from .http_server import ImageHTTPServer
+
+
+@pytest.fixture
+def served(tmp_path):
+    directory = tmp_path / 'remote'
+    directory.mkdir()
+    (directory / 'frame.jpg').write_bytes(os.urandom(3 * 2 ** 20 + 17))
+    return directory
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    directory = tmp_path / 'storage'
+    monkeypatch.setattr(settings, 'LOCAL_STORAGE', str(directory))
+    return directory
+
+
+def test_download_and_delete(served, storage):
+    manager = DownloadManager(chunk_size=2 ** 16)
+    with ImageHTTPServer(str(served)) as server:
+        image = Image(source_url=server.url('frame.jpg'), meta={'focus': 1}, prefix='test')
+        image.download_image(manager)
+        image.delete_remote_image(manager)
+
+    assert image.image_file == str(storage / 'test-frame.jpg')
+    assert (storage / 'test-frame.jpg').stat().st_size == 3 * 2 ** 20 + 17
+    assert image.meta['filename'] == 'test-frame.jpg'
+    assert not (served / 'frame.jpg').exists()
+    manager.close()
+
+
+def test_download_retries(served, storage):
+    manager = DownloadManager(backoff=0.01)
+    with ImageHTTPServer(str(served), failures=2) as server:
+        manager.fetch(server.url('frame.jpg'), str(storage.parent / 'copy.jpg'))
+
+    assert [r[0] for r in server.requests] == ['GET', 'GET', 'GET']
+    assert (storage.parent / 'copy.jpg').exists()
+    manager.close()
+
+
+def test_download_gives_up(served, storage):
+    manager = DownloadManager(retries=1, backoff=0.01)
+    with ImageHTTPServer(str(served), failures=5) as server:
+        with pytest.raises(Exception):
+            manager.fetch(server.url('frame.jpg'), str(storage.parent / 'copy.jpg'))
+
+    assert not (storage.parent / 'copy.jpg').exists()
+    assert not (storage.parent / 'copy.jpg.part').exists()
+    manager.close()
+
+
+def test_parallel_transfers(served, storage):
+    (served / 'frame.raw').write_bytes(os.urandom(2 ** 20))
+    manager = DownloadManager(max_workers=2, max_queue=2)
+    with ImageHTTPServer(str(served)) as server:
+        images = [Image(source_url=server.url(name)) for name in ('frame.jpg', 'frame.raw')]
+        jobs = [manager.submit(image.download_image, manager) for image in images]
+        for job in jobs:
+            job.result()
+
+    assert all(os.path.exists(image.image_file) for image in images)
+    manager.close()
+
+
+def test_fetch_async(served, storage):
+    manager = DownloadManager()
+    with ImageHTTPServer(str(served)) as server:
+        image = Image(source_url=server.url('frame.jpg'))
+        future = image.fetch_async(manager)
+
+        assert image.wait_downloaded(timeout=10) is image
+
+    assert future.done()
+    assert image.is_downloaded()
+    assert not (served / 'frame.jpg').exists()
+    manager.close()
@@ -0,0 +1,167 @@
+import os
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import settings
+
+pytest.importorskip('indi')
+
+from core import instrument  # noqa: E402
+from core.autofocus import Autofocus  # noqa: E402
+from core.client import Connector  # noqa: E402
+from core.download import DownloadManager  # noqa: E402
+from core.timelapse import Timelapse  # noqa: E402
+from .http_server import ImageHTTPServer  # noqa: E402
+from .indi_server import (  # noqa: E402
+    IndiSimulator, SimsFrames, SimulatedCamera, SimulatedFocuser, SimulatedGuider, SyntheticFrames,
+)
+
+
+@contextmanager
+def simulated_rig(directory, best_focus=3950, focuser_speed=5000.0, time_scale=0.0, readout=0.0, settle=0.0,
+                  focuser_position=3800, focuser_backlash=0, subframes=False, frames=None, **connector_kwargs):
+    """Connected Connector talking to a simulated camera, focuser and PHD2 over real sockets.
+    The camera renders SyntheticFrames around `best_focus` unless given other `frames`."""
+    images = os.path.join(directory, 'server')
+    os.makedirs(images)
+    with ImageHTTPServer(images) as host:
+        focuser = SimulatedFocuser(
+            position=focuser_position, speed=focuser_speed, temperature=12.5, backlash=focuser_backlash,
+        )
+        camera = SimulatedCamera(
+            frames=frames or SyntheticFrames(best_focus=best_focus), image_host=host, time_scale=time_scale,
+            readout=readout, subframes=subframes,
+        )
+        camera.focuser = focuser
+        guider = SimulatedGuider(settle=settle)
+        with IndiSimulator([camera, focuser, guider]) as sim:
+            conn = Connector(
+                port=sim.port, camera_name=camera.name, focuser_name=focuser.name, phd2_name=guider.name,
+                download_manager=DownloadManager(), **connector_kwargs
+            )
+            conn.connect(timeout=10)
+            yield conn, sim, host
+            conn.close(timeout=10)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'LOCAL_STORAGE', str(tmp_path / 'storage'))
+    return tmp_path
+
+
+def test_connect_and_control(storage):
+    with simulated_rig(str(storage)) as (conn, sim, host):
+        assert set(conn.connect_report) == {
+            'CAMERA_SIMULATOR.CONNECTION', 'CAMERA_SIMULATOR.CCD_EXPOSURE',
+            'FOCUSER_SIMULATOR.CONNECTION', 'FOCUSER_SIMULATOR.ABS_FOCUS_POSITION',
+            'PHD2.CONNECTION', 'PHD2.DITHER',
+        }
+
+        conn.move_focuser(3900)
+        assert sim.devices['FOCUSER_SIMULATOR'].position == 3900
+        assert conn.temperature() == 12.5
+
+        img, raw_img = conn.expose_only(1, dither=3)
+        img.wait_downloaded(10)
+        raw_img.wait_downloaded(10)
+
+        assert os.path.exists(img.image_file) and os.path.exists(raw_img.image_file)
+        assert sim.devices['PHD2'].dithers == [3]
+        assert sorted(command for command, _ in host.requests) == ['DELETE', 'DELETE', 'GET', 'GET']
+        assert os.listdir(host.directory) == []
+
+
+def test_close_disconnects(storage):
+    with simulated_rig(str(storage)) as (conn, sim, host):
+        assert len(sim.connections) == 2
+
+        conn.close()
+        deadline = time.monotonic() + 5
+        while sim.connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert sim.connections == []
+        assert conn.client is None
+
+
+def test_autofocus_end_to_end(storage):
+    with simulated_rig(str(storage), best_focus=3950) as (conn, sim, host):
+        af = Autofocus(conn, detector='threshold', executor='inline')
+
+        with instrument.recording() as recorder:
+            best_focus = af.autofocus(1, 3800, 4100, 6, 5)
+
+    assert abs(best_focus - 3950) < 15
+    assert {'focuser.move', 'camera.exposure', 'camera.readout', 'download', 'autofocus'} <= set(recorder.summary())
+
+
+def test_autofocus_on_recorded_frames(storage):
+    pytest.importorskip('telescopy_sims')
+    with simulated_rig(str(storage), frames=SimsFrames(), focuser_position=380) as (conn, sim, host):
+        best_focus = Autofocus(conn).autofocus(3, 380, 480, 10, 3)
+
+    # the mocked connector of test_autofocus finds 432 on the same frames
+    assert abs(best_focus - 432) <= 2
+    assert sim.devices['FOCUSER_SIMULATOR'].position == best_focus
+
+
+@pytest.mark.parametrize('backlash', [0, 60])
+def test_autofocus_backlash_compensation(storage, backlash):
+    rig = simulated_rig(str(storage), best_focus=3950, focuser_position=4200, focuser_backlash=40, backlash=backlash)
+    with rig as (conn, sim, host):
+        focuser = sim.devices['FOCUSER_SIMULATOR']
+        Autofocus(conn, detector='threshold', executor='inline').autofocus(1, 3800, 4100, 6, 5)
+
+        # the optics end up at best focus only when every position is approached the same way
+        assert (abs(focuser.optical - 3950) < 15) == bool(backlash)
+
+
+@pytest.mark.parametrize('subframes', [False, True])
+def test_autofocus_on_star_region(storage, subframes):
+    with simulated_rig(str(storage), best_focus=3950, subframes=subframes) as (conn, sim, host):
+        camera = sim.devices['CAMERA_SIMULATOR']
+        regions = []
+        render = camera.frames.render
+        camera.frames.render = lambda focus, path, region=None: regions.append(region) or render(focus, path, region)
+        af = Autofocus(conn, detector='threshold', executor='inline', roi='stars', roi_size=200)
+
+        with instrument.recording() as recorder:
+            best_focus = af.autofocus(1, 3800, 4100, 6, 5)
+
+        assert camera.region is None
+        assert conn.subframe is None
+
+    assert abs(best_focus - 3950) < 15
+    assert af.region.height == af.region.width == 200
+    # full sweep frames until one picks the region, the rest cropped by the camera if it can,
+    # full verification frame
+    full = next(i for i, r in enumerate(regions) if r is not None) if subframes else 1
+    assert 1 <= full < 7
+    assert regions == [None] * full + [tuple(af.region) if subframes else None] * (7 - full) + [None]
+    measured = [s for s in recorder.to_dict()['spans'] if s['name'] == 'decode']
+    assert len(measured) == 8
+
+
+def test_timelapse_end_to_end(storage):
+    with simulated_rig(str(storage), readout=0.05) as (conn, sim, host):
+        report = Timelapse(conn, time=1, dither=2, max_pending=1).run(3)
+
+    assert len(report.frames) == 3
+    assert [f.dithered for f in report.frames] == [True, True, False]
+    assert sim.devices['PHD2'].dithers == [2, 2]
+    assert all(f.shutter >= 0.05 for f in report.frames)
+
+
+@pytest.mark.skipif(not os.environ.get('TELESCOPY_BENCHMARK'), reason='set TELESCOPY_BENCHMARK=1 to run benchmarks')
+def test_latency_benchmark(storage):
+    """Autofocus and timelapse against realistic device latencies; prints the span summary"""
+    with simulated_rig(str(storage), focuser_speed=500.0, time_scale=1.0, readout=0.5, settle=0.5) as (conn, _, _):
+        with instrument.recording(str(storage / 'e2e-spans.json')) as recorder:
+            Autofocus(conn, detector='threshold').autofocus(0.5, 3800, 4100, 10, 5)
+            Timelapse(conn, time=1, dither=3).run(5)
+
+    print()
+    print(instrument.format_summary(recorder.summary()))
@@ -0,0 +1,46 @@
+import pytest
+
+from core.focuser import FocuserMotion
+
+
+def test_moves_overshoot_only_against_approach_direction():
+    motion = FocuserMotion(backlash=50)
+
+    assert motion.moves(3800, 3900) == [3900]
+    assert motion.moves(4100, 3900) == [3850, 3900]
+    assert motion.moves(None, 3900) == [3850, 3900]
+    assert motion.moves(3900, 3900) == []
+
+
+def test_inward_approach():
+    motion = FocuserMotion(backlash=20, direction=-1)
+
+    assert motion.moves(3800, 3900) == [3920, 3900]
+    assert motion.moves(4000, 3900) == [3900]
+    assert motion.order([3900, 3800, 4000]) == [4000, 3900, 3800]
+
+
+def test_tolerance():
+    motion = FocuserMotion(backlash=50, tolerance=3)
+
+    assert motion.settled(3902, 3900)
+    assert not motion.settled(3904, 3900)
+    assert motion.moves(3902, 3900) == []
+
+
+def test_sweep_order_needs_one_overshoot():
+    motion = FocuserMotion(backlash=50)
+    points = [3950, 3800, 4100, 3875, 4025]
+
+    ordered = motion.order(points)
+
+    assert ordered == [3800, 3875, 3950, 4025, 4100]
+    assert motion.travel(4100, ordered) == 350 + 50 + 300
+    assert motion.travel(4100, ordered) < motion.travel(4100, points)
+
+
+def test_invalid_configuration():
+    with pytest.raises(ValueError):
+        FocuserMotion(direction=0)
+    with pytest.raises(ValueError):
+        FocuserMotion(backlash=-1)
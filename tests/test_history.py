@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import settings
+from core import alg
+from core.autofocus import Autofocus
+from core.executor import MeasurementExecutors
+from core.history import FocusHistory, FocusPrediction, FocusPredictor
+from .sweep import SweepConnector
+
+
+def add_record(history, focus, temperature=None, timestamp=1000.0, rig=None):
+    return history.add(focus, 2.0, 'linear', -0.03, 0.03, 3.0, temperature=temperature, rig=rig, timestamp=timestamp)
+
+
+def test_history_persists(tmp_path):
+    path = str(tmp_path / 'history.json')
+    history = FocusHistory(path)
+    add_record(history, 3950, temperature=10.5, rig='FOCUSER')
+
+    reloaded = FocusHistory(path)
+
+    assert len(reloaded) == 1
+    assert reloaded.recent(rig='FOCUSER')[0]['temperature'] == 10.5
+    assert reloaded.recent(rig='OTHER') == []
+
+
+def test_predictor_follows_temperature(tmp_path):
+    history = FocusHistory(str(tmp_path / 'history.json'))
+    for i, temperature in enumerate([12.0, 10.0, 8.0, 6.0]):
+        add_record(history, 3900 + 5 * (12 - temperature), temperature=temperature, timestamp=1000.0 + i)
+
+    prediction = FocusPredictor(history).predict(temperature=4.0, now=2000.0)
+
+    assert prediction.focus == pytest.approx(3940)
+    assert prediction.uncertainty == pytest.approx(2.0)
+    assert prediction.bottom_width == pytest.approx(100)
+
+
+def test_predictor_ignores_old_records(tmp_path):
+    history = FocusHistory(str(tmp_path / 'history.json'))
+    add_record(history, 3950, timestamp=1000.0)
+
+    predictor = FocusPredictor(history, max_age=3600)
+
+    assert predictor.predict(now=2000.0).focus == 3950
+    assert predictor.predict(now=10000.0) is None
+
+
+def test_sweep_range_keeps_step_size(tmp_path):
+    history = FocusHistory(str(tmp_path / 'history.json'))
+    add_record(history, 3950)
+    prediction = FocusPredictor(history).predict(now=2000.0)
+
+    assert FocusPredictor.sweep_range(prediction, 3700, 4200, 10) == (3800, 4100, 6)
+
+
+def test_flat_slope_sweeps_full_range():
+    prediction = FocusPrediction(3950, 2.0, 0.0, 0.03, 3.0, 'linear')
+
+    assert prediction.bottom_width == np.inf
+    assert FocusPredictor.sweep_range(prediction, 3700, 4200, 10) == (3700, 4200, 10)
+
+
+@pytest.mark.parametrize('model', alg.V_CURVE_MODELS)
+def test_v_curve_center(model):
+    a, b, center, level = -0.03, 0.05, 3950, np.array([3.0, 4.0])
+
+    def fwhm(x):
+        slope = a if x < center else b
+        return level + slope * (x - center) if model == 'linear' else np.sqrt(level ** 2 + (slope * (x - center)) ** 2)
+
+    estimate = alg.v_curve_center(3850, fwhm(3850), 4020, fwhm(4020), a, b, model)
+
+    np.testing.assert_allclose(estimate, center)
+
+
+def test_autofocus_quick_check(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'LOCAL_STORAGE', str(tmp_path))
+    history = FocusHistory(str(tmp_path / 'history.json'))
+
+    first = SweepConnector(str(tmp_path), best_focus=3950)
+    Autofocus(first, detector='threshold', executor='inline', history=history).autofocus(1, 3700, 4200, 10)
+
+    second = SweepConnector(str(tmp_path), best_focus=3960)
+    best_focus = Autofocus(second, detector='threshold', executor='inline', history=history).autofocus(1, 3700, 4200, 10)
+
+    assert len(first.exposed) == 12
+    assert len(second.exposed) == 3
+    assert abs(best_focus - 3960) < 10
+    assert len(history) == 2
+
+
+@pytest.mark.parametrize('slope_a, starless', [(0.0, ()), (-0.03, (3850,)), (-0.03, (3850, 4050))])
+def test_quick_check_rejects_unusable_frames(tmp_path, slope_a, starless):
+    conn = SweepConnector(str(tmp_path), best_focus=3950, starless=starless)
+    prediction = FocusPrediction(3950, 2.0, slope_a, 0.03, 3.0, 'linear')
+    af = Autofocus(conn, detector='threshold', executor='inline')
+
+    with MeasurementExecutors('inline') as e:
+        assert af.quick_check(e, prediction, 1, 3700, 4200) is None
+
+
+def test_concurrent_writers_keep_all_records(tmp_path):
+    path = str(tmp_path / 'history.json')
+    shared = FocusHistory.shared(path)
+    # a second instance stands in for another process writing the same file
+    other = FocusHistory(path)
+
+    def add(history, rig):
+        for i in range(20):
+            add_record(history, 3900 + i, rig=rig, timestamp=1000.0 + i)
+
+    threads = [threading.Thread(target=add, args=(shared, rig)) for rig in ('A', 'B')]
+    threads.append(threading.Thread(target=add, args=(other, 'C')))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert FocusHistory.shared(str(tmp_path / '.' / 'history.json')) is shared
+    assert len(shared.recent(rig='A')) == len(shared.recent(rig='B')) == 20
+    assert len(FocusHistory(path).recent(rig='C')) == 20
+    assert sorted(os.listdir(str(tmp_path))) == ['history.json', 'history.json.lock']
+
+
+def test_history_keyed_by_server_and_focuser():
+    class Conn:
+        ip, port, focuser_name = '10.0.0.2', 7624, 'FOCUSER'
+
+    assert Autofocus(Conn()).rig == '10.0.0.2:7624/FOCUSER'
+    assert Autofocus(object()).rig is None
+
+
+def test_no_full_sweep_when_focus_at_range_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'LOCAL_STORAGE', str(tmp_path))
+    history = FocusHistory(str(tmp_path / 'history.json'))
+    add_record(history, 3720, timestamp=time.time())
+    conn = SweepConnector(str(tmp_path), best_focus=3705)
+
+    best_focus = Autofocus(conn, detector='threshold', executor='inline', history=history).autofocus(1, 3700, 4200, 10)
+
+    # quick check would leave the range; the narrowed sweep keeps the low limit, so no full sweep follows
+    assert conn.exposed[:-1] == [3700, 3742, 3784, 3826, 3870]
+    assert abs(best_focus - 3705) < 15
@@ -0,0 +1,103 @@
+import socket
+import time
+import xml.etree.ElementTree as ET
+from urllib.request import urlopen
+
+import pytest
+
+from .http_server import ImageHTTPServer
+from .indi_server import IndiSimulator, SimulatedCamera, SimulatedFocuser, SyntheticFrames
+
+
+class RawClient:
+    """Speaks just enough INDI XML to drive the simulator without indipy"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.parser = ET.XMLPullParser(events=('start', 'end'))
+        self.parser.feed('<stream>')
+        self.depth = 0
+
+    def send(self, xml):
+        self.sock.sendall(xml.encode())
+
+    def wait(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for event, element in self.parser.read_events():
+                if event == 'start':
+                    self.depth += 1
+                    continue
+                self.depth -= 1
+                if self.depth == 1 and predicate(element):
+                    return element
+            self.parser.feed(self.sock.recv(65536).decode())
+        raise TimeoutError()
+
+    def close(self):
+        self.sock.close()
+
+
+def values(element):
+    return {child.get('name'): (child.text or '').strip() for child in element}
+
+
+@pytest.fixture
+def simulator(tmpdir):
+    focuser = SimulatedFocuser(position=3900, speed=1000)
+    with ImageHTTPServer(str(tmpdir)) as host:
+        camera = SimulatedCamera(frames=SyntheticFrames(width=200, height=150, star_count=5), image_host=host)
+        camera.focuser = focuser
+        with IndiSimulator([camera, focuser]) as sim:
+            client = RawClient(sim.port)
+            yield sim, client
+            client.close()
+
+
+def test_properties_defined_after_connect(simulator):
+    sim, client = simulator
+
+    client.send('<getProperties version="1.7"/>')
+    client.wait(lambda e: e.tag == 'defSwitchVector' and e.get('device') == 'FOCUSER_SIMULATOR')
+
+    client.send(
+        '<newSwitchVector device="FOCUSER_SIMULATOR" name="CONNECTION">'
+        '<oneSwitch name="CONNECT">On</oneSwitch><oneSwitch name="DISCONNECT">Off</oneSwitch>'
+        '</newSwitchVector>'
+    )
+    defined = client.wait(lambda e: e.tag == 'defNumberVector' and e.get('name') == 'ABS_FOCUS_POSITION')
+
+    assert values(defined) == {'FOCUS_ABSOLUTE_POSITION': '3900'}
+
+
+def test_focuser_moves_at_speed(simulator):
+    sim, client = simulator
+    sim.devices['FOCUSER_SIMULATOR'].connected = True
+
+    start = time.monotonic()
+    client.send(
+        '<newNumberVector device="FOCUSER_SIMULATOR" name="ABS_FOCUS_POSITION">'
+        '<oneNumber name="FOCUS_ABSOLUTE_POSITION">4000</oneNumber></newNumberVector>'
+    )
+    done = client.wait(lambda e: e.get('name') == 'ABS_FOCUS_POSITION' and e.get('state') == 'Ok')
+
+    assert values(done) == {'FOCUS_ABSOLUTE_POSITION': '4000'}
+    assert time.monotonic() - start >= 0.1
+
+
+def test_exposure_publishes_image(simulator):
+    sim, client = simulator
+    camera = sim.devices['CAMERA_SIMULATOR']
+    camera.connected = True
+    camera.readout = 0.05
+
+    client.send(
+        '<newNumberVector device="CAMERA_SIMULATOR" name="CCD_EXPOSURE">'
+        '<oneNumber name="CCD_EXPOSURE_VALUE">2</oneNumber></newNumberVector>'
+    )
+    urls = values(client.wait(lambda e: e.get('name') == 'LAST_IMAGE_URL'))
+    client.wait(lambda e: e.get('name') == 'CCD_EXPOSURE' and e.get('state') == 'Ok')
+
+    with urlopen(urls['JPEG']) as response:
+        assert response.read(3) == b'\xff\xd8\xff'
+    assert urls['RAW'].endswith('IMG_0001.raw')
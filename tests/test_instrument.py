@@ -0,0 +1,65 @@
+import threading
+import timeit
+
+import pytest
+
+from benchmarks.synthetic import star_field, write_frame
+from core import instrument
+from core.value_object import Image, MeasuredImage
+
+
+def test_disabled_spans_record_nothing():
+    assert instrument.active() is None
+
+    with instrument.span('noop') as span:
+        pass
+    instrument.record('noop', 1.0)
+
+    assert not span.enabled
+    # a disabled span costs about a function call
+    per_call = min(timeit.repeat(lambda: instrument.span('noop'), number=10000, repeat=3)) / 10000
+    assert per_call < 20e-6
+
+
+def test_recording_collects_spans_from_threads(tmp_path):
+    def work():
+        with instrument.span('work', kind='thread'):
+            pass
+
+    with instrument.recording(str(tmp_path / 'run.json')) as recorder:
+        threads = [threading.Thread(target=work) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        instrument.record('readout', 0.5)
+
+    assert instrument.active() is None
+    summary = recorder.summary()
+    assert summary['work']['count'] == 3
+    assert summary['readout']['total'] == pytest.approx(0.5)
+    assert {s['kind'] for s in recorder.spans if s['name'] == 'work'} == {'thread'}
+
+
+def test_dump_and_aggregate(tmp_path):
+    paths = []
+    for i, fmt in enumerate(['json', 'csv']):
+        with instrument.recording() as recorder:
+            instrument.record('download', 1.0 + i, url=f'http://server/{i}.jpg')
+        paths.append(recorder.write(str(tmp_path / f'run-{i}.{fmt}')))
+
+    summary = instrument.aggregate(paths)
+
+    assert summary['download']['count'] == 2
+    assert summary['download']['total'] == pytest.approx(3.0)
+    assert 'download' in instrument.format_summary(summary)
+
+
+def test_measurement_phases(tmp_path):
+    frame, _ = star_field(width=400, height=300, star_count=5)
+    path = write_frame(str(tmp_path / 'frame.png'), frame)
+
+    with instrument.recording() as recorder:
+        MeasuredImage.from_image(Image(image_file=path, meta={'focus': 1}), detector='threshold')
+
+    assert {'decode', 'detect', 'fit', 'measure'} <= set(recorder.summary())
@@ -0,0 +1,84 @@
+import json
+from types import SimpleNamespace
+
+from core.autofocus import Autofocus
+from core.catalog import StarCatalog
+
+
+def make_measured_stars():
+    ms = Autofocus.MeasuredStars(1000, 800)
+    positions = [(100, 100), (400, 300), (420, 310), (700, 600)]
+    for focus in (10, 20, 30):
+        for i, (x, y) in enumerate(positions):
+            if focus == 10 and i == 3:
+                continue
+            ms.stars.append(Autofocus.MeasuredStar(
+                x=x + focus / 10, y=y, fwhm=2 + abs(focus - 20) / 10 + i / 100, focus=focus, area_radius=8,
+            ))
+    return ms
+
+
+def test_star_all_focuses():
+    ms = make_measured_stars()
+    seed = ms.stars_at_focus(20)[1]
+
+    matched = ms.star_all_focuses(seed, tolerance=3)
+
+    assert sorted(s.focus for s in matched) == [10, 20, 30]
+    assert all(abs(s.y - 300) < 1e-9 for s in matched)
+
+
+def test_star_at_focus_missing():
+    ms = make_measured_stars()
+    seed = ms.stars_at_focus(20)[3]
+
+    assert ms.star_at_focus(10, seed, tolerance=3) is None
+    assert ms.star_at_focus(30, seed, tolerance=3).x == 703
+
+
+def test_to_fwhm_list():
+    ms = make_measured_stars()
+
+    fwhms, stars = ms.to_fwhm_list(max_stars=3)
+
+    assert [row[0] for row in fwhms] == [10, 20, 30]
+    assert len(stars) == 3
+    assert all(len(row) == 4 for row in fwhms)
+    assert all(s.focus == 20 for s in stars)
+
+
+def test_index_follows_added_stars():
+    ms = make_measured_stars()
+    assert ms.focus_points() == [10, 20, 30]
+
+    ms.stars.append(Autofocus.MeasuredStar(x=100, y=100, fwhm=2, focus=40, area_radius=8))
+
+    assert ms.focus_points() == [10, 20, 30, 40]
+
+
+def test_tracks_extended_by_added_image():
+    ms = make_measured_stars()
+    ms.build_tracks()
+
+    img = SimpleNamespace(
+        shape=(1000, 800),
+        image=SimpleNamespace(meta={'focus': 21}),
+        catalog=StarCatalog.from_star_areas([SimpleNamespace(x=402.1, y=300, fwhm=2.0, flux=100.0, radius=8)]),
+    )
+    ms.add_measured_image(img)
+
+    added = ms.stars_at_focus(21)[0]
+    track = ms.track_for(added)
+    assert track.focus_points() == [10, 20, 21, 30]
+    assert track.at_focus(20).y == 300
+    assert json.loads(json.dumps(track.to_dict()))['seed_focus'] == 20
+
+
+def test_catalog():
+    ms = make_measured_stars()
+
+    catalog = ms.catalog()
+
+    assert len(catalog) == len(ms.stars)
+    assert len(catalog.at_focus(10)) == 3
+    assert catalog.positions().shape == (len(ms.stars), 2)
@@ -0,0 +1,120 @@
+import os
+import time
+
+import pytest
+
+from benchmarks.synthetic import star_field, write_frame
+from core import instrument
+from core.executor import MeasurementExecutors, InlineExecutor, EXECUTOR_BACKENDS
+from core.pipeline import SweepPipeline
+from core.value_object import Image, MeasuredImage
+
+
+@pytest.fixture
+def images(tmp_path):
+    result = []
+    for focus in (10, 20, 30):
+        frame, _ = star_field(width=400, height=300, star_count=5, seeing=3 + abs(focus - 20) / 10)
+        path = write_frame(str(tmp_path / f'focus-{focus}.png'), frame)
+        result.append(Image(image_file=path, meta={'focus': focus}))
+    return result
+
+
+@pytest.mark.parametrize('backend', EXECUTOR_BACKENDS)
+def test_pipeline_backends(images, backend):
+    with MeasurementExecutors(backend, max_workers=2) as e:
+        pipeline = SweepPipeline(
+            e.io,
+            measure_options={'detector': 'threshold'},
+            keep_frames=False,
+            measure_executor=e.measure,
+        )
+        for image in images:
+            pipeline.submit(image, image.meta['focus'])
+        measured = pipeline.results()
+
+    assert [m.focus for m in measured] == [10, 20, 30]
+    assert all(len(m.catalog) > 0 for m in measured)
+    assert all(m.frame_released for m in measured)
+    assert all(m.shape == (300, 400) for m in measured)
+
+
+def test_worker_process_spans_are_merged(images):
+    started = time.perf_counter()
+    with instrument.recording() as recorder, MeasurementExecutors('processes', max_workers=2) as e:
+        pipeline = SweepPipeline(e.io, measure_options={'detector': 'threshold'}, measure_executor=e.measure)
+        for image in images:
+            pipeline.submit(image, image.meta['focus'])
+        pipeline.results()
+
+    spans = [s for s in recorder.spans if s['name'] in ('decode', 'detect', 'fit', 'measure')]
+    assert {s['name'] for s in spans} == {'decode', 'detect', 'fit', 'measure'}
+    assert all(s['process'] != os.getpid() for s in spans)
+    assert all(started - recorder.origin <= s['start'] <= time.perf_counter() - recorder.origin for s in spans)
+
+
+def test_inline_executor_propagates_errors():
+    future = InlineExecutor().submit(lambda: 1 / 0)
+
+    with pytest.raises(ZeroDivisionError):
+        future.result()
+
+
+def test_drain_returns_frames_in_order(images):
+    with MeasurementExecutors('threads', max_workers=2) as e:
+        pipeline = SweepPipeline(e.io, measure_options={'detector': 'threshold'})
+        for image in images:
+            pipeline.submit(image, image.meta['focus'])
+        drained = pipeline.drain() + pipeline.drain(wait=True)
+
+    assert [m.focus for m in drained] == [10, 20, 30]
+    assert pipeline.drain(wait=True) == []
+
+
+@pytest.fixture
+def slow_measure(monkeypatch):
+    """Makes every measurement take at least `delay` seconds and records its (start, end)"""
+    intervals = {}
+    measure = MeasuredImage.measure
+
+    def slow(self, delay=0.2):
+        start = time.monotonic()
+        time.sleep(delay)
+        measure(self)
+        intervals[self.image.meta['focus']] = (start, time.monotonic())
+
+    monkeypatch.setattr(MeasuredImage, 'measure', slow)
+    return intervals
+
+
+def test_measurement_overlaps_next_exposure(images, slow_measure):
+    exposures = {}
+    with MeasurementExecutors('threads', max_workers=2) as e:
+        pipeline = SweepPipeline(e.io, max_in_flight=2, measure_options={'detector': 'threshold'})
+        for image in images:
+            start = time.monotonic()
+            time.sleep(0.2)  # slow exposure of this frame
+            exposures[image.meta['focus']] = (start, time.monotonic())
+            pipeline.submit(image, image.meta['focus'])
+        pipeline.results()
+
+    # frame N is measured while frame N+1 is being exposed
+    for focus, next_focus in ((10, 20), (20, 30)):
+        measure_start, measure_end = slow_measure[focus]
+        expose_start, expose_end = exposures[next_focus]
+        assert measure_start < expose_end and expose_start < measure_end
+
+
+def test_submit_blocks_at_max_in_flight(images, slow_measure):
+    submitted = []
+    with MeasurementExecutors('threads', max_workers=2) as e:
+        pipeline = SweepPipeline(e.io, max_in_flight=1, measure_options={'detector': 'threshold'})
+        for image in images:
+            pipeline.submit(image, image.meta['focus'])
+            submitted.append(time.monotonic())
+        pipeline.results()
+
+    # with one frame in flight the next submit waits until the previous measurement finished
+    assert submitted[1] >= slow_measure[10][1]
+    assert submitted[2] >= slow_measure[20][1]
+    assert submitted[0] < slow_measure[10][1]
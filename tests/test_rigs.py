@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+import settings
+
+pytest.importorskip('indi')
+
+from core.rigs import Rig, RigScheduler  # noqa: E402
+from .sweep import SweepConnector  # noqa: E402
+
+
+class FakeConnector:
+    def __init__(self, **connection):
+        self.connection = connection
+        self.connected = 0
+        self.outstanding = []
+
+    def connect(self):
+        self.connected += 1
+
+    def close(self, timeout=None):
+        pass
+
+
+def test_jobs_keep_rig_order_and_run_rigs_concurrently():
+    log = []
+    running = set()
+    overlap = threading.Event()
+
+    def job(conn, step):
+        running.add(conn.connection['camera_name'])
+        if len(running) > 1:
+            overlap.set()
+        time.sleep(0.05)
+        log.append((conn.connection['camera_name'], step))
+        running.discard(conn.connection['camera_name'])
+        return conn
+
+    rigs = [Rig('a', camera_name='A'), Rig('b', camera_name='B')]
+    with RigScheduler(rigs, connector_factory=FakeConnector, jobs={'job': job}) as scheduler:
+        results = scheduler.run([('a', 'job', {'step': i}) for i in range(3)] + [('b', 'job', {'step': 0})])
+
+    assert [step for camera, step in log if camera == 'A'] == [0, 1, 2]
+    assert overlap.is_set()
+    assert results[0] is results[2]
+    assert results[0].connected == 1
+
+
+def test_rig_options_override_job_parameters():
+    rig = Rig('a', timelapse={'dither': 0})
+
+    assert rig.options('timelapse', {'dither': 5, 'count': 3}) == {'dither': 0, 'count': 3}
+    assert rig.options('autofocus', {'steps': 10}) == {'steps': 10}
+
+
+def test_rigs_from_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'RIGS', {'one': {'camera_name': 'CAM'}, 'two': {}})
+
+    assert [r.name for r in Rig.from_settings()] == ['one', 'two']
+    assert Rig.from_settings(['one'])[0].camera_name == 'CAM'
+    with pytest.raises(ValueError):
+        Rig.from_settings(['three'])
+
+
+def test_autofocus_on_two_rigs(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'LOCAL_STORAGE', str(tmp_path))
+    best = {'A': 3870, 'B': 3950}
+
+    def factory(camera_name, **connection):
+        directory = tmp_path / camera_name
+        directory.mkdir()
+        conn = SweepConnector(str(directory), best[camera_name])
+        conn.connect = lambda: None
+        conn.close = lambda timeout=None: None
+        return conn
+
+    rigs = [Rig('a', camera_name='A'), Rig('b', camera_name='B')]
+    options = {'time': 1, 'min_focus': 3800, 'max_focus': 4100, 'steps': 6, 'detector': 'threshold', 'history': False}
+    with RigScheduler(rigs, max_workers=2, connector_factory=factory) as scheduler:
+        results = scheduler.run([('a', 'autofocus', options), ('b', 'autofocus', options)])
+
+    assert abs(results[0] - 3870) < 15
+    assert abs(results[1] - 3950) < 15
@@ -0,0 +1,89 @@
+import threading
+import time
+from concurrent import futures
+
+import pytest
+
+from core.timelapse import Timelapse
+
+
+class FakeImage:
+    def __init__(self, future):
+        self.download_future = future
+
+
+class FakeConnector:
+    def __init__(self, download_time=0.0):
+        self.download_time = download_time
+        self.pool = futures.ThreadPoolExecutor(max_workers=4)
+        self.dithers = []
+        self.exposures = 0
+        self.max_running = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def exposure(self, seconds):
+        time.sleep(seconds)
+        self.exposures += 1
+        return f'jpg-{self.exposures}', f'raw-{self.exposures}'
+
+    def download(self):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.download_time)
+        with self.lock:
+            self.running -= 1
+
+    def download_exposure(self, url, raw_url, prefix=None):
+        return FakeImage(self.pool.submit(self.download)), FakeImage(self.pool.submit(self.download))
+
+    def dither(self, pixels):
+        self.dithers.append(pixels)
+
+
+def test_dithers_every_n_frames_but_not_after_last():
+    conn = FakeConnector()
+    report = Timelapse(conn, time=0.01, dither=3, dither_every=2).run(5)
+
+    assert conn.exposures == 5
+    assert conn.dithers == [3, 3]
+    assert [f.dithered for f in report.frames] == [False, True, False, True, False]
+
+
+def test_bounds_download_backlog():
+    conn = FakeConnector(download_time=0.1)
+    timelapse = Timelapse(conn, time=0.01, dither=0, max_pending=1)
+    report = timelapse.run(4)
+
+    # with one pending frame the next exposure waits for previous downloads
+    assert conn.max_running == 2
+    assert all(f.backlog_wait > 0.05 for f in report.frames[1:])
+    assert all(img.download_future.done() for pair in timelapse.images for img in pair)
+
+
+def test_duty_cycle_report():
+    report = Timelapse(FakeConnector(), time=0.05, dither=0).run(3)
+
+    assert report.exposure == pytest.approx(0.15)
+    assert 0.5 < report.duty_cycle <= 1.0
+    assert len(report.to_dict()['frames']) == 3
+
+
+class FailingConnector(FakeConnector):
+    def fail(self):
+        raise IOError('connection reset')
+
+    def download_exposure(self, url, raw_url, prefix=None):
+        if url != 'jpg-2':
+            return super().download_exposure(url, raw_url, prefix)
+        return FakeImage(self.pool.submit(self.fail)), FakeImage(self.pool.submit(self.fail))
+
+
+@pytest.mark.parametrize('max_pending', [1, 5])
+def test_failed_downloads_recorded_per_frame(max_pending):
+    report = Timelapse(FailingConnector(), time=0.01, dither=0, max_pending=max_pending).run(3)
+
+    assert [len(f.download_errors) for f in report.frames] == [0, 2, 0]
+    assert report.frames[1].to_dict()['download_errors'] == ['connection reset'] * 2
+    assert report.to_dict()['failed_downloads'] == 2